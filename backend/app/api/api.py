@@ -1,9 +1,14 @@
 from fastapi import APIRouter
+from app.core.config import settings
 from app.api.endpoints import upload, stories, audio
 
 api_router = APIRouter()
 
-# Include all endpoint routers
-api_router.include_router(upload.router, prefix="/api", tags=["upload"])
+# Inference routes first so that /audio/voices wins over /audio/{filename}
+if not settings.edge_mode:
+    api_router.include_router(upload.router, prefix="/api", tags=["upload"])
+    api_router.include_router(audio.inference_router, prefix="/api", tags=["audio"])
+
+# Delivery and stats routes are available in every mode
 api_router.include_router(stories.router, prefix="/api", tags=["stories"])
 api_router.include_router(audio.router, prefix="/api", tags=["audio"]) 
\ No newline at end of file
@@ -1,18 +1,33 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, HTTPException, Request, UploadFile, File, Form, Header
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from app.services.tts_service import tts_service
 from app.services.file_service import file_service
+from app.services.voice_service import voice_service
+from app.services.tts_fragments import fragment_cache
+from app.services.idempotency_service import idempotency_cache
+from app.api.idempotency import run_idempotent, mark_replayed
+from app.core.tracing import current_span
 from pydantic import BaseModel
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple, Dict, Any, List
 import logging
-import os
+import uuid
 
 logger = logging.getLogger(__name__)
+# Delivery routes are served in edge mode; inference routes need the TTS model
 router = APIRouter()
+inference_router = APIRouter()
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "public, max-age=0, must-revalidate"
 
 
 class AudioGenerationRequest(BaseModel):
     text: str
     voice: str = "default"
+    format: Optional[str] = None  # wav, flac, ogg, opus, mp3; defaults to settings.audio_format
+    stream: bool = False  # return the encoded audio as the response body
 
 
 class AudioResponse(BaseModel):
@@ -21,52 +36,289 @@ class AudioResponse(BaseModel):
     generation_time: float
     duration: float
     model_used: str
+    format: str
+    file_size: int
     message: str
 
 
-@router.post("/audio/generate", response_model=AudioResponse)
-async def generate_audio(request: AudioGenerationRequest):
+@inference_router.post("/audio/generate", response_model=AudioResponse)
+async def generate_audio(
+    request: AudioGenerationRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """
     Generate audio narration from text.
     
+    Synthesis and encoding run in a worker thread. With ``stream`` set, the
+    encoded audio is streamed back directly instead of the JSON metadata.
+    Retries sent with the same ``Idempotency-Key`` header reuse the stored
+    result instead of synthesizing again.
+    
     Args:
-        request: Audio generation request with text and voice preference
+        request: Audio generation request with text, voice and format preference
+        idempotency_key: Client-chosen key identifying retries of this request
     
     Returns:
-        Audio generation result with metadata
+        Audio generation result with metadata, or the audio itself when streaming
     """
     try:
-        # Generate unique filename for audio
-        import time
-        audio_filename = f"audio_{int(time.time())}.{file_service.audio_format}"
-        audio_path = file_service.get_audio_path(audio_filename)
+        audio_format = tts_service.resolve_format(request.format)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported audio format. Supported formats: {', '.join(tts_service.get_supported_formats())}"
+        )
+    
+    current_span().set_attribute("voice", request.voice)
+    current_span().set_attribute("format", audio_format)
+    
+    # The stream flag only changes how the stored result is delivered, so it is not part of the fingerprint
+    fingerprint = idempotency_cache.fingerprint(request.text, request.voice, audio_format)
+    result, replayed = await run_idempotent(
+        idempotency_key, "audio.generate", fingerprint,
+        lambda: _synthesize_audio(request.text, request.voice, audio_format)
+    )
+    
+    if request.stream:
+        audio_filename = result["audio_filename"]
+        streaming_response = StreamingResponse(
+            file_service.storage.stream(file_service.get_audio_key(audio_filename)),
+            media_type=file_service.get_audio_media_type(audio_filename),
+            headers={
+                "X-Audio-Filename": audio_filename,
+                "X-Audio-Duration": str(result["duration"]),
+                "X-Model-Used": result["model_used"]
+            }
+        )
+        mark_replayed(streaming_response, replayed)
+        return streaming_response
+    
+    mark_replayed(response, replayed)
+    return AudioResponse(**result)
+
+
+async def _synthesize_audio(text: str, voice: str, audio_format: str) -> Dict[str, Any]:
+    """Synthesize, encode and store narration audio."""
+    try:
+        # Generate into a temporary file, then rename it after its content hash
+        temp_filename = f"tmp_{uuid.uuid4().hex}.{audio_format}"
         
         # Generate audio using TTS service
-        audio_result = tts_service.generate_audio(
-            text=request.text,
-            output_path=audio_path,
-            voice=request.voice
+        audio_result = await run_in_threadpool(
+            tts_service.generate_audio,
+            text=text,
+            output_path=file_service.get_audio_path(temp_filename),
+            voice=voice,
+            audio_format=audio_format
         )
+        audio_filename = await run_in_threadpool(file_service.finalize_audio, temp_filename)
+        audio_path = file_service.get_audio_path(audio_filename)
         
-        return AudioResponse(
-            audio_filename=audio_filename,
-            audio_path=audio_path,
-            generation_time=audio_result["generation_time"],
-            duration=audio_result.get("duration", 0),
-            model_used=audio_result["model_used"],
-            message="Audio generated successfully!"
-        )
+        return {
+            "audio_filename": audio_filename,
+            "audio_path": audio_path,
+            "generation_time": audio_result["generation_time"],
+            "duration": audio_result.get("duration", 0),
+            "model_used": audio_result["model_used"],
+            "format": audio_format,
+            "file_size": file_service.get_file_info(audio_path).get("size", 0),
+            "message": "Audio generated successfully!"
+        }
         
     except Exception as e:
         logger.error(f"Error generating audio: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate audio")
 
 
-@router.get("/audio/{filename}")
-async def get_audio(filename: str):
+@inference_router.get("/audio/voices")
+async def list_voices():
+    """List built-in and registered narration voices."""
+    return {
+        "voices": tts_service.get_available_voices(),
+        "custom_voices": voice_service.list_voices()
+    }
+
+
+@inference_router.post("/audio/voices")
+async def register_voice(
+    name: str = Form(...),
+    files: List[UploadFile] = File(...)
+):
+    """
+    Register a custom narration voice from reference clips.
+    
+    The voice's conditioning latents and speaker embedding are computed once
+    here and cached, so later generations with this voice skip that work.
+    
+    Args:
+        name: Voice name to use in generation requests
+        files: One or more short reference recordings of the speaker
+    
+    Returns:
+        Voice registration details
+    """
+    if name in tts_service.get_available_voices() and not voice_service.has_voice(name):
+        raise HTTPException(status_code=400, detail="Voice name is reserved for a built-in voice")
+    
+    try:
+        clips = []
+        for upload in files:
+            data = await upload.read()
+            if len(data) > file_service.max_file_size:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File size exceeds maximum allowed size of {file_service.max_file_size} bytes"
+                )
+            clips.append((upload.filename or "", data))
+        
+        result = await run_in_threadpool(tts_service.register_voice, name, clips)
+        return {**result, "message": "Voice registered successfully!"}
+        
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error registering voice {name}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to register voice")
+
+
+@inference_router.delete("/audio/voices/{name}")
+async def delete_voice(name: str):
+    """Delete a registered voice and its cached conditioning."""
+    if not voice_service.delete_voice(name):
+        raise HTTPException(status_code=404, detail="Voice not found")
+    return {"message": "Voice deleted successfully"}
+
+
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range "bytes=" header into an inclusive (start, end) pair.
+    
+    Returns None when the header should be ignored (malformed or multi-range),
+    and raises a 416 HTTPException when the range cannot be satisfied.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if not start_str:
+            # Suffix range: the last N bytes
+            length = int(end_str)
+            if length <= 0:
+                raise ValueError
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+    except ValueError:
+        return None
+    
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, min(end, size - 1)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def _if_range_matches(header: str, etag: str) -> bool:
+    """Strong comparison of an If-Range header against an ETag; weak validators never match."""
+    header = header.strip()
+    return not header.startswith("W/") and header == etag
+
+
+def _etag_for(filename: str, stat: Dict[str, Any]) -> str:
+    """
+    Quoted ETag for a stored media object.
+    
+    Content-addressed files are named after the hash of their bytes, which is
+    the same on every node and survives restores; other files fall back to the
+    backend's validator.
+    """
+    if file_service.is_content_addressed(filename):
+        return f'"{filename.rsplit(".", 1)[0].removeprefix("audio_")}"'
+    return f'"{stat["etag"]}"'
+
+
+def _not_modified(request: Request, etag: str, modified: float) -> bool:
+    """Evaluate conditional request headers (If-None-Match takes precedence)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _build_media_response(request: Request, key: str, filename: str, stat: Dict[str, Any]) -> Response:
+    """Build a cache-aware, range-capable response for a stored media object."""
+    size = stat["size"]
+    etag = _etag_for(filename, stat)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat["modified"], usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if file_service.is_content_addressed(filename) else REVALIDATE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes"
+    }
+    
+    if _not_modified(request, etag, stat["modified"]):
+        return Response(status_code=304, headers=headers)
+    
+    headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    media_type = file_service.get_audio_media_type(filename)
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header:
+        if_range = request.headers.get("if-range")
+        if if_range is None or _if_range_matches(if_range, etag):
+            byte_range = _parse_range(range_header, size)
+    
+    status_code = 200
+    start, end = 0, size - 1
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    
+    if request.method == "HEAD" or size == 0:
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    
+    return StreamingResponse(
+        file_service.storage.stream(key, start=start, end=end),
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type
+    )
+
+
+@router.api_route("/audio/{filename}", methods=["GET", "HEAD"])
+async def get_audio(filename: str, request: Request):
     """
     Get audio file by filename.
     
+    Supports byte-range requests (206) for seeking and conditional requests
+    (ETag / Last-Modified with 304) so repeat listeners don't re-download.
+    
     Args:
         filename: Name of the audio file
     
@@ -74,16 +326,18 @@ async def get_audio(filename: str):
         Audio file response
     """
     try:
-        audio_path = file_service.get_audio_path(filename)
+        audio_key = file_service.get_audio_key(filename)
+        stat = file_service.storage.stat(audio_key)
         
-        if not os.path.exists(audio_path):
+        if stat is None:
             raise HTTPException(status_code=404, detail="Audio file not found")
         
-        return FileResponse(
-            path=audio_path,
-            media_type="audio/wav",
-            filename=filename
-        )
+        # Let remote object stores serve the bytes directly
+        download_url = file_service.get_download_url(audio_key)
+        if download_url:
+            return RedirectResponse(url=download_url, status_code=307)
+        
+        return _build_media_response(request, audio_key, filename, stat)
         
     except HTTPException:
         raise
@@ -118,11 +372,13 @@ async def delete_audio(filename: str):
         raise HTTPException(status_code=500, detail="Failed to delete audio")
 
 
-@router.get("/audio/status/tts")
+@inference_router.get("/audio/status/tts")
 async def get_tts_status():
     """Get the status of the TTS service."""
     return {
         "tts_model_loaded": tts_service.is_model_loaded(),
         "available_voices": tts_service.get_available_voices(),
+        "supported_formats": tts_service.get_supported_formats(),
+        "template_fragments": fragment_cache.get_stats(),
         "model_name": "xtts-v2"
     } 
\ No newline at end of file
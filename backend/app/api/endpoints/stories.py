@@ -1,7 +1,11 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from typing import Dict, Any, Optional
 import logging
-import os
-from app.services.file_service import file_service
+import time
+from app.services.file_service import file_service, AUDIO_MEDIA_TYPES
+from app.services.image_store import image_ref_store
+from app.services.story_store import story_store, build_match_query
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -19,27 +23,84 @@ async def get_stories_stats():
         # Get storage stats from file service
         storage_stats = file_service.get_storage_stats()
         
-        # Count image files in upload directory
-        images_dir = os.path.join(file_service.upload_dir, "images")
-        audio_dir = os.path.join(file_service.upload_dir, "audio")
-        
-        image_count = 0
-        audio_count = 0
-        
-        if os.path.exists(images_dir):
-            image_count = len([f for f in os.listdir(images_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))])
-        
-        if os.path.exists(audio_dir):
-            audio_count = len([f for f in os.listdir(audio_dir) if f.lower().endswith('.wav')])
+        # Count image and audio objects in storage
+        image_count = len(file_service.list_files("images/", ["jpg", "jpeg", "png", "webp"]))
+        audio_count = len(file_service.list_files("audio/", list(AUDIO_MEDIA_TYPES)))
         
         return {
             "total_images": image_count,
             "total_audio_files": audio_count,
             "total_size_mb": storage_stats.get("total_size_mb", 0),
             "upload_dir": storage_stats.get("upload_dir", ""),
+            "storage_backend": storage_stats.get("storage_backend", ""),
+            "image_deduplication": image_ref_store.get_stats(),
+            "stories": story_store.get_stats(),
             "message": "File-based storage statistics"
         }
         
     except Exception as e:
         logger.error(f"Error getting file stats: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get statistics") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to get statistics")
+
+
+def _search_result(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape a stored story like the upload response, plus its relevance score."""
+    return {
+        "id": row["id"],
+        "title": row["title"],
+        "content": row["content"],
+        "story_type": row["story_type"],
+        "caption": row["caption"],
+        "upload_id": row["upload_id"],
+        "image_filename": row["image_filename"],
+        "model_used": row["model_used"],
+        "caption_source": row["caption_source"],
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["created_at"])),
+        "score": round(row["score"], 4)
+    }
+
+
+@router.get("/stories/search")
+async def search_stories(
+    q: str = Query(..., min_length=1, max_length=200),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(10, ge=1, le=50),
+    story_type: Optional[str] = None
+):
+    """
+    Search generated stories by the words of their captions and titles.
+    
+    Every word must match (stemmed, so "beaches" finds "beach"); end a word
+    with ``*`` to match it as a prefix. All matches are ranked by relevance
+    and can be paged through.
+    
+    Args:
+        q: Words to search for
+        page: 1-based page number
+        page_size: Results per page
+        story_type: Only return stories of this type ("story" or "poem")
+    
+    Returns:
+        A page of matching stories, best first, with the total number of matches
+    """
+    if story_type is not None and story_type not in ["story", "poem"]:
+        raise HTTPException(status_code=400, detail="story_type must be 'story' or 'poem'")
+    
+    match = build_match_query(q)
+    if match is None:
+        raise HTTPException(status_code=400, detail="Search query must contain at least one word")
+    
+    try:
+        rows = await run_in_threadpool(story_store.search, match, page_size, (page - 1) * page_size, story_type)
+        total = await run_in_threadpool(story_store.count, match, story_type)
+    except Exception as e:
+        logger.error(f"Error searching stories: {e}")
+        raise HTTPException(status_code=500, detail="Failed to search stories")
+    
+    return {
+        "query": q,
+        "page": page,
+        "page_size": page_size,
+        "total": total,
+        "results": [_search_result(row) for row in rows]
+    }
@@ -1,62 +1,137 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi import APIRouter, UploadFile, File, HTTPException, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from app.services.file_service import file_service
 from app.services.kosmos_service import kosmos_service
+from app.services.tts_service import tts_service, split_sentences
+from app.services.phash_index import caption_index
+from app.services.embedding_cache import embedding_cache
+from app.services.idempotency_service import idempotency_cache
+from app.services.story_store import story_store
+from app.api.streaming import format_sse, iterate_in_context, SSE_HEADERS
+from app.api.idempotency import run_idempotent, mark_replayed
+from app.core.tracing import trace_span, current_span, get_request_id
+from typing import Dict, Any, Optional
+import asyncio
+import base64
+import hashlib
 import logging
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
+def _build_story_response(story_id: int, file_info: Dict[str, Any], story_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the API response for a generated story."""
+    return {
+        "id": story_id,
+        "title": story_data["title"],
+        "content": story_data["content"],
+        "story_type": story_data["story_type"],
+        "caption": story_data.get("caption"),
+        "upload_id": file_info["upload_id"],
+        "image_filename": file_info["filename"],
+        "image_path": file_info["path"],
+        "generation_time": story_data["generation_time"],
+        "model_used": story_data["model_used"],
+        "caption_source": story_data.get("caption_source", "model"),
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "request_id": get_request_id(),
+        "message": "Story generated successfully!"
+    }
+
+
+def _save_story(file_info: Dict[str, Any], story_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Persist and index a generated story (searchable right away), then build its response."""
+    story_id = story_store.add(story_data, upload_id=file_info["upload_id"], image_filename=file_info["filename"])
+    return _build_story_response(story_id, file_info, story_data)
+
+
 @router.post("/upload")
 async def upload_image(
+    response: Response,
     file: UploadFile = File(...),
-    story_type: str = "story"
+    story_type: str = "story",
+    reuse_caption: bool = True,
+    deadline_ms: Optional[float] = Query(None, gt=0),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """
     Upload an image and generate a story or poem.
     
+    Retries sent with the same ``Idempotency-Key`` header get the stored
+    response instead of generating (and storing) the story again.
+    
     Args:
         file: Image file to upload
         story_type: Type of content to generate ("story" or "poem")
+        reuse_caption: Reuse the caption of a near-duplicate photo if one is indexed
+        deadline_ms: Captioning latency budget; cheaper caption tiers answer when it is missed
+        idempotency_key: Client-chosen key identifying retries of this request
     
     Returns:
         Generated story with metadata
     """
+    # Validate story type
+    if story_type not in ["story", "poem"]:
+        raise HTTPException(status_code=400, detail="story_type must be 'story' or 'poem'")
+    current_span().set_attribute("story_type", story_type)
+    
+    fingerprint = ""
+    if idempotency_key:
+        # A retry must carry the same photo, not just one with the same name and size
+        content_hash = await _hash_upload(file)
+        fingerprint = idempotency_cache.fingerprint(
+            content_hash, file.filename, story_type, reuse_caption, deadline_ms
+        )
+    story, replayed = await run_idempotent(
+        idempotency_key, "upload", fingerprint,
+        lambda: _upload_and_generate(file, story_type, reuse_caption, deadline_ms)
+    )
+    mark_replayed(response, replayed)
+    return story
+
+
+async def _hash_upload(file: UploadFile) -> str:
+    """SHA-256 of an upload's bytes (up to the size limit), leaving the file rewound."""
+    digest = hashlib.sha256()
+    remaining = file_service.max_file_size + 1
+    while remaining > 0:
+        chunk = await file.read(min(1024 * 1024, remaining))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+    await file.seek(0)
+    return digest.hexdigest()
+
+
+async def _upload_and_generate(file: UploadFile, story_type: str, reuse_caption: bool,
+                               deadline_ms: Optional[float]) -> Dict[str, Any]:
+    """Save an uploaded image and generate its story."""
     try:
-        # Validate story type
-        if story_type not in ["story", "poem"]:
-            raise HTTPException(status_code=400, detail="story_type must be 'story' or 'poem'")
-        
         # Save uploaded file
         file_info = await file_service.save_uploaded_image(file)
         
         try:
             # Generate story using Kosmos-2
-            story_data = kosmos_service.generate_story(
+            story_data = await run_in_threadpool(
+                kosmos_service.generate_story,
                 image_path=file_info["path"],
-                story_type=story_type
+                story_type=story_type,
+                phash=file_info.get("phash"),
+                reuse_caption=reuse_caption,
+                deadline_ms=deadline_ms
             )
             
-            # Create response with generated story
-            response = {
-                "id": int(time.time()),  # Simple ID based on timestamp
-                "title": story_data["title"],
-                "content": story_data["content"],
-                "story_type": story_data["story_type"],
-                "image_filename": file_info["filename"],
-                "image_path": file_info["path"],
-                "generation_time": story_data["generation_time"],
-                "model_used": story_data["model_used"],
-                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                "message": "Story generated successfully!"
-            }
-            
-            return response
+            # Store the story and create the response
+            return await run_in_threadpool(_save_story, file_info, story_data)
             
         except Exception as e:
             # Clean up uploaded file if story generation fails
-            file_service.delete_file(file_info["path"])
+            file_service.delete_file(file_info["path"], upload_id=file_info["upload_id"])
             logger.error(f"Error generating story: {e}")
             raise HTTPException(status_code=500, detail="Failed to generate story from image")
             
@@ -67,11 +142,231 @@ async def upload_image(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+@router.post("/upload/stream")
+async def upload_and_stream(
+    request: Request,
+    file: UploadFile = File(...),
+    story_type: str = "story",
+    reuse_caption: bool = True
+):
+    """
+    Upload an image and stream the caption as it is decoded.
+    
+    The response is a Server-Sent Events stream: one ``token`` event per
+    decoded caption piece, a ``caption`` event with the full description and
+    its source, then a ``story`` event with the same payload as
+    ``POST /api/upload``. Decoding stops if the client disconnects.
+    
+    Args:
+        request: Incoming request, polled for client disconnects
+        file: Image file to upload
+        story_type: Type of content to generate ("story" or "poem")
+        reuse_caption: Reuse the caption of a near-duplicate photo if one is indexed
+    
+    Returns:
+        Event stream of caption tokens followed by the story
+    """
+    if story_type not in ["story", "poem"]:
+        raise HTTPException(status_code=400, detail="story_type must be 'story' or 'poem'")
+    
+    try:
+        start_time = time.time()
+        file_info = await file_service.save_uploaded_image(file)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in stream endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    
+    stop = threading.Event()
+    events = kosmos_service.stream_story(
+        image_path=file_info["path"],
+        story_type=story_type,
+        phash=file_info.get("phash"),
+        reuse_caption=reuse_caption,
+        stop=stop
+    )
+    
+    async def event_stream():
+        first_token = True
+        stream = iterate_in_context(events)
+        try:
+            async for event, payload in stream:
+                if await request.is_disconnected():
+                    logger.info("Client disconnected from caption stream; stopping generation")
+                    stop.set()
+                    # No story was saved for the upload, as on the error path below
+                    await run_in_threadpool(file_service.delete_file, file_info["path"], file_info["upload_id"])
+                    break
+                if event == "token" and first_token:
+                    first_token = False
+                    current_span().set_attribute("time_to_first_token_ms", (time.time() - start_time) * 1000)
+                if event == "story":
+                    payload = await run_in_threadpool(_save_story, file_info, payload)
+                yield format_sse(payload, event=event)
+        except Exception as e:
+            await run_in_threadpool(file_service.delete_file, file_info["path"], file_info["upload_id"])
+            logger.error(f"Error streaming story: {e}")
+            yield format_sse({"message": "Failed to generate story from image", "request_id": get_request_id()}, event="error")
+        finally:
+            # Also reached when the response is cancelled: end decoding before closing the generator
+            stop.set()
+            await stream.aclose()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.post("/upload/narrate")
+async def upload_and_narrate(
+    file: UploadFile = File(...),
+    story_type: str = "story",
+    voice: str = "default",
+    audio_format: Optional[str] = None,
+    reuse_caption: bool = True,
+    deadline_ms: Optional[float] = Query(None, gt=0)
+):
+    """
+    Upload an image, generate a story and stream its narration in one request.
+    
+    The response is a Server-Sent Events stream: a ``story`` event with the
+    same payload as ``POST /api/upload``, one ``audio`` event per sentence
+    (base64-encoded audio, synthesized while the previous one is being sent),
+    and a final ``done`` event naming the stored full narration.
+    
+    Args:
+        file: Image file to upload
+        story_type: Type of content to generate ("story" or "poem")
+        voice: Voice to narrate with
+        audio_format: Output format for the audio chunks
+        reuse_caption: Reuse the caption of a near-duplicate photo if one is indexed
+        deadline_ms: Captioning latency budget; cheaper caption tiers answer when it is missed
+    
+    Returns:
+        Event stream with the story followed by audio chunks
+    """
+    if story_type not in ["story", "poem"]:
+        raise HTTPException(status_code=400, detail="story_type must be 'story' or 'poem'")
+    
+    try:
+        audio_format = tts_service.resolve_format(audio_format)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported audio format. Supported formats: {', '.join(tts_service.get_supported_formats())}"
+        )
+    
+    try:
+        start_time = time.time()
+        file_info = await file_service.save_uploaded_image(file)
+        
+        try:
+            story_data = await run_in_threadpool(
+                kosmos_service.generate_story,
+                image_path=file_info["path"],
+                story_type=story_type,
+                phash=file_info.get("phash"),
+                reuse_caption=reuse_caption,
+                deadline_ms=deadline_ms
+            )
+            story = await run_in_threadpool(_save_story, file_info, story_data)
+        except Exception as e:
+            file_service.delete_file(file_info["path"], upload_id=file_info["upload_id"])
+            logger.error(f"Error generating story: {e}")
+            raise HTTPException(status_code=500, detail="Failed to generate story from image")
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in narrate endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    
+    sentences = split_sentences(story["content"])
+    
+    async def synthesize_sentences(queue: asyncio.Queue):
+        """Synthesize sentences in order, staying at most a couple of chunks ahead of the client."""
+        try:
+            for index, sentence in enumerate(sentences):
+                with trace_span("narrate.sentence", index=index, chars=len(sentence)):
+                    wav, sample_rate = await run_in_threadpool(tts_service.synthesize, sentence, voice)
+                    audio_bytes, encoded_rate = await run_in_threadpool(
+                        tts_service.encode_audio, wav, sample_rate, audio_format
+                    )
+                await queue.put((index, sentence, wav, sample_rate, audio_bytes, encoded_rate))
+        except Exception as e:
+            logger.error(f"Error synthesizing narration: {e}")
+            await queue.put(e)
+            return
+        await queue.put(None)
+    
+    async def event_stream():
+        yield format_sse(story, event="story")
+        
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+        producer = asyncio.create_task(synthesize_sentences(queue))
+        pcm_chunks = []
+        sample_rate = None
+        
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    yield format_sse({"message": "Failed to generate audio", "request_id": get_request_id()}, event="error")
+                    return
+                
+                index, sentence, wav, sample_rate, audio_bytes, encoded_rate = item
+                pcm_chunks.append(wav)
+                if index == 0:
+                    story["time_to_first_audio"] = time.time() - start_time
+                    current_span().set_attribute("time_to_first_audio_ms", story["time_to_first_audio"] * 1000)
+                
+                yield format_sse({
+                    "index": index,
+                    "total": len(sentences),
+                    "text": sentence,
+                    "format": audio_format,
+                    "media_type": file_service.get_audio_media_type(f"chunk.{audio_format}"),
+                    "sample_rate": encoded_rate,
+                    "duration": len(wav) / sample_rate,
+                    "audio": base64.b64encode(audio_bytes).decode("ascii")
+                }, event="audio")
+            
+            # Store the full narration so it can be replayed through /api/audio/{filename}
+            audio_filename = None
+            duration = 0
+            if pcm_chunks:
+                import numpy as np
+                
+                with trace_span("narrate.store"):
+                    full_wav = np.concatenate(pcm_chunks)
+                    audio_bytes, _ = await run_in_threadpool(
+                        tts_service.encode_audio, full_wav, sample_rate, audio_format
+                    )
+                    audio_filename = await run_in_threadpool(file_service.save_audio, audio_bytes, audio_format)
+                    duration = len(full_wav) / sample_rate
+            
+            yield format_sse({
+                "audio_filename": audio_filename,
+                "duration": duration,
+                "time_to_first_audio": story.get("time_to_first_audio"),
+                "total_time": time.time() - start_time
+            }, event="done")
+        finally:
+            producer.cancel()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 @router.get("/upload/status")
 async def get_upload_status():
     """Get the status of AI models and upload service."""
     return {
         "kosmos_model_loaded": kosmos_service.is_model_loaded(),
+        "captioning": kosmos_service.get_caption_metrics(),
+        "embedding_cache": embedding_cache.get_stats(),
+        "caption_index": caption_index.get_stats(),
+        "idempotency_cache": idempotency_cache.get_stats(),
         "max_file_size": file_service.max_file_size,
         "allowed_extensions": file_service.allowed_extensions,
         "upload_dir": file_service.upload_dir
@@ -0,0 +1,41 @@
+from fastapi import HTTPException, Response
+from app.services.idempotency_service import idempotency_cache, IdempotencyConflict, MAX_KEY_LENGTH
+from app.core.tracing import current_span
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+async def run_idempotent(
+    idempotency_key: Optional[str],
+    scope: str,
+    fingerprint: str,
+    compute: Callable[[], Awaitable[Any]]
+) -> Tuple[Any, bool]:
+    """
+    Run an endpoint's work once per Idempotency-Key.
+
+    Without a key the work simply runs. With one, duplicates of an in-flight
+    request wait for it and later retries get the stored result.
+
+    Returns:
+        (result, replayed)
+    """
+    if not idempotency_key:
+        return await compute(), False
+    if len(idempotency_key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+
+    try:
+        result, replayed = await idempotency_cache.run(f"{scope}:{idempotency_key}", fingerprint, compute)
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+
+    current_span().set_attribute("idempotent_replay", replayed)
+    return result, replayed
+
+
+def mark_replayed(response: Response, replayed: bool):
+    """Flag responses served from the idempotency cache."""
+    if replayed:
+        response.headers[REPLAYED_HEADER] = "true"
@@ -0,0 +1,41 @@
+import json
+import contextvars
+from typing import Any, AsyncIterator, Iterator, Optional, TypeVar
+from fastapi.concurrency import run_in_threadpool
+
+T = TypeVar("T")
+
+_EXHAUSTED = object()
+
+
+def format_sse(data: Any, event: Optional[str] = None) -> str:
+    """Format a payload as a Server-Sent Events message."""
+    message = f"event: {event}\n" if event else ""
+    return f"{message}data: {json.dumps(data)}\n\n"
+
+
+async def iterate_in_context(iterator: Iterator[T]) -> AsyncIterator[T]:
+    """
+    Drive a blocking iterator from a threadpool, one item at a time.
+
+    Unlike iterate_in_threadpool, every step runs in the same copied context,
+    so spans opened inside the generator can be closed across yields.
+    """
+    context = contextvars.copy_context()
+    try:
+        while True:
+            item = await run_in_threadpool(context.run, next, iterator, _EXHAUSTED)
+            if item is _EXHAUSTED:
+                break
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await run_in_threadpool(context.run, close)
+
+
+# Headers that keep proxies from buffering event streams
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
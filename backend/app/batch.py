@@ -0,0 +1,439 @@
+"""
+Offline bulk story generation.
+
+Walks a directory of images (or reads a manifest), stores each image through
+the same FileService as uploads, and captions them in batches with
+KosmosService while a thread pool reads and decodes the next batch. Stories
+are indexed for search like uploaded ones and can optionally be narrated with
+TTSService. Results are appended to a JSONL file, one object per image.
+
+A checkpoint file next to the results records which images are done and how
+far the results file is known to be complete, so an interrupted run continues
+where it stopped when started again with the same arguments. Uploads are
+given ids derived from the results file and the image id, so images that
+are processed again after an interruption replace their earlier upload and
+story instead of adding duplicates. Images that failed are skipped on
+resume unless --retry-failed is given; their retried results are appended,
+so the last line for an id is the current one.
+
+Manifests list one image per line, either as a path or as a JSON object with
+a ``path`` and an optional ``id``; relative paths are resolved against the
+manifest's directory.
+
+Usage (from the backend directory):
+    python -m app.batch photos/ --output stories.jsonl
+    python -m app.batch manifest.jsonl --output stories.jsonl --batch-size 16 --narrate --voice narrator
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, Any, List, Set, NamedTuple
+from app.core.config import settings
+from app.core.cpu_topology import cpu_topology
+from app.core.tracing import RequestIdFilter
+from app.services.file_service import file_service
+from app.services.kosmos_service import kosmos_service
+from app.services.tts_service import tts_service
+from app.services.story_store import story_store
+
+logger = logging.getLogger("app.batch")
+
+# Batches captioned ahead of the one being narrated and written
+MAX_PENDING_WRITES = 2
+
+
+class BatchItem(NamedTuple):
+    """One image to process; id is what the checkpoint and results refer to it by."""
+    id: str
+    path: str
+
+
+class LoadedImage(NamedTuple):
+    item: BatchItem
+    file_info: Optional[Dict[str, Any]]
+    image: Any
+    image_hash: Optional[str]
+    error: Optional[str]
+
+
+def walk_directory(root: str) -> List[BatchItem]:
+    """Images under a directory with an allowed extension, in a stable order."""
+    items = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.rsplit(".", 1)[-1].lower() in settings.allowed_extensions:
+                path = os.path.join(dirpath, filename)
+                items.append(BatchItem(os.path.relpath(path, root), path))
+    return items
+
+
+def read_manifest(manifest_path: str) -> List[BatchItem]:
+    """Images listed in a manifest of paths or JSON objects, one per line."""
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    items = []
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                if "path" not in entry:
+                    raise ValueError(f"{manifest_path}:{line_number}: manifest entry has no 'path'")
+                path, item_id = entry["path"], entry.get("id")
+            else:
+                path, item_id = line, None
+            items.append(BatchItem(str(item_id or path), os.path.join(base_dir, path)))
+    return items
+
+
+class Checkpoint:
+    """
+    Append-only record of processed images.
+
+    Each line is written after a batch's results are flushed and holds the
+    ids that succeeded, the ids that failed and the results file size at that
+    point. On resume, results past the last recorded size (a batch that was
+    being written when the run stopped) are truncated and those images are
+    processed again. Failed images are only retried when asked to, since a
+    broken file fails the same way every time.
+    """
+
+    def __init__(self, path: str, output_path: str):
+        self.path = path
+        self.output_path = output_path
+        self.completed: Set[str] = set()
+        self.failed: Set[str] = set()
+        self.output_offset = 0
+
+    def load(self) -> bool:
+        """Read an existing checkpoint. Returns whether there was one."""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+
+        valid_end = 0
+        for line in data.splitlines(keepends=True):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Only the last line can be partial; everything before it is intact
+                break
+            if not line.endswith(b"\n"):
+                break
+            self._apply(record["ids"], record.get("failed", []))
+            self.output_offset = record["output_offset"]
+            valid_end += len(line)
+
+        if valid_end < len(data):
+            # Drop the torn record, or the next one would be appended to it and lost as well
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_end)
+        return True
+
+    def truncate_output(self):
+        """Drop results written after the last checkpointed batch."""
+        if os.path.exists(self.output_path) and os.path.getsize(self.output_path) > self.output_offset:
+            with open(self.output_path, "r+b") as f:
+                f.truncate(self.output_offset)
+
+    def record(self, ids: List[str], failed: List[str], output_offset: int):
+        """Durably record a written batch: ids that succeeded and ids that failed."""
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ids": ids, "failed": failed, "output_offset": output_offset}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._apply(ids, failed)
+        self.output_offset = output_offset
+
+    def _apply(self, ids: List[str], failed: List[str]):
+        # A retried image that succeeds is no longer failed, and vice versa
+        self.completed.update(ids)
+        self.failed.difference_update(ids)
+        self.failed.update(failed)
+        self.completed.difference_update(failed)
+
+
+class Progress:
+    """Periodic throughput and ETA reports on stderr."""
+
+    def __init__(self, total: int, interval: float):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+        self._last_report = self.start
+        self._last_done = 0
+
+    def update(self, done: int, errors: int):
+        self.done += done
+        self.errors += errors
+        now = time.perf_counter()
+        if now - self._last_report >= self.interval:
+            self.report(now)
+
+    def report(self, now: Optional[float] = None, final: bool = False):
+        now = now or time.perf_counter()
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        recent = (self.done - self._last_done) / (now - self._last_report) if now > self._last_report else 0.0
+        message = f"{self.done}/{self.total} images, {rate:.2f} images/s"
+        if final:
+            message += f" in {_format_duration(elapsed)}"
+        else:
+            message += f" (last {now - self._last_report:.0f}s: {recent:.2f}/s)"
+            if rate > 0:
+                message += f", ETA {_format_duration((self.total - self.done) / rate)}"
+        if self.errors:
+            message += f", {self.errors} failed"
+        print(message, file=sys.stderr, flush=True)
+        self._last_report = now
+        self._last_done = self.done
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def _error_message(e: Exception) -> str:
+    # FileService raises HTTPExceptions, whose message is in detail
+    return str(getattr(e, "detail", None) or e)
+
+
+def batch_upload_id(output_path: str, item_id: str) -> str:
+    """
+    Upload id for an image of a run, the same every time the run is retried.
+
+    Stories are keyed by upload, so a retried image replaces its upload and
+    story rather than adding new ones.
+    """
+    return uuid.uuid5(uuid.NAMESPACE_URL, f"{os.path.abspath(output_path)}#{item_id}").hex
+
+
+def load_item(item: BatchItem, output_path: str) -> LoadedImage:
+    """Store an image as an upload and decode it. Runs in the prefetch pool."""
+    try:
+        with open(item.path, "rb") as f:
+            data = f.read(file_service.max_file_size + 1)
+        if len(data) > file_service.max_file_size:
+            raise ValueError(f"File size exceeds maximum allowed size of {file_service.max_file_size} bytes")
+        file_info = file_service.save_image_bytes(
+            data, os.path.basename(item.path), upload_id=batch_upload_id(output_path, item.id)
+        )
+        # Decode the stored blob, as the API does, so embedding cache keys are shared with it
+        image, image_hash = kosmos_service.load_image(file_info["path"])
+        return LoadedImage(item, file_info, image, image_hash, None)
+    except Exception as e:
+        return LoadedImage(item, None, None, None, _error_message(e))
+
+
+def prefetch(items: List[BatchItem], output_path: str, batch_size: int, workers: int):
+    """Yield batches of loaded images, loading up to two batches ahead in a thread pool."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch") as executor:
+        pending: "deque[Future]" = deque()
+        remaining = iter(items)
+        for item in remaining:
+            pending.append(executor.submit(load_item, item, output_path))
+            if len(pending) >= batch_size * 2:
+                break
+
+        while pending:
+            batch = []
+            while pending and len(batch) < batch_size:
+                batch.append(pending.popleft().result())
+                next_item = next(remaining, None)
+                if next_item is not None:
+                    pending.append(executor.submit(load_item, next_item, output_path))
+            yield batch
+
+
+def narrate(story: Dict[str, Any], voice: str, audio_format: str) -> Dict[str, Any]:
+    """Synthesize and store narration for a story, as POST /api/audio/generate does."""
+    temp_filename = f"tmp_{uuid.uuid4().hex}.{audio_format}"
+    audio_result = tts_service.generate_audio(
+        text=story["content"],
+        output_path=file_service.get_audio_path(temp_filename),
+        voice=voice,
+        audio_format=audio_format
+    )
+    return {
+        "audio_filename": file_service.finalize_audio(temp_filename),
+        "audio_duration": audio_result.get("duration", 0),
+        "audio_format": audio_format
+    }
+
+
+def build_result(loaded: LoadedImage, story: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"id": loaded.item.id, "source_path": loaded.item.path}
+    if loaded.file_info is not None:
+        result.update({
+            "upload_id": loaded.file_info["upload_id"],
+            "image_filename": loaded.file_info["filename"],
+            "image_path": loaded.file_info["path"],
+            "content_hash": loaded.file_info["content_hash"]
+        })
+    if story is not None:
+        result.update({
+            "title": story["title"],
+            "content": story["content"],
+            "story_type": story["story_type"],
+            "generation_time": story["generation_time"],
+            "model_used": story["model_used"],
+            "caption": story.get("caption"),
+            "caption_source": story.get("caption_source", "model"),
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        })
+    if loaded.error is not None:
+        result["error"] = loaded.error
+    return result
+
+
+def write_batch(results: List[Dict[str, Any]], output, checkpoint: Checkpoint, progress: Progress,
+                args: argparse.Namespace):
+    """Store, narrate (if asked), append and checkpoint a batch of results. Runs on the writer thread."""
+    for result in results:
+        if "content" in result:
+            result["story_id"] = story_store.add(
+                result, upload_id=result["upload_id"], image_filename=result["image_filename"]
+            )
+
+    if args.narrate:
+        for result in results:
+            if "content" not in result:
+                continue
+            try:
+                result.update(narrate(result, args.voice, args.audio_format))
+            except Exception as e:
+                logger.error(f"Narration failed for {result['id']}: {e}")
+                result["audio_error"] = _error_message(e)
+
+    for result in results:
+        output.write((json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8"))
+    output.flush()
+    os.fsync(output.fileno())
+    succeeded = [result["id"] for result in results if "error" not in result and "audio_error" not in result]
+    failed = [result["id"] for result in results if "error" in result or "audio_error" in result]
+    checkpoint.record(succeeded, failed, output.tell())
+    progress.update(len(results), sum(1 for result in results if "error" in result))
+
+
+def run(args: argparse.Namespace) -> int:
+    if os.path.isdir(args.source):
+        items = walk_directory(args.source)
+    else:
+        items = read_manifest(args.source)
+
+    checkpoint = Checkpoint(args.checkpoint or f"{args.output}.checkpoint", args.output)
+    if args.restart:
+        for path in (checkpoint.path, args.output):
+            if os.path.exists(path):
+                os.remove(path)
+    if checkpoint.load():
+        checkpoint.truncate_output()
+    elif os.path.exists(args.output) and os.path.getsize(args.output) > 0:
+        print(f"{args.output} exists but has no checkpoint; use --restart to overwrite it", file=sys.stderr)
+        return 2
+
+    skipped = set(checkpoint.completed)
+    if not args.retry_failed:
+        skipped |= checkpoint.failed
+    todo = [item for item in items if item.id not in skipped]
+    done = sum(1 for item in items if item.id in checkpoint.completed)
+    failed = sum(1 for item in items if item.id in checkpoint.failed)
+    if args.limit is not None:
+        todo = todo[:args.limit]
+    message = f"{len(items)} images, {done} already done, {len(todo)} to process"
+    if failed and not args.retry_failed:
+        message += f" ({failed} failed earlier; pass --retry-failed to process them again)"
+    print(message, file=sys.stderr, flush=True)
+    if not todo:
+        return 0
+
+    # Load models before the clock starts so the throughput reports reflect steady state
+    cpu_topology.apply()
+    kosmos_service.initialize()
+    if args.narrate:
+        tts_service.initialize()
+
+    progress = Progress(len(todo), args.progress_interval)
+    with open(args.output, "ab") as output, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer") as writer:
+        writes: "deque[Future]" = deque()
+        for batch in prefetch(todo, args.output, args.batch_size, args.prefetch_workers):
+            ready = [loaded for loaded in batch if loaded.error is None]
+            stories: Dict[str, Dict[str, Any]] = {}
+            if ready:
+                generated = kosmos_service.generate_stories(
+                    [loaded.image for loaded in ready],
+                    [loaded.image_hash for loaded in ready],
+                    story_type=args.story_type,
+                    phashes=[loaded.file_info.get("phash") for loaded in ready],
+                    reuse_caption=not args.no_reuse_caption
+                )
+                stories = {loaded.item.id: story for loaded, story in zip(ready, generated)}
+
+            results = [build_result(loaded, stories.get(loaded.item.id)) for loaded in batch]
+            writes.append(writer.submit(write_batch, results, output, checkpoint, progress, args))
+            while len(writes) > MAX_PENDING_WRITES:
+                writes.popleft().result()
+
+        while writes:
+            writes.popleft().result()
+
+    progress.report(final=True)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Generate stories for a directory or manifest of images")
+    parser.add_argument("source", help="Directory of images, or a manifest file with one image per line")
+    parser.add_argument("--output", "-o", required=True, help="JSONL file the results are appended to")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: OUTPUT.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="Discard existing results and checkpoint")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Process images that failed in an earlier run again")
+    parser.add_argument("--story-type", choices=["story", "poem"], default="story")
+    parser.add_argument("--batch-size", type=int, default=8, help="Images captioned per model call")
+    parser.add_argument("--prefetch-workers", type=int, default=4, help="Threads reading and decoding images")
+    parser.add_argument("--no-reuse-caption", action="store_true",
+                        help="Caption every image instead of reusing captions of near-duplicates")
+    parser.add_argument("--narrate", action="store_true", help="Also synthesize narration for each story")
+    parser.add_argument("--voice", default="default", help="Voice for narration")
+    parser.add_argument("--audio-format", help=f"Narration format (default: {settings.audio_format})")
+    parser.add_argument("--limit", type=int, help="Process at most this many images in this run")
+    parser.add_argument("--progress-interval", type=float, default=10.0, help="Seconds between progress reports")
+    args = parser.parse_args()
+
+    if args.batch_size < 1 or args.prefetch_workers < 1:
+        parser.error("--batch-size and --prefetch-workers must be at least 1")
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
+    )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+
+    if args.narrate:
+        try:
+            args.audio_format = tts_service.resolve_format(args.audio_format)
+        except ValueError as e:
+            parser.error(str(e))
+
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
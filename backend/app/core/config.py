@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Optional, Dict
 import os
 
 
@@ -10,9 +10,23 @@ class Settings(BaseSettings):
     
     # File Storage
     upload_dir: str = "./uploads"
+    data_dir: str = "./data"  # private state (caches, indexes); never served statically
     max_file_size: int = 10485760  # 10MB
     allowed_extensions: List[str] = ["jpg", "jpeg", "png", "webp"]
     
+    # Storage Backend
+    storage_backend: str = "local"  # local, s3
+    s3_bucket: str = ""
+    s3_prefix: str = ""
+    s3_endpoint_url: Optional[str] = None  # set for MinIO / other S3-compatible stores
+    s3_region: Optional[str] = None
+    s3_access_key_id: Optional[str] = None
+    s3_secret_access_key: Optional[str] = None
+    s3_max_pool_connections: int = 32
+    s3_multipart_threshold: int = 8388608  # 8MB
+    s3_multipart_chunksize: int = 8388608  # 8MB
+    s3_presign_expiry: int = 3600  # seconds
+    
     # CORS
     cors_origins: List[str] = [
         "http://localhost:3000",
@@ -24,12 +38,57 @@ class Settings(BaseSettings):
     host: str = "0.0.0.0"
     port: int = 8000
     debug: bool = True
+    edge_mode: bool = False  # serve files and stats only; never load ML libraries
+    preload_models: bool = True  # load models at startup instead of on first request
+    
+    # Idempotency
+    idempotency_ttl_seconds: int = 86400  # how long responses are replayed for an Idempotency-Key
+    idempotency_max_entries: int = 1000  # stored responses kept in memory (LRU)
+    
+    # CPU threading
+    cpu_topology_enabled: bool = True
+    cpu_workers: int = 1  # model-serving processes sharing this machine's cores (e.g. uvicorn workers)
+    cpu_worker_index: Optional[int] = None  # this process's share; claimed automatically when unset
+    torch_intra_op_threads: Optional[int] = None  # defaults to the number of cores in this worker's share
+    torch_inter_op_threads: Optional[int] = None  # defaults to 1
+    cpu_affinity: bool = False  # pin each worker to its share of cores (Linux)
     
     # AI Settings
-    device: str = "auto"  # auto, cpu, cuda
+    device: str = "auto"  # auto, cpu, cuda, cuda:N, mps
+    device_policies: Dict[str, str] = {}  # per-model override, e.g. {"xtts": "cpu", "blip": "cuda:1"}
+    model_memory_mb: Dict[str, int] = {"blip": 1000, "kosmos": 3500, "xtts": 2500}
+    request_memory_mb: Dict[str, int] = {"blip": 300, "kosmos": 800, "xtts": 600}
+    device_headroom_mb: int = 512  # keep this much accelerator memory free
+    device_memory_budget_mb: Optional[int] = None  # cap usable accelerator memory per device
     max_story_length: int = 500
+    caption_index_enabled: bool = True  # reuse captions of perceptually near-duplicate photos
+    caption_index_max_distance: int = 4  # max Hamming distance (of 64 bits) between dHashes
+    caption_deadline_ms: Optional[int] = None  # captioning latency budget; unset waits for the best tier
+    caption_hedge_delay_ms: int = 1500  # start the next cheaper tier if no answer after this long
+    caption_hedge_workers: int = 4
+    embedding_cache_enabled: bool = True  # reuse vision-encoder outputs for images captioned before
+    embedding_cache_memory_mb: int = 256
+    embedding_cache_disk_mb: int = 1024  # memory-mapped .npy files under <data_dir>/embeddings; 0 disables
     audio_sample_rate: int = 22050
-    audio_format: str = "wav"
+    audio_format: str = "wav"  # default output format
+    audio_formats: List[str] = ["wav", "flac", "ogg", "opus", "mp3"]  # formats clients may request
+    tts_language: str = "en"
+    tts_fragment_cache_enabled: bool = True  # reuse audio of fixed template text, synthesize only the description
+    tts_fragment_cache_mb: int = 128
+    tts_fragment_prewarm_voices: List[str] = []  # voices whose template audio is synthesized at startup
+    # Voice names mapped to XTTS-v2 built-in speakers; registered voices are added at runtime
+    tts_builtin_voices: Dict[str, str] = {
+        "default": "Claribel Dervla",
+        "female": "Ana Florence",
+        "male": "Damien Black"
+    }
+    
+    # Tracing
+    tracing_enabled: bool = True
+    trace_file: Optional[str] = None  # defaults to <data_dir>/traces.jsonl
+    trace_sample_rate: float = 0.01  # fraction of requests traced regardless of latency
+    trace_slow_threshold_ms: float = 2000  # requests slower than this are always traced
+    trace_service_name: str = "storylens-api"
     
     class Config:
         env_file = ".env"
@@ -37,7 +96,7 @@ class Settings(BaseSettings):
         
         @classmethod
         def parse_env_var(cls, field_name: str, raw_val: str) -> any:
-            if field_name in ['cors_origins', 'allowed_extensions']:
+            if field_name in ['cors_origins', 'allowed_extensions', 'audio_formats', 'tts_fragment_prewarm_voices']:
                 return [x.strip() for x in raw_val.split(',')]
             return cls.json_loads(raw_val)
 
@@ -45,5 +104,6 @@ class Settings(BaseSettings):
 # Create settings instance
 settings = Settings()
 
-# Ensure upload directory exists
-os.makedirs(settings.upload_dir, exist_ok=True) 
\ No newline at end of file
+# Ensure upload and data directories exist
+os.makedirs(settings.upload_dir, exist_ok=True)
+os.makedirs(settings.data_dir, exist_ok=True) 
\ No newline at end of file
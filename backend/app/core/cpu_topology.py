@@ -0,0 +1,177 @@
+import os
+import sys
+import logging
+import threading
+from typing import Optional, Dict, Any, List
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Read by OpenMP/MKL when torch is first imported, so they must be set before that
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+
+def available_cores() -> List[int]:
+    """Cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_worker_cores(cores: List[int], workers: int, index: int) -> List[int]:
+    """
+    Split cores into contiguous, near-equal shares and return one worker's share.
+
+    With more workers than cores, workers share cores round-robin.
+    """
+    workers = max(1, workers)
+    index %= workers
+    if workers >= len(cores):
+        return [cores[index % len(cores)]]
+    base, extra = divmod(len(cores), workers)
+    start = index * base + min(index, extra)
+    return cores[start:start + base + (1 if index < extra else 0)]
+
+
+class CpuTopology:
+    """
+    Divides the machine's cores between model-serving processes.
+
+    Each process claims a worker slot (settings.cpu_worker_index, or the first
+    free slot lock under data_dir when several uvicorn workers start without
+    one), takes that slot's share of the cores, sizes PyTorch's intra-op and
+    inter-op thread pools to it and optionally pins itself to those cores.
+    This keeps N workers from each spawning a thread per core.
+    """
+
+    def __init__(self):
+        self.worker_index: Optional[int] = None
+        self.cores: List[int] = []
+        self.intra_op_threads = 0
+        self.inter_op_threads = 0
+        self.pinned = False
+        self._applied = False
+        self._torch_configured = False
+        self._slot_lock = None
+        self._lock = threading.Lock()
+
+    def _claim_slot(self) -> int:
+        """Hold an exclusive lock on the first free worker slot for the life of the process."""
+        if settings.cpu_worker_index is not None:
+            return settings.cpu_worker_index
+        try:
+            import fcntl
+        except ImportError:
+            return 0
+
+        slots_dir = os.path.join(settings.data_dir, "cpu_slots")
+        os.makedirs(slots_dir, exist_ok=True)
+        for index in range(settings.cpu_workers):
+            handle = open(os.path.join(slots_dir, f"worker_{index}.lock"), "w")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                continue
+            self._slot_lock = handle
+            return index
+
+        logger.warning(f"All {settings.cpu_workers} CPU worker slots are taken; sharing slot 0")
+        return 0
+
+    def apply(self):
+        """Claim a worker slot and configure threading for it. Safe to call more than once."""
+        with self._lock:
+            if self._applied or not settings.cpu_topology_enabled:
+                return
+            self._applied = True
+
+            self.worker_index = self._claim_slot()
+            self.cores = plan_worker_cores(available_cores(), settings.cpu_workers, self.worker_index)
+            self.intra_op_threads = settings.torch_intra_op_threads or len(self.cores)
+            self.inter_op_threads = settings.torch_inter_op_threads or 1
+
+            for name in THREAD_ENV_VARS:
+                os.environ[name] = str(self.intra_op_threads)
+
+            if settings.cpu_affinity:
+                if hasattr(os, "sched_setaffinity"):
+                    os.sched_setaffinity(0, self.cores)
+                    self.pinned = True
+                else:
+                    logger.warning("CPU affinity is not supported on this platform")
+
+            logger.info(
+                f"CPU worker {self.worker_index}/{settings.cpu_workers}: cores {self.cores}, "
+                f"{self.intra_op_threads} intra-op / {self.inter_op_threads} inter-op threads"
+                f"{', pinned' if self.pinned else ''}"
+            )
+
+        # torch may already be loaded (e.g. by a script importing the services); configure it now if so
+        if "torch" in sys.modules:
+            self.configure_torch()
+
+    def configure_torch(self):
+        """Size PyTorch's thread pools. Called by model services before loading models."""
+        self.apply()
+        with self._lock:
+            if self._torch_configured or not self._applied or not self.intra_op_threads:
+                return
+            try:
+                import torch
+            except ImportError:
+                return
+            self._torch_configured = True
+
+            torch.set_num_threads(self.intra_op_threads)
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError as e:
+                # Only allowed before the first inter-op parallel work in the process
+                logger.warning(f"Could not set inter-op threads: {e}")
+
+    def verify(self) -> Dict[str, Any]:
+        """Compare the planned layout with what the process is actually using."""
+        status: Dict[str, Any] = {
+            "enabled": settings.cpu_topology_enabled,
+            "workers": settings.cpu_workers,
+            "worker_index": self.worker_index,
+            "cores": self.cores,
+            "intra_op_threads": self.intra_op_threads,
+            "inter_op_threads": self.inter_op_threads,
+            "pinned": self.pinned,
+            "issues": []
+        }
+        if not self._applied:
+            return status
+
+        if self.pinned:
+            actual = available_cores()
+            status["actual_affinity"] = actual
+            if actual != self.cores:
+                status["issues"].append(f"affinity is {actual}, expected {self.cores}")
+
+        if "torch" in sys.modules:
+            torch = sys.modules["torch"]
+            status["torch_threads"] = {
+                "intra_op": torch.get_num_threads(),
+                "inter_op": torch.get_num_interop_threads()
+            }
+            if torch.get_num_threads() != self.intra_op_threads:
+                status["issues"].append(
+                    f"torch uses {torch.get_num_threads()} intra-op threads, expected {self.intra_op_threads}"
+                )
+            if torch.get_num_interop_threads() != self.inter_op_threads:
+                status["issues"].append(
+                    f"torch uses {torch.get_num_interop_threads()} inter-op threads, expected {self.inter_op_threads}"
+                )
+
+        if self.intra_op_threads > len(self.cores):
+            status["issues"].append(
+                f"{self.intra_op_threads} intra-op threads for a share of {len(self.cores)} cores"
+            )
+        return status
+
+
+# Global instance
+cpu_topology = CpuTopology()
@@ -0,0 +1,37 @@
+import threading
+import logging
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class LazyService:
+    """
+    Proxy that constructs a service on first use.
+
+    Service modules expose these instead of eagerly built instances so that
+    importing the API does not load models (or their libraries) until a code
+    path actually needs them.
+    """
+
+    def __init__(self, factory: Callable[[], Any], name: str):
+        self._factory = factory
+        self._name = name
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def initialize(self) -> Any:
+        """Construct the service if needed and return it."""
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    logger.info(f"Initializing {self._name} service...")
+                    self._instance = self._factory()
+        return self._instance
+
+    def is_initialized(self) -> bool:
+        """Check whether the service has been constructed, without constructing it."""
+        return self._instance is not None
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self.initialize(), item)
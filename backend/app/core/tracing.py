@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import functools
+import contextvars
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Callable, Iterator
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# OTLP status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    """A timed unit of work within a trace."""
+
+    __slots__ = (
+        "name", "trace_id", "span_id", "parent_id", "local_root_id", "sampled",
+        "start_ns", "end_ns", "attributes", "status", "status_message"
+    )
+
+    def __init__(self, name: str, trace_id: str, parent: Optional["Span"], sampled: bool,
+                 attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        # Spans are buffered per root and exported together once the root finishes
+        self.local_root_id = parent.local_root_id if parent else self.span_id
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.status = STATUS_OK
+        self.status_message = ""
+
+    @property
+    def is_local_root(self) -> bool:
+        return self.local_root_id == self.span_id
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns or time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        self.status = STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {error}"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """Serialize in the OTLP/JSON span shape."""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 2 if self.parent_id is None else 1,  # SERVER for roots, INTERNAL otherwise
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": self.status, "message": self.status_message}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """Span stand-in used when tracing is disabled."""
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def record_error(self, error: BaseException):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class JsonFileExporter:
+    """
+    Appends finished traces to a file as OTLP/JSON lines.
+
+    Each line is a complete ExportTraceServiceRequest, the format read by the
+    OpenTelemetry collector's otlpjsonfile receiver.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, spans: List[Span]):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    _otlp_attribute("service.name", settings.trace_service_name),
+                    _otlp_attribute("process.pid", os.getpid())
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "storylens"},
+                    "spans": [span.to_otlp() for span in spans]
+                }]
+            }]
+        }
+        line = json.dumps(payload, separators=(",", ":")) + "\n"
+        try:
+            with self._lock, open(self.path, "a") as f:
+                f.write(line)
+        except Exception as e:
+            logger.warning(f"Failed to export trace: {e}")
+
+
+class Tracer:
+    """
+    Creates spans and exports them with tail-based sampling.
+
+    Spans are buffered until their process-local root finishes. The trace is
+    then exported if it was head-sampled (settings.trace_sample_rate) or if
+    the root took longer than settings.trace_slow_threshold_ms, so slow
+    requests are always kept while fast ones cost almost nothing.
+    """
+
+    def __init__(self, exporter: JsonFileExporter):
+        self.exporter = exporter
+        self._pending: Dict[str, List[Span]] = defaultdict(list)
+        self._decided: "OrderedDict[str, bool]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Any]:
+        """Open a span as a child of the current one (or a new trace)."""
+        if not settings.tracing_enabled:
+            yield NOOP_SPAN
+            return
+
+        parent = _current_span.get()
+        if parent is None:
+            trace_id = os.urandom(16).hex()
+            sampled = random.random() < settings.trace_sample_rate
+            request_id = _request_id.get()
+            if request_id:
+                attributes.setdefault("request_id", request_id)
+        else:
+            trace_id, sampled = parent.trace_id, parent.sampled
+
+        span = Span(name, trace_id, parent, sampled, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _finish(self, span: Span):
+        with self._lock:
+            if not span.is_local_root:
+                decided = self._decided.get(span.local_root_id)
+                if decided is None:
+                    self._pending[span.local_root_id].append(span)
+                    return
+                # Finished after its root (e.g. a background thread); follow the root's decision
+                spans = [span] if decided else []
+            else:
+                spans = self._pending.pop(span.span_id, [])
+                spans.append(span)
+                keep = span.sampled or span.duration_ms >= settings.trace_slow_threshold_ms
+                self._decided[span.span_id] = keep
+                if len(self._decided) > 4096:
+                    self._decided.popitem(last=False)
+                if not keep:
+                    spans = []
+
+        if spans:
+            self.exporter.export(spans)
+
+
+def _default_trace_file() -> str:
+    return settings.trace_file or os.path.join(settings.data_dir, "traces.jsonl")
+
+
+# Global instance
+tracer = Tracer(JsonFileExporter(_default_trace_file()))
+
+
+def trace_span(name: str, **attributes):
+    """Open a span on the global tracer."""
+    return tracer.span(name, **attributes)
+
+
+def traced(name: str) -> Callable:
+    """Decorator wrapping a function call in a span."""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span() -> Any:
+    """Get the active span, or a no-op span outside of any trace."""
+    return _current_span.get() or NOOP_SPAN
+
+
+def get_request_id() -> Optional[str]:
+    """Get the id of the request being handled, if any."""
+    return _request_id.get()
+
+
+def propagate(fn: Callable) -> Callable:
+    """
+    Bind a callable to the current trace context.
+
+    Use when submitting work to a ThreadPoolExecutor, which (unlike
+    run_in_threadpool) does not copy context variables into its threads.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request id to log records."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get() or "-"
+        return True
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware assigning a request id and a root span to each HTTP request.
+
+    Implemented at the ASGI level so the span also covers streamed response
+    bodies and the context variables reach the endpoint unchanged.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex
+        token = _request_id.set(request_id)
+
+        try:
+            with tracer.span("http.request", method=scope["method"], path=scope["path"]) as span:
+                async def send_with_request_id(message):
+                    if message["type"] == "http.response.start":
+                        span.set_attribute("status_code", message["status"])
+                        message["headers"] = list(message.get("headers", [])) + [
+                            (b"x-request-id", request_id.encode("latin-1"))
+                        ]
+                    await send(message)
+
+                await self.app(scope, receive, send_with_request_id)
+        finally:
+            _request_id.reset(token)
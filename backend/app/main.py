@@ -1,19 +1,24 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.concurrency import run_in_threadpool
 import logging
 import os
 from contextlib import asynccontextmanager
 
 from app.core.config import settings
+from app.core.tracing import TracingMiddleware, RequestIdFilter
+from app.core.cpu_topology import cpu_topology
 from app.api.api import api_router
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 logger = logging.getLogger(__name__)
 
 
@@ -23,8 +28,24 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting StoryLens API...")
     
-    # Initialize AI models (this happens in service constructors)
-    logger.info("AI models initialization started...")
+    # Size thread pools for this worker's share of the cores before any model loads torch
+    cpu_topology.apply()
+    
+    if settings.edge_mode:
+        logger.info("Edge mode: serving files and stats only, AI models will not be loaded")
+    elif settings.preload_models:
+        # Services are constructed lazily; load the models now so the first request doesn't pay for it
+        from app.services.kosmos_service import kosmos_service
+        from app.services.tts_service import tts_service
+        
+        logger.info("AI models initialization started...")
+        await run_in_threadpool(kosmos_service.initialize)
+        await run_in_threadpool(tts_service.initialize)
+        for voice in settings.tts_fragment_prewarm_voices:
+            await run_in_threadpool(tts_service.prewarm_fragments, voice)
+        
+        for issue in cpu_topology.verify()["issues"]:
+            logger.warning(f"CPU topology: {issue}")
     
     yield
     
@@ -49,14 +70,28 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Audio-Filename", "X-Audio-Duration", "X-Model-Used", "Idempotent-Replayed"],
 )
 
+# Request ids and tracing spans
+app.add_middleware(TracingMiddleware)
+
 # Include API routes
 app.include_router(api_router)
 
 # Serve static files (uploaded images and audio)
-if os.path.exists(settings.upload_dir):
-    app.mount("/uploads", StaticFiles(directory=settings.upload_dir), name="uploads")
+if settings.storage_backend == "local":
+    if os.path.exists(settings.upload_dir):
+        app.mount("/uploads", StaticFiles(directory=settings.upload_dir), name="uploads")
+else:
+    @app.get("/uploads/{key:path}")
+    async def get_upload(key: str):
+        """Redirect stored objects to a presigned URL on the remote backend."""
+        from app.services.storage_service import storage_backend
+        
+        if not storage_backend.exists(key):
+            raise HTTPException(status_code=404, detail="File not found")
+        return RedirectResponse(url=storage_backend.presigned_url(key), status_code=307)
 
 
 @app.get("/")
@@ -76,15 +111,23 @@ async def root():
 async def health_check():
     """Health check endpoint."""
     try:
-        # Check if AI services are loaded
+        # Check if AI services are loaded, without triggering a load
         from app.services.kosmos_service import kosmos_service
         from app.services.tts_service import tts_service
+        from app.services.device_service import device_manager
+        
+        kosmos_loaded = kosmos_service.is_initialized() and kosmos_service.is_model_loaded()
+        tts_loaded = tts_service.is_initialized() and tts_service.is_model_loaded()
         
         return {
             "status": "healthy",
-            "kosmos_model_loaded": kosmos_service.is_model_loaded(),
-            "tts_model_loaded": tts_service.is_model_loaded(),
-            "upload_dir_exists": os.path.exists(settings.upload_dir)
+            "mode": "edge" if settings.edge_mode else "full",
+            "kosmos_model_loaded": kosmos_loaded,
+            "tts_model_loaded": tts_loaded,
+            "upload_dir_exists": os.path.exists(settings.upload_dir),
+            "storage_backend": settings.storage_backend,
+            "devices": device_manager.get_status() if kosmos_service.is_initialized() or tts_service.is_initialized() else None,
+            "cpu_topology": cpu_topology.verify()
         }
     except Exception as e:
         logger.error(f"Health check failed: {e}")
@@ -0,0 +1,228 @@
+import threading
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+CPU = "cpu"
+
+
+class DeviceManager:
+    """
+    Shared placement of models onto devices.
+
+    Each model is placed according to its policy in settings.device_policies
+    (falling back to settings.device) and its estimated footprint. Requests
+    reserve working memory on the model's device while they run; when the
+    accelerator has no headroom left the request is sent to CPU instead.
+
+    Accelerator budgets can be passed explicitly (device name -> MB), which
+    makes placement decisions fully simulated and testable without a GPU.
+    """
+
+    def __init__(self, accelerators: Optional[Dict[str, float]] = None):
+        self._simulated = accelerators is not None
+        # Detected lazily so constructing the manager does not import torch
+        self._accelerators: Optional[Dict[str, Optional[float]]] = (
+            dict(accelerators) if accelerators is not None else None
+        )
+        self._placements: Dict[str, Dict[str, Any]] = {}
+        self._reserved: Counter = Counter()
+        self._active_requests: Counter = Counter()
+        self._fallbacks: Counter = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def _budgets(self) -> Dict[str, Optional[float]]:
+        if self._accelerators is None:
+            self._accelerators = self._detect_accelerators()
+        return self._accelerators
+
+    def _detect_accelerators(self) -> Dict[str, Optional[float]]:
+        """Find usable accelerators. A None budget means "ask the driver"."""
+        accelerators: Dict[str, Optional[float]] = {}
+        try:
+            import torch
+        except ImportError:
+            return accelerators
+
+        budget = settings.device_memory_budget_mb
+        if torch.cuda.is_available():
+            for index in range(torch.cuda.device_count()):
+                accelerators[f"cuda:{index}"] = budget
+        if torch.backends.mps.is_available():
+            accelerators["mps"] = budget
+        return accelerators
+
+    def _normalize(self, device: str) -> str:
+        return "cuda:0" if device == "cuda" else device
+
+    def _policy(self, model_name: str) -> str:
+        return settings.device_policies.get(model_name, settings.device)
+
+    def _free_mb(self, device: str) -> float:
+        """Memory still available on a device for new models and requests."""
+        budget = self._budgets.get(device)
+        placed = sum(p["estimated_mb"] for p in self._placements.values() if p["device"] == device)
+
+        if budget is not None:
+            return budget - placed - self._reserved[device]
+
+        import torch
+        if device.startswith("cuda"):
+            free_bytes, _ = torch.cuda.mem_get_info(torch.device(device))
+            return free_bytes / (1024 * 1024) - self._reserved[device]
+        if device == "mps":
+            total = torch.mps.recommended_max_memory()
+            return (total - torch.mps.current_allocated_memory()) / (1024 * 1024) - self._reserved[device]
+        return float("inf")
+
+    def _candidates(self, model_name: str):
+        """Devices to try for a model, in order of preference."""
+        policy = self._normalize(self._policy(model_name))
+        if policy == CPU:
+            return []
+        if policy == "auto":
+            return list(self._budgets)
+        return [policy]
+
+    def place_model(self, model_name: str, estimated_mb: Optional[float] = None) -> str:
+        """
+        Decide which device a model should be loaded on.
+
+        Args:
+            model_name: Model key, e.g. "blip", "kosmos" or "xtts"
+            estimated_mb: Expected resident size; defaults to settings.model_memory_mb
+
+        Returns:
+            Torch device string
+        """
+        if estimated_mb is None:
+            estimated_mb = settings.model_memory_mb.get(model_name, 0)
+
+        with self._lock:
+            self._placements.pop(model_name, None)
+            device = CPU
+            reason = "policy" if self._policy(model_name) == CPU else "no accelerator available"
+
+            for candidate in self._candidates(model_name):
+                if candidate not in self._budgets:
+                    reason = f"{candidate} unavailable"
+                    continue
+                try:
+                    free_mb = self._free_mb(candidate)
+                except Exception as e:
+                    reason = f"{candidate} unavailable: {e}"
+                    continue
+                if free_mb - estimated_mb >= settings.device_headroom_mb:
+                    device, reason = candidate, "fits"
+                    break
+                reason = f"insufficient memory on {candidate} ({free_mb:.0f}MB free)"
+
+            self._placements[model_name] = {
+                "device": device,
+                "estimated_mb": estimated_mb if device != CPU else 0,
+                "reason": reason
+            }
+
+        logger.info(f"Placing {model_name} on {device} ({reason})")
+        return device
+
+    def release_model(self, model_name: str):
+        """Forget a model's placement, e.g. after it failed to load."""
+        with self._lock:
+            self._placements.pop(model_name, None)
+
+    def get_device(self, model_name: str) -> str:
+        """Get the device a model was placed on."""
+        placement = self._placements.get(model_name)
+        return placement["device"] if placement else CPU
+
+    @contextmanager
+    def acquire(self, model_name: str, request_mb: Optional[float] = None) -> Iterator[str]:
+        """
+        Reserve working memory for one inference request.
+
+        Yields the model's device when it has headroom for the request, or
+        "cpu" when the accelerator is saturated.
+        """
+        if request_mb is None:
+            request_mb = settings.request_memory_mb.get(model_name, 0)
+        device = self.get_device(model_name)
+
+        if device != CPU:
+            with self._lock:
+                try:
+                    saturated = self._free_mb(device) - request_mb < settings.device_headroom_mb
+                except Exception:
+                    saturated = True
+                if saturated:
+                    self._fallbacks[model_name] += 1
+                    logger.warning(f"{device} saturated, running {model_name} request on CPU")
+                    device = CPU
+                else:
+                    self._reserved[device] += request_mb
+
+        with self._lock:
+            self._active_requests[device] += 1
+        try:
+            yield device
+        finally:
+            with self._lock:
+                self._active_requests[device] -= 1
+                if device != CPU:
+                    self._reserved[device] -= request_mb
+
+    def record_fallback(self, model_name: str, reason: str):
+        """Count a request that had to be retried on CPU."""
+        with self._lock:
+            self._fallbacks[model_name] += 1
+        logger.warning(f"Falling back to CPU for {model_name}: {reason}")
+
+    def release_cached_memory(self, device: str):
+        """Return cached allocator blocks to the driver after an OOM."""
+        if self._simulated or device == CPU:
+            return
+        try:
+            import torch
+            if device.startswith("cuda"):
+                torch.cuda.empty_cache()
+            elif device == "mps":
+                torch.mps.empty_cache()
+        except Exception as e:
+            logger.warning(f"Failed to release cached memory on {device}: {e}")
+
+    @staticmethod
+    def is_out_of_memory(error: Exception) -> bool:
+        """Check whether an exception is an accelerator out-of-memory error."""
+        return "out of memory" in str(error).lower() or type(error).__name__ == "OutOfMemoryError"
+
+    def get_status(self) -> Dict[str, Any]:
+        """Summarize placement decisions and memory headroom."""
+        devices = {}
+        for device in self._budgets:
+            try:
+                free_mb = round(self._free_mb(device), 1)
+            except Exception:
+                free_mb = None
+            devices[device] = {
+                "budget_mb": self._budgets[device],
+                "free_mb": free_mb,
+                "reserved_mb": self._reserved[device],
+                "active_requests": self._active_requests[device]
+            }
+
+        return {
+            "simulated": self._simulated,
+            "placements": {name: dict(p) for name, p in self._placements.items()},
+            "devices": devices,
+            "cpu_active_requests": self._active_requests[CPU],
+            "cpu_fallbacks": dict(self._fallbacks)
+        }
+
+
+# Global instance
+device_manager = DeviceManager()
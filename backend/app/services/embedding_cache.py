@@ -0,0 +1,210 @@
+import os
+import re
+import threading
+import logging
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Callable, TYPE_CHECKING
+from app.core.config import settings
+
+if TYPE_CHECKING:
+    import torch
+
+logger = logging.getLogger(__name__)
+
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of vision-encoder outputs, keyed by model and image hash.
+
+    Captioning the same pixels again (another decoding profile, a hedged
+    tier, a regenerated story) then only runs the text decoder. Recently used
+    embeddings are kept in memory as CPU tensors in an LRU bounded by bytes;
+    everything is also written to an .npy file per entry that is read back
+    memory-mapped, with the directory bounded by evicting the least recently
+    used files.
+    """
+
+    def __init__(self, root: str, memory_bytes: int, disk_bytes: int):
+        self.root = root
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._memory_used = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()  # path -> size, oldest access first
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+        if self.disk_bytes > 0:
+            os.makedirs(self.root, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".npy"):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    entries.append((stat.st_atime, path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self._disk[path] = size
+            self._disk_used += size
+
+    def _disk_path(self, model: str, image_hash: str) -> str:
+        return os.path.join(self.root, _UNSAFE_CHARS.sub("_", model), f"{image_hash}.npy")
+
+    def get_or_compute(self, model: str, image_hash: Optional[str],
+                       compute: Callable[[], "torch.Tensor"]) -> "torch.Tensor":
+        """
+        Get cached embeddings for an image, computing and storing them on a miss.
+
+        Args:
+            model: Model identifier; embeddings are never shared between models
+            image_hash: Content hash of the image, or None to skip the cache
+            compute: Runs the vision encoder
+
+        Returns:
+            Embeddings as a CPU tensor on a hit, or whatever compute returned on a miss
+        """
+        cached = self.get(model, image_hash)
+        if cached is not None:
+            return cached
+
+        embeddings = compute()
+        self.put(model, image_hash, embeddings)
+        return embeddings
+
+    def _enabled(self, image_hash: Optional[str]) -> bool:
+        return image_hash is not None and (self.memory_bytes > 0 or self.disk_bytes > 0)
+
+    def get(self, model: str, image_hash: Optional[str]) -> Optional["torch.Tensor"]:
+        """Get cached embeddings as a CPU tensor, or None on a miss."""
+        if not self._enabled(image_hash):
+            return None
+        return self._get(f"{model}:{image_hash}", model, image_hash)
+
+    def put(self, model: str, image_hash: Optional[str], embeddings: "torch.Tensor"):
+        """Store embeddings computed by the caller, e.g. one row of a batched encoder call."""
+        if self._enabled(image_hash):
+            self._put(f"{model}:{image_hash}", model, image_hash, embeddings)
+
+    def _get(self, key: str, model: str, image_hash: str) -> Optional["torch.Tensor"]:
+        with self._lock:
+            tensor = self._memory.get(key)
+            if tensor is not None:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return tensor
+
+        if self.disk_bytes <= 0:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        path = self._disk_path(model, image_hash)
+        try:
+            import numpy as np
+            import torch
+
+            # Copy-on-write mapping: torch needs a writable array, and pages are only
+            # read from disk as the decoder touches them. Writes never reach the file.
+            array = np.load(path, mmap_mode="c")
+            tensor = torch.from_numpy(array)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Discarding unreadable cached embeddings {path}: {e}")
+            self._remove_file(path)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits["disk"] += 1
+            if path in self._disk:
+                self._disk.move_to_end(path)
+            self._remember(key, tensor)
+        return tensor
+
+    def _put(self, key: str, model: str, image_hash: str, embeddings: "torch.Tensor"):
+        import torch
+
+        tensor = embeddings.detach().to("cpu")
+        if tensor.dtype not in (torch.float16, torch.float32):
+            tensor = tensor.float()
+        with self._lock:
+            self._remember(key, tensor)
+
+        if self.disk_bytes <= 0:
+            return
+        path = self._disk_path(model, image_hash)
+        try:
+            import numpy as np
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, tensor.numpy())
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except Exception as e:
+            logger.warning(f"Failed to persist embeddings for {key}: {e}")
+            return
+
+        with self._lock:
+            self._disk_used += size - self._disk.pop(path, 0)
+            self._disk[path] = size
+            evicted = []
+            while self._disk_used > self.disk_bytes and len(self._disk) > 1:
+                old_path, old_size = self._disk.popitem(last=False)
+                self._disk_used -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            self._remove_file(old_path)
+
+    def _remember(self, key: str, tensor: "torch.Tensor"):
+        """Add to the memory tier; caller holds the lock."""
+        size = tensor.element_size() * tensor.nelement()
+        if size > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= previous.element_size() * previous.nelement()
+        self._memory[key] = tensor
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_used -= old.element_size() * old.nelement()
+
+    def _remove_file(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to evict cached embeddings {path}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_mb": round(self._memory_used / (1024 * 1024), 1),
+                "disk_entries": len(self._disk),
+                "disk_mb": round(self._disk_used / (1024 * 1024), 1),
+                "hits": dict(self.hits),
+                "misses": self.misses
+            }
+
+
+# Global instance
+embedding_cache = EmbeddingCache(
+    os.path.join(settings.data_dir, "embeddings"),
+    settings.embedding_cache_memory_mb * 1024 * 1024 if settings.embedding_cache_enabled else 0,
+    settings.embedding_cache_disk_mb * 1024 * 1024 if settings.embedding_cache_enabled else 0
+)
@@ -1,14 +1,37 @@
+import io
 import os
+import re
 import uuid
-import shutil
+import hashlib
+import threading
 from typing import Optional, List, Dict, Any
 from fastapi import UploadFile, HTTPException
-from PIL import Image
+from fastapi.concurrency import run_in_threadpool
 import logging
 from app.core.config import settings
+from app.services.storage_service import storage_backend
+from app.services.image_store import image_ref_store
+from app.services.phash_index import compute_dhash, format_hash
+from app.core.tracing import trace_span
 
 logger = logging.getLogger(__name__)
 
+AUDIO_MEDIA_TYPES = {
+    "wav": "audio/wav",
+    "mp3": "audio/mpeg",
+    "ogg": "audio/ogg",
+    "opus": "audio/ogg",
+    "flac": "audio/flac",
+    "m4a": "audio/mp4",
+    "webm": "audio/webm"
+}
+
+# Generated audio is named after the hash of its bytes, so its content never changes
+CONTENT_ADDRESSED_AUDIO = re.compile(r"^audio_[0-9a-f]{32}\.[a-z0-9]+$")
+
+# Image blobs are guarded by one of a fixed set of locks chosen by content hash
+BLOB_LOCK_STRIPES = 64
+
 
 class FileService:
     def __init__(self):
@@ -16,8 +39,12 @@ class FileService:
         self.max_file_size = settings.max_file_size
         self.allowed_extensions = settings.allowed_extensions
         self.audio_format = settings.audio_format
+        self.storage = storage_backend
+        # Serialize creating a blob with unlinking it, so a delete of the last
+        # reference can't remove a blob that an identical upload just reused
+        self._blob_locks = [threading.Lock() for _ in range(BLOB_LOCK_STRIPES)]
         
-        # Create subdirectories
+        # Create subdirectories (local working copies for the models)
         self.images_dir = os.path.join(self.upload_dir, "images")
         self.audio_dir = os.path.join(self.upload_dir, "audio")
         
@@ -27,66 +54,89 @@ class FileService:
     def validate_image_file(self, file: UploadFile) -> bool:
         """Validate uploaded image file."""
         # Check file size
-        if hasattr(file, 'size') and file.size > self.max_file_size:
+        if hasattr(file, 'size') and file.size is not None and file.size > self.max_file_size:
             raise HTTPException(
                 status_code=413,
                 detail=f"File size exceeds maximum allowed size of {self.max_file_size} bytes"
             )
         
-        # Check file extension
-        if file.filename:
-            extension = file.filename.split('.')[-1].lower()
+        self._validate_extension(file.filename)
+        return True
+    
+    def _validate_extension(self, filename: Optional[str]):
+        """Check the file extension against the allowed image types."""
+        if filename:
+            extension = filename.split('.')[-1].lower()
             if extension not in self.allowed_extensions:
                 raise HTTPException(
                     status_code=400,
                     detail=f"File type not allowed. Allowed types: {', '.join(self.allowed_extensions)}"
                 )
-        
-        return True
     
-    async def save_uploaded_image(self, file: UploadFile) -> Dict[str, str]:
+    async def save_uploaded_image(self, file: UploadFile) -> Dict[str, Any]:
         """Save uploaded image file and return file info."""
-        try:
+        with trace_span("file.save_uploaded_image", filename=file.filename or "") as span:
             # Validate file
             self.validate_image_file(file)
             
-            # Generate unique filename
-            file_extension = file.filename.split('.')[-1].lower() if file.filename else 'jpg'
-            unique_filename = f"{uuid.uuid4()}.{file_extension}"
-            file_path = os.path.join(self.images_dir, unique_filename)
+            data = await file.read(self.max_file_size + 1)
+            if len(data) > self.max_file_size:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File size exceeds maximum allowed size of {self.max_file_size} bytes"
+                )
             
-            # Save file
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            file_info = await run_in_threadpool(self.save_image_bytes, data, file.filename)
+            span.set_attribute("size", file_info["size"])
+            span.set_attribute("deduplicated", file_info["deduplicated"])
+            return file_info
+    
+    def save_image_bytes(self, data: bytes, original_filename: Optional[str] = None,
+                         upload_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Save image bytes as a content-addressed, reference-counted blob.
+        
+        Identical bytes are stored once: a repeat upload only costs a hash and
+        a metadata row, and skips decoding and re-encoding entirely.
+        
+        Args:
+            data: Raw image bytes as uploaded
+            original_filename: Client-side filename, used for the extension
+            upload_id: Id to store the upload under (default: a new random id). Saving
+                the same bytes under an existing id returns that upload unchanged;
+                different bytes replace it.
+        
+        Returns:
+            File info including the upload id and whether the blob already existed
+        """
+        try:
+            self._validate_extension(original_filename)
             
-            # Validate and process image
-            try:
-                with Image.open(file_path) as img:
-                    # Convert to RGB if necessary
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                        img.save(file_path, 'JPEG', quality=95)
-                        unique_filename = unique_filename.replace(f'.{file_extension}', '.jpg')
-                        new_path = os.path.join(self.images_dir, unique_filename)
-                        os.rename(file_path, new_path)
-                        file_path = new_path
-                    
-                    # Get image dimensions
-                    width, height = img.size
-                    
-            except Exception as e:
-                # Clean up invalid file
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                raise HTTPException(status_code=400, detail="Invalid image file")
+            with trace_span("file.hash"):
+                content_hash = hashlib.sha256(data).hexdigest()
+            if upload_id is None:
+                upload_id = uuid.uuid4().hex
+            else:
+                existing = image_ref_store.get_upload(upload_id)
+                if existing and existing["hash"] == content_hash and \
+                        self.storage.exists(self.get_image_key(existing["filename"])):
+                    return self._image_info(existing, upload_id, deduplicated=True)
+                if existing:
+                    self.delete_file(os.path.join(self.images_dir, existing["filename"]), upload_id=upload_id)
             
-            return {
-                "filename": unique_filename,
-                "path": file_path,
-                "size": os.path.getsize(file_path),
-                "width": width,
-                "height": height
-            }
+            with self._blob_lock(content_hash):
+                blob = image_ref_store.get_blob(content_hash)
+                if blob and self.storage.exists(self.get_image_key(blob["filename"])):
+                    try:
+                        blob = image_ref_store.add_reference(content_hash, upload_id, original_filename)
+                        return self._image_info(blob, upload_id, deduplicated=True)
+                    except KeyError:
+                        # Last reference was released by another process; store it again below
+                        pass
+                
+                blob = self._write_image_blob(data, content_hash, original_filename)
+                blob = image_ref_store.add_reference(content_hash, upload_id, original_filename, blob=blob)
+                return self._image_info(blob, upload_id, deduplicated=False)
             
         except HTTPException:
             raise
@@ -94,30 +144,210 @@ class FileService:
             logger.error(f"Error saving uploaded file: {e}")
             raise HTTPException(status_code=500, detail="Failed to save uploaded file")
     
+    def _blob_lock(self, content_hash: str) -> threading.Lock:
+        """Lock guarding the image blob with the given content hash."""
+        return self._blob_locks[hash(content_hash) % BLOB_LOCK_STRIPES]
+    
+    def _write_image_blob(self, data: bytes, content_hash: str, original_filename: Optional[str]) -> Dict[str, Any]:
+        """Decode, normalize and store a new image blob."""
+        from PIL import Image
+        
+        file_extension = original_filename.split('.')[-1].lower() if original_filename else 'jpg'
+        
+        # Validate and process image
+        try:
+            with trace_span("file.decode"), Image.open(io.BytesIO(data)) as img:
+                img.load()
+                # Convert to RGB if necessary
+                if img.mode != 'RGB':
+                    buffer = io.BytesIO()
+                    img.convert('RGB').save(buffer, 'JPEG', quality=95)
+                    data = buffer.getvalue()
+                    file_extension = 'jpg'
+                
+                # Get image dimensions
+                width, height = img.size
+            
+            # Perceptual hash for near-duplicate caption reuse
+            with trace_span("file.phash"):
+                phash = format_hash(compute_dhash(img))
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid image file")
+        
+        filename = f"{content_hash}.{file_extension}"
+        file_path = os.path.join(self.images_dir, filename)
+        
+        # Save file
+        with trace_span("file.write"):
+            tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as buffer:
+                buffer.write(data)
+            os.replace(tmp_path, file_path)
+        
+        key = self.get_image_key(filename)
+        with trace_span("storage.put", backend=self.storage.name, key=key):
+            self.storage.put_file(key, file_path)
+        
+        return {"filename": filename, "size": len(data), "width": width, "height": height, "phash": phash}
+    
+    def _image_info(self, blob: Dict[str, Any], upload_id: str, deduplicated: bool) -> Dict[str, Any]:
+        """Build the file info returned for a stored image."""
+        key = self.get_image_key(blob["filename"])
+        return {
+            "filename": blob["filename"],
+            "path": self.get_local_path(key),
+            "key": key,
+            "upload_id": upload_id,
+            "content_hash": blob["hash"],
+            "size": blob["size"],
+            "width": blob["width"],
+            "height": blob["height"],
+            "phash": blob.get("phash"),
+            "deduplicated": deduplicated
+        }
+    
     def get_audio_path(self, filename: str) -> str:
         """Get full path for audio file."""
         return os.path.join(self.audio_dir, filename)
     
-    def delete_file(self, file_path: str) -> bool:
-        """Delete a file safely."""
+    def get_audio_key(self, filename: str) -> str:
+        """Get the storage key for an audio file."""
+        return f"audio/{os.path.basename(filename)}"
+    
+    def get_image_key(self, filename: str) -> str:
+        """Get the storage key for an image file."""
+        return f"images/{os.path.basename(filename)}"
+    
+    def get_key(self, file_path: str) -> str:
+        """Map a local working path under the upload directory to its storage key."""
+        relative = os.path.relpath(os.path.abspath(file_path), os.path.abspath(self.upload_dir))
+        return relative.replace(os.sep, "/")
+    
+    def get_audio_media_type(self, filename: str) -> str:
+        """Get the media type for an audio file from its extension."""
+        extension = filename.rsplit('.', 1)[-1].lower()
+        return AUDIO_MEDIA_TYPES.get(extension, "application/octet-stream")
+    
+    def is_content_addressed(self, filename: str) -> bool:
+        """Check whether an audio filename is derived from its content hash."""
+        return bool(CONTENT_ADDRESSED_AUDIO.match(filename))
+    
+    def finalize_audio(self, filename: str) -> str:
+        """
+        Rename a freshly generated audio file after its content hash and store it.
+        
+        Args:
+            filename: Temporary filename the audio was written to
+        
+        Returns:
+            The content-addressed filename
+        """
+        with trace_span("file.finalize_audio"):
+            return self._finalize_audio(filename)
+    
+    def _finalize_audio(self, filename: str) -> str:
+        temp_path = self.get_audio_path(filename)
+        digest = hashlib.sha256()
+        with open(temp_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        
+        extension = filename.rsplit('.', 1)[-1].lower()
+        final_filename = f"audio_{digest.hexdigest()[:32]}.{extension}"
+        os.replace(temp_path, self.get_audio_path(final_filename))
+        self.store_audio(final_filename)
+        return final_filename
+    
+    def save_audio(self, data: bytes, audio_format: str) -> str:
+        """
+        Save encoded audio bytes under a content-addressed filename.
+        
+        Args:
+            data: Encoded audio
+            audio_format: File extension of the encoding
+        
+        Returns:
+            The content-addressed filename
+        """
+        temp_filename = f"tmp_{uuid.uuid4().hex}.{audio_format}"
+        with open(self.get_audio_path(temp_filename), "wb") as f:
+            f.write(data)
+        return self.finalize_audio(temp_filename)
+    
+    def store_audio(self, filename: str) -> str:
+        """Push a generated audio file from the working directory to storage."""
+        key = self.get_audio_key(filename)
+        with trace_span("storage.put", backend=self.storage.name, key=key):
+            self.storage.put_file(key, self.get_audio_path(filename))
+        return key
+    
+    def get_local_path(self, key: str) -> str:
+        """
+        Get a local filesystem path for a stored object.
+        
+        Remote objects are downloaded into the working directory on first use,
+        so a node that did not receive the upload can still hand a path to the models.
+        """
+        local_path = self.storage.local_path(key)
+        if local_path:
+            return local_path
+        
+        local_path = os.path.join(self.upload_dir, *key.split("/"))
+        if not os.path.exists(local_path):
+            self.storage.download_to(key, local_path)
+        return local_path
+    
+    def get_download_url(self, key: str) -> Optional[str]:
+        """Get a presigned URL for direct downloads, if the backend supports it."""
+        return self.storage.presigned_url(key)
+    
+    def delete_file(self, file_path: str, upload_id: Optional[str] = None) -> bool:
+        """
+        Delete a file safely from storage and the local working directory.
+        
+        Images are shared between uploads of identical bytes, so deleting one
+        only drops a reference (the given upload's, or the newest one); the
+        blob itself is unlinked when its last reference goes away, under the
+        same lock that uploads of those bytes take.
+        """
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                return True
-            return False
+            key = self.get_key(file_path)
+            if key.startswith("images/"):
+                filename = os.path.basename(file_path)
+                content_hash = filename.split(".", 1)[0]
+                with self._blob_lock(content_hash):
+                    released = image_ref_store.release(upload_id=upload_id, filename=filename)
+                    if released is None and image_ref_store.get_blob_by_filename(filename):
+                        # Unknown upload id for a blob that is still referenced elsewhere
+                        return False
+                    if released is not None and released[1] > 0:
+                        return True
+                    if image_ref_store.get_blob(content_hash):
+                        # Stored again by another worker process since the release
+                        return True
+                    return self._delete_object(key, file_path)
+            
+            return self._delete_object(key, file_path)
         except Exception as e:
             logger.error(f"Error deleting file {file_path}: {e}")
             return False
     
+    def _delete_object(self, key: str, file_path: str) -> bool:
+        """Remove an object from storage and its local working copy."""
+        deleted = self.storage.delete(key)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            deleted = True
+        return deleted
+    
     def get_file_info(self, file_path: str) -> Optional[Dict[str, Any]]:
         """Get information about a file."""
         try:
-            if os.path.exists(file_path):
-                stat = os.stat(file_path)
+            stat = self.storage.stat(self.get_key(file_path))
+            if stat:
                 return {
-                    "size": stat.st_size,
-                    "created": stat.st_ctime,
-                    "modified": stat.st_mtime,
+                    "size": stat["size"],
+                    "modified": stat["modified"],
                     "exists": True
                 }
         except Exception as e:
@@ -125,26 +355,26 @@ class FileService:
         
         return {"exists": False}
     
+    def list_files(self, prefix: str, extensions: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """List stored objects under a prefix, optionally filtered by extension."""
+        objects = self.storage.list(prefix)
+        if extensions:
+            suffixes = tuple(f".{ext.lower()}" for ext in extensions)
+            objects = [obj for obj in objects if obj["key"].lower().endswith(suffixes)]
+        return objects
+    
     def get_storage_stats(self) -> Dict[str, Any]:
         """Get storage usage statistics."""
         try:
-            total_size = 0
-            file_count = 0
-            
-            for root, dirs, files in os.walk(self.upload_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    try:
-                        total_size += os.path.getsize(file_path)
-                        file_count += 1
-                    except:
-                        continue
+            objects = self.storage.list()
+            total_size = sum(obj["size"] for obj in objects)
             
             return {
                 "total_size_bytes": total_size,
                 "total_size_mb": round(total_size / (1024 * 1024), 2),
-                "file_count": file_count,
-                "upload_dir": self.upload_dir
+                "file_count": len(objects),
+                "upload_dir": self.upload_dir,
+                "storage_backend": self.storage.name
             }
         except Exception as e:
             logger.error(f"Error getting storage stats: {e}")
@@ -0,0 +1,124 @@
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(Exception):
+    """An idempotency key was reused with a different request."""
+
+
+class IdempotencyCache:
+    """
+    Stores the result of requests carrying an Idempotency-Key header.
+
+    The first request with a key runs the computation; concurrent duplicates
+    await the same in-flight task, and later retries get the stored result
+    until it expires. Completed entries are bounded by an LRU. Failures are
+    not stored, so a retry after an error runs again.
+
+    Entries live in process memory, so with several workers a retry is only
+    deduplicated when it reaches the same worker.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._completed: "OrderedDict[str, Tuple[float, str, Any]]" = OrderedDict()
+        self._in_flight: Dict[str, Tuple[str, asyncio.Task]] = {}
+        self.hits = 0
+        self.joins = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(*parts: Any) -> str:
+        """Hash the parts of a request that must match for a key to be replayed."""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(repr(part).encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _get_completed(self, key: str) -> Optional[Tuple[str, Any]]:
+        entry = self._completed.get(key)
+        if entry is None:
+            return None
+        expires_at, fingerprint, value = entry
+        if expires_at < time.monotonic():
+            del self._completed[key]
+            return None
+        self._completed.move_to_end(key)
+        return fingerprint, value
+
+    def _store(self, key: str, fingerprint: str, value: Any):
+        self._completed[key] = (time.monotonic() + self.ttl_seconds, fingerprint, value)
+        self._completed.move_to_end(key)
+        while len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+
+    async def run(self, key: str, fingerprint: str,
+                  compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Run a computation at most once per key.
+
+        Args:
+            key: Idempotency key, scoped by the caller (e.g. prefixed with the route)
+            fingerprint: Request fingerprint; reusing a key for another request is an error
+            compute: Coroutine factory producing the result to store
+
+        Returns:
+            (result, replayed) where replayed is True when the result was not computed by this call
+
+        Raises:
+            IdempotencyConflict: The key was already used with a different fingerprint
+        """
+        completed = self._get_completed(key)
+        if completed is not None:
+            stored_fingerprint, value = completed
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyConflict(key)
+            self.hits += 1
+            return value, True
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            stored_fingerprint, task = in_flight
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyConflict(key)
+            self.joins += 1
+            # Shielded so a disconnecting duplicate doesn't cancel the shared computation
+            return await asyncio.shield(task), True
+
+        self.misses += 1
+        task = asyncio.ensure_future(compute())
+        self._in_flight[key] = (fingerprint, task)
+
+        def on_done(done: asyncio.Task):
+            self._in_flight.pop(key, None)
+            if not done.cancelled() and done.exception() is None:
+                self._store(key, fingerprint, done.result())
+
+        task.add_done_callback(on_done)
+        return await asyncio.shield(task), False
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._completed),
+            "in_flight": len(self._in_flight),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "joins": self.joins,
+            "misses": self.misses
+        }
+
+
+# Global instance
+idempotency_cache = IdempotencyCache(settings.idempotency_ttl_seconds, settings.idempotency_max_entries)
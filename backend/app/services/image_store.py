@@ -0,0 +1,170 @@
+import os
+import time
+import sqlite3
+import threading
+import logging
+from typing import Optional, Dict, Any, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ImageRefStore:
+    """
+    Reference-counted mapping from upload ids to content-addressed image blobs.
+
+    Each distinct image (by SHA-256 of the uploaded bytes) is stored once as a
+    blob; every upload of those bytes adds a row pointing at it. A blob may be
+    removed from storage only when its last reference is released.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                phash TEXT,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS uploads (
+                upload_id TEXT PRIMARY KEY,
+                hash TEXT NOT NULL REFERENCES blobs(hash),
+                original_filename TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS uploads_hash ON uploads(hash);
+            CREATE UNIQUE INDEX IF NOT EXISTS blobs_filename ON blobs(filename);
+            """
+        )
+
+    def get_blob(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """Look up a blob by content hash."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+        return dict(row) if row else None
+
+    def get_blob_by_filename(self, filename: str) -> Optional[Dict[str, Any]]:
+        """Look up a blob by its stored filename."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM blobs WHERE filename = ?", (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def get_upload(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        """Look up an upload and the blob it references."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT u.upload_id, u.original_filename, u.created_at AS uploaded_at, b.* "
+                "FROM uploads u JOIN blobs b ON b.hash = u.hash WHERE u.upload_id = ?",
+                (upload_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def add_reference(self, content_hash: str, upload_id: str, original_filename: Optional[str],
+                      blob: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Record an upload of a blob, creating the blob row if it is new.
+
+        Args:
+            content_hash: SHA-256 of the uploaded bytes
+            upload_id: Id of this upload
+            original_filename: Client-side filename, for reference
+            blob: Blob metadata (filename, size, width, height, phash) when the blob was just written
+
+        Returns:
+            The blob row after the reference was added
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if blob is not None:
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO blobs (hash, filename, size, width, height, phash, refcount, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+                        (content_hash, blob["filename"], blob["size"], blob["width"], blob["height"],
+                         blob.get("phash"), now)
+                    )
+                updated = self._conn.execute(
+                    "UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?", (content_hash,)
+                ).rowcount
+                if not updated:
+                    raise KeyError(f"Unknown blob: {content_hash}")
+                self._conn.execute(
+                    "INSERT INTO uploads (upload_id, hash, original_filename, created_at) VALUES (?, ?, ?, ?)",
+                    (upload_id, content_hash, original_filename, now)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return self.get_blob(content_hash)
+
+    def release(self, upload_id: Optional[str] = None,
+                filename: Optional[str] = None) -> Optional[Tuple[Dict[str, Any], int]]:
+        """
+        Drop one reference to a blob, either for a specific upload or (by filename) the newest one.
+
+        Returns:
+            (blob row, remaining refcount), or None if nothing matched. When the
+            remaining count is 0 the blob row is deleted and the caller should
+            remove the stored file.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if upload_id is not None:
+                    row = self._conn.execute(
+                        "SELECT u.upload_id, b.* FROM uploads u JOIN blobs b ON b.hash = u.hash "
+                        "WHERE u.upload_id = ?", (upload_id,)
+                    ).fetchone()
+                else:
+                    row = self._conn.execute(
+                        "SELECT u.upload_id, b.* FROM uploads u JOIN blobs b ON b.hash = u.hash "
+                        "WHERE b.filename = ? ORDER BY u.created_at DESC LIMIT 1", (filename,)
+                    ).fetchone()
+
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+
+                blob = dict(row)
+                self._conn.execute("DELETE FROM uploads WHERE upload_id = ?", (blob.pop("upload_id"),))
+                remaining = blob["refcount"] - 1
+                if remaining > 0:
+                    self._conn.execute("UPDATE blobs SET refcount = ? WHERE hash = ?", (remaining, blob["hash"]))
+                else:
+                    self._conn.execute("DELETE FROM blobs WHERE hash = ?", (blob["hash"],))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        blob["refcount"] = remaining
+        return blob, remaining
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Summarize deduplication."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) AS blobs, COALESCE(SUM(refcount), 0) AS uploads, "
+                "COALESCE(SUM(size), 0) AS stored_bytes, COALESCE(SUM(size * refcount), 0) AS logical_bytes "
+                "FROM blobs"
+            ).fetchone()
+        return dict(row)
+
+
+# Global instance
+image_ref_store = ImageRefStore(os.path.join(settings.data_dir, "images.db"))
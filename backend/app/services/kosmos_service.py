@@ -1,59 +1,106 @@
-import torch
-from transformers import AutoProcessor, AutoModelForVision2Seq, BlipProcessor, BlipForConditionalGeneration
-from PIL import Image
 import time
 import logging
 import random
-from typing import Optional, Dict, Any
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from typing import Optional, Dict, Any, Iterator, List, Tuple, Callable, TYPE_CHECKING
 from app.core.config import settings
+from app.core.lazy import LazyService
+from app.services.device_service import device_manager
+from app.core.cpu_topology import cpu_topology
+from app.core.tracing import trace_span, current_span, propagate
+from app.services.phash_index import caption_index, compute_dhash, parse_hash
+from app.services.embedding_cache import embedding_cache
+from app.services.story_templates import STORY_TEMPLATES, POEM_TEMPLATES, fill_template
+
+if TYPE_CHECKING:
+    import torch
+    from PIL import Image
+
+# torch, transformers and PIL are imported inside the methods that need them so
+# that importing this module (e.g. in edge mode) does not load the ML stack.
 
 logger = logging.getLogger(__name__)
 
+# Caption tier names, reported in model_used
+INDEX_TIER = "index"
+TEMPLATE_TIER = "template"
+
+
+def _cancel_criteria(*stops: Optional[threading.Event]):
+    """Stopping criteria that end generation early once any of the events is set (None entries are ignored)."""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+    
+    events = [stop for stop in stops if stop is not None]
+    
+    class StopWhenSet(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            stopped = any(stop.is_set() for stop in events)
+            return torch.full((input_ids.shape[0],), stopped, dtype=torch.bool, device=input_ids.device)
+    
+    return StoppingCriteriaList([StopWhenSet()])
+
 
 class KosmosService:
+    BLIP_MODEL_PATH = "Salesforce/blip-image-captioning-base"
+    
     def __init__(self):
         self.model = None
         self.processor = None
         self.blip_model = None
         self.blip_processor = None
-        self.device = self._get_device()
+        self.device = "cpu"
+        self._cpu_replicas = {}
+        self._replica_lock = threading.Lock()
+        self._hedge_executor = ThreadPoolExecutor(
+            max_workers=settings.caption_hedge_workers, thread_name_prefix="caption"
+        )
+        self._tier_wins: Counter = Counter()
+        self._hedges_started = 0
+        self._deadline_misses = 0
+        self._metrics_lock = threading.Lock()
         self._load_model()
     
-    def _get_device(self) -> str:
-        """Determine the best device to use for inference."""
-        if settings.device == "auto":
-            if torch.cuda.is_available():
-                return "cuda"
-            elif torch.backends.mps.is_available():
-                return "mps"
-            else:
-                return "cpu"
-        return settings.device
+    def _dtype_for(self, device: str):
+        """Half precision on CUDA, full precision elsewhere."""
+        import torch
+        return torch.float16 if device.startswith("cuda") else torch.float32
     
     def _load_model(self):
         """Load the models for image understanding and story generation."""
+        cpu_topology.configure_torch()
+        
         try:
-            logger.info(f"Loading image captioning model on {self.device}...")
+            from transformers import AutoProcessor, AutoModelForVision2Seq, BlipProcessor, BlipForConditionalGeneration
             
             # Try to load BLIP for better image understanding
             try:
-                self.blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+                self.device = device_manager.place_model("blip")
+                logger.info(f"Loading image captioning model on {self.device}...")
+                self.blip_processor = BlipProcessor.from_pretrained(self.BLIP_MODEL_PATH)
                 self.blip_model = BlipForConditionalGeneration.from_pretrained(
-                    "Salesforce/blip-image-captioning-base",
-                    torch_dtype=torch.float16 if self.device == "cuda" else torch.float32
+                    self.BLIP_MODEL_PATH,
+                    torch_dtype=self._dtype_for(self.device)
                 ).to(self.device)
                 logger.info("BLIP model loaded successfully!")
             except Exception as e:
                 logger.warning(f"Failed to load BLIP model: {e}")
+                device_manager.release_model("blip")
                 # Fallback to Kosmos-2 for basic image understanding
                 try:
+                    self.device = device_manager.place_model("kosmos")
                     self.processor = AutoProcessor.from_pretrained(settings.kosmos_model_path)
                     self.model = AutoModelForVision2Seq.from_pretrained(
                         settings.kosmos_model_path,
-                        torch_dtype=torch.float16 if self.device == "cuda" else torch.float32
+                        torch_dtype=self._dtype_for(self.device)
                     ).to(self.device)
                     logger.info("Kosmos-2 model loaded as fallback!")
                 except Exception as kosmos_error:
+                    device_manager.release_model("kosmos")
                     logger.error(f"Failed to load both BLIP and Kosmos-2: {kosmos_error}")
                     logger.info("Using mock story generation service")
                     
@@ -61,128 +108,675 @@ class KosmosService:
             logger.error(f"Failed to load any vision model: {e}")
             logger.info("Using mock story generation service")
     
-    def generate_story(self, image_path: str, story_type: str = "story") -> Dict[str, Any]:
+    def _get_cpu_replica(self, model_key: str):
+        """Lazily load a CPU copy of a model for requests the accelerator cannot take."""
+        if model_key in self._cpu_replicas:
+            return self._cpu_replicas[model_key]
+        
+        # Concurrent fallbacks wait for one load instead of each loading a copy
+        with self._replica_lock:
+            if model_key not in self._cpu_replicas:
+                from transformers import AutoModelForVision2Seq, BlipForConditionalGeneration
+                
+                logger.info(f"Loading CPU replica of {model_key} for fallback requests...")
+                if model_key == "blip":
+                    model = BlipForConditionalGeneration.from_pretrained(self.BLIP_MODEL_PATH)
+                else:
+                    model = AutoModelForVision2Seq.from_pretrained(settings.kosmos_model_path)
+                self._cpu_replicas[model_key] = model.to("cpu").eval()
+        return self._cpu_replicas[model_key]
+    
+    def _get_model_for_device(self, model_key: str, device: str):
+        """Get the model instance that lives on the given device."""
+        primary = self.blip_model if model_key == "blip" else self.model
+        if device == self.device:
+            return primary
+        return self._get_cpu_replica(model_key)
+    
+    def _run_on_device(self, model_key: str, caption_fn, image: "Image.Image",
+                       stop: Optional[threading.Event] = None, image_hash: Optional[str] = None) -> str:
+        """
+        Run a captioning function on the device the device manager grants.
+        
+        Accelerator OOM errors are retried once on CPU instead of failing the request.
+        """
+        if stop is not None and stop.is_set():
+            # Queued behind other work until the hedged request was already answered
+            raise RuntimeError("Caption request no longer needed")
+        
+        with device_manager.acquire(model_key) as device:
+            current_span().set_attribute("model", model_key)
+            current_span().set_attribute("device", device)
+            try:
+                return caption_fn(self._get_model_for_device(model_key, device), device, image, stop, image_hash)
+            except Exception as e:
+                if device == "cpu" or not device_manager.is_out_of_memory(e):
+                    raise
+                device_manager.release_cached_memory(device)
+                device_manager.record_fallback(model_key, "out of memory")
+        
+        current_span().set_attribute("device", "cpu")
+        return caption_fn(self._get_model_for_device(model_key, "cpu"), "cpu", image, stop, image_hash)
+    
+    KOSMOS_PROMPT = "<grounding>Describe this image in detail."
+    MOCK_DESCRIPTION = "a vibrant scene with people enjoying a moment together in a colorful setting"
+    ERROR_DESCRIPTION = "an interesting scene captured in this photograph"
+    
+    def generate_story(self, image_path: str, story_type: str = "story", phash: Optional[str] = None,
+                       reuse_caption: bool = True, deadline_ms: Optional[float] = None) -> Dict[str, Any]:
         """
         Generate a story or poem from an image.
         
         Args:
             image_path: Path to the image file
             story_type: Type of content to generate ("story" or "poem")
+            phash: Perceptual hash computed on ingest (computed here if missing)
+            reuse_caption: Allow reusing the caption of a near-duplicate image
+            deadline_ms: Captioning latency budget; defaults to settings.caption_deadline_ms
             
         Returns:
             Dictionary containing the generated content and metadata
         """
+        with trace_span("kosmos.generate_story", story_type=story_type):
+            return self._generate_story(image_path, story_type, phash, reuse_caption, deadline_ms)
+    
+    def _generate_story(self, image_path: str, story_type: str, phash: Optional[str],
+                        reuse_caption: bool, deadline_ms: Optional[float]) -> Dict[str, Any]:
         start_time = time.time()
         
         try:
             # Load and preprocess image
-            image = Image.open(image_path).convert("RGB")
+            with trace_span("kosmos.decode_image"):
+                image, image_hash = self.load_image(image_path)
             
             # Get image description
-            description = self._get_image_description(image)
+            with trace_span("kosmos.caption") as span:
+                description, caption_source, tier = self._describe(
+                    image, phash, reuse_caption, deadline_ms, image_hash
+                )
+                span.set_attribute("caption_source", caption_source)
+                span.set_attribute("caption_tier", tier)
+            
+            return self._compose(description, story_type, caption_source, tier, start_time)
             
-            # Generate creative content based on description
+        except Exception as e:
+            logger.error(f"Error generating story: {e}")
+            # Fallback to mock generation
+            return self._generate_mock_story(story_type, start_time)
+    
+    def load_image(self, image_path: str) -> Tuple["Image.Image", str]:
+        """Decode an image and hash its bytes, which keys the embedding cache."""
+        import io
+        from PIL import Image
+        
+        with open(image_path, "rb") as f:
+            data = f.read()
+        return Image.open(io.BytesIO(data)).convert("RGB"), hashlib.sha256(data).hexdigest()
+    
+    def _compose(self, description: str, story_type: str, caption_source: str, tier: str,
+                 start_time: float) -> Dict[str, Any]:
+        """Generate creative content based on description."""
+        with trace_span("kosmos.compose"):
             if story_type == "poem":
                 content = self._generate_poem_from_description(description)
                 title = self._generate_title(content, "poem")
             else:
                 content = self._generate_story_from_description(description)
                 title = self._generate_title(content, "story")
+        
+        generation_time = time.time() - start_time
+        
+        return {
+            "title": title,
+            "content": content,
+            "story_type": story_type,
+            "generation_time": generation_time,
+            "model_used": f"{tier}-creative",
+            "caption": description,
+            "caption_source": caption_source
+        }
+    
+    def generate_stories(self, images: List["Image.Image"], image_hashes: List[Optional[str]],
+                         story_type: str = "story", phashes: Optional[List[Optional[str]]] = None,
+                         reuse_caption: bool = True) -> List[Dict[str, Any]]:
+        """
+        Generate stories or poems for a batch of decoded images, for offline bulk runs.
+        
+        Images without an indexed caption are captioned together in one model
+        call with the best tier; there is no deadline or hedging.
+        
+        Args:
+            images: Decoded RGB images
+            image_hashes: Content hashes from load_image, keying the embedding cache
+            story_type: Type of content to generate ("story" or "poem")
+            phashes: Perceptual hashes computed on ingest (computed here where missing)
+            reuse_caption: Allow reusing the captions of near-duplicate images
             
-            generation_time = time.time() - start_time
+        Returns:
+            One story dictionary per image, in order; generation_time is the batch's
+        """
+        with trace_span("kosmos.generate_stories", story_type=story_type, batch_size=len(images)):
+            start_time = time.time()
+            with trace_span("kosmos.caption"):
+                descriptions = self._describe_batch(images, image_hashes, phashes or [None] * len(images),
+                                                    reuse_caption)
+            return [
+                self._compose(description, story_type, caption_source, tier, start_time)
+                for description, caption_source, tier in descriptions
+            ]
+    
+    def stream_story(self, image_path: str, story_type: str = "story", phash: Optional[str] = None,
+                     reuse_caption: bool = True,
+                     stop: Optional[threading.Event] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Generate a story while streaming the caption as it is decoded.
+        
+        Decoding is greedy because token streamers don't support beam search.
+        
+        Args:
+            image_path: Path to the image file
+            story_type: Type of content to generate ("story" or "poem")
+            phash: Perceptual hash computed on ingest (computed here if missing)
+            reuse_caption: Allow reusing the caption of a near-duplicate image
+            stop: Set when the caller no longer wants the story; decoding ends at its next step
             
-            return {
-                "title": title,
-                "content": content,
-                "story_type": story_type,
-                "generation_time": generation_time,
-                "model_used": "blip-enhanced-creative" if self.blip_model else "creative-mock"
-            }
+        Yields:
+            ("token", {"text"}) for each decoded piece, then ("caption", {...}) and ("story", {...}),
+            unless stopped first
+        """
+        with trace_span("kosmos.stream_story", story_type=story_type):
+            start_time = time.time()
+            
+            try:
+                with trace_span("kosmos.decode_image"):
+                    image, image_hash = self.load_image(image_path)
+            except Exception as e:
+                logger.error(f"Error generating story: {e}")
+                yield "story", self._generate_mock_story(story_type, start_time)
+                return
+            
+            model_key = self._caption_model_key()
+            use_index = settings.caption_index_enabled and model_key is not None
+            hash_value = None
+            description = None
+            caption_source = "model"
+            tier = self._streaming_tier(model_key)
+            
+            if use_index:
+                hash_value = parse_hash(phash) if phash else compute_dhash(image)
+                match = caption_index.lookup(hash_value, model_key) if reuse_caption else None
+                if match is not None:
+                    description, caption_source, tier = match[0], "index", INDEX_TIER
+            
+            if description is None:
+                pieces = []
+                try:
+                    with trace_span("kosmos.caption", streaming=True):
+                        for piece in self._stream_caption(model_key, image, image_hash, stop):
+                            pieces.append(piece)
+                            yield "token", {"text": piece}
+                    if stop is not None and stop.is_set():
+                        # The caption was cut short; don't index or tell a story about it
+                        return
+                    description = "".join(pieces).replace(self.KOSMOS_PROMPT, "").strip()
+                    if use_index and description:
+                        caption_index.add(hash_value, description, model_key)
+                except Exception as e:
+                    logger.error(f"Error getting image description: {e}")
+                    description = "".join(pieces).strip()
+                    if not description:
+                        description, tier = self.ERROR_DESCRIPTION, TEMPLATE_TIER
+            
+            self._record_win(tier)
+            yield "caption", {"text": description, "source": caption_source}
+            yield "story", self._compose(description, story_type, caption_source, tier, start_time)
+    
+    def _streaming_tier(self, model_key: Optional[str]) -> str:
+        """Tier reported for streamed captions, which are always decoded greedily."""
+        if model_key == "blip":
+            return "blip-greedy"
+        if model_key == "kosmos":
+            return "kosmos-2"
+        return TEMPLATE_TIER
+    
+    def _stream_caption(self, model_key: Optional[str], image: "Image.Image",
+                        image_hash: Optional[str] = None,
+                        stop: Optional[threading.Event] = None) -> Iterator[str]:
+        """
+        Yield caption text pieces as the model decodes them.
+        
+        An accelerator OOM before the first piece is retried on CPU, like
+        _run_on_device does; after that the client already has part of the
+        caption, so the error is raised instead.
+        """
+        if model_key is None:
+            yield self.MOCK_DESCRIPTION
+            return
+        
+        with device_manager.acquire(model_key) as device:
+            current_span().set_attribute("device", device)
+            streamed = False
+            try:
+                for piece in self._stream_on_device(model_key, device, image, image_hash, stop):
+                    streamed = True
+                    yield piece
+                return
+            except Exception as e:
+                if streamed or device == "cpu" or not device_manager.is_out_of_memory(e):
+                    raise
+                device_manager.release_cached_memory(device)
+                device_manager.record_fallback(model_key, "out of memory")
+        
+        current_span().set_attribute("device", "cpu")
+        yield from self._stream_on_device(model_key, "cpu", image, image_hash, stop)
+    
+    def _stream_on_device(self, model_key: str, device: str, image: "Image.Image",
+                          image_hash: Optional[str], stop: Optional[threading.Event] = None) -> Iterator[str]:
+        """Stream a caption from the model instance on a device, until it is done or stop is set."""
+        import torch
+        from transformers import TextIteratorStreamer
+        
+        model = self._get_model_for_device(model_key, device)
+        generate, decoder_inputs = self._prepare_decoding(model_key, model, device, image, image_hash)
+        if model_key == "blip":
+            processor = self.blip_processor
+            generate_kwargs = {"max_length": 50}
+        else:
+            processor = self.processor
+            generate_kwargs = {"max_new_tokens": 100}
+        
+        streamer = TextIteratorStreamer(
+            processor.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=120
+        )
+        errors = []
+        # Set when this generator is closed early, so generate() doesn't decode a caption nobody reads
+        abandoned = threading.Event()
+        stopping_criteria = _cancel_criteria(abandoned, stop)
+        
+        def run_generate():
+            try:
+                with torch.no_grad():
+                    generate(**decoder_inputs, **generate_kwargs, num_beams=1, streamer=streamer,
+                             stopping_criteria=stopping_criteria)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+        
+        thread = threading.Thread(target=propagate(run_generate), daemon=True)
+        thread.start()
+        try:
+            for piece in streamer:
+                if piece:
+                    yield piece
+        finally:
+            # Keep the reservation until generate() has actually finished
+            abandoned.set()
+            thread.join()
+        
+        if errors:
+            raise errors[0]
+    
+    def _caption_model_key(self) -> Optional[str]:
+        """Key of the captioning model in use, or None when running on mock descriptions."""
+        if self.blip_model and self.blip_processor:
+            return "blip"
+        if self.model and self.processor:
+            return "kosmos"
+        return None
+    
+    def _describe(self, image: "Image.Image", phash: Optional[str], reuse_caption: bool,
+                  deadline_ms: Optional[float] = None, image_hash: Optional[str] = None):
+        """
+        Describe an image, reusing the caption of a perceptually near-identical one when possible.
+        
+        Returns:
+            Tuple of (description, source, tier) where source is "index" or "model"
+        """
+        model_key = self._caption_model_key()
+        use_index = settings.caption_index_enabled and model_key is not None
+        
+        if use_index:
+            hash_value = parse_hash(phash) if phash else compute_dhash(image)
+            if reuse_caption:
+                match = caption_index.lookup(hash_value, model_key)
+                if match is not None:
+                    caption, distance = match
+                    current_span().set_attribute("phash_distance", distance)
+                    self._record_win(INDEX_TIER)
+                    return caption, "index", INDEX_TIER
+        
+        description, tier = self._get_image_description(image, deadline_ms, image_hash)
+        self._record_win(tier)
+        if use_index and tier != TEMPLATE_TIER:
+            caption_index.add(hash_value, description, model_key)
+        return description, "model", tier
+    
+    def _describe_batch(self, images: List["Image.Image"], image_hashes: List[Optional[str]],
+                        phashes: List[Optional[str]], reuse_caption: bool) -> List[Tuple[str, str, str]]:
+        """
+        Batched counterpart of _describe.
+        
+        Returns:
+            (description, source, tier) for each image, in order
+        """
+        model_key = self._caption_model_key()
+        if model_key is None:
+            for _ in images:
+                self._record_win(TEMPLATE_TIER)
+            return [(self.MOCK_DESCRIPTION, "model", TEMPLATE_TIER)] * len(images)
+        
+        use_index = settings.caption_index_enabled
+        results: List[Optional[Tuple[str, str, str]]] = [None] * len(images)
+        hash_values: Dict[int, int] = {}
+        for index, image in enumerate(images):
+            if not use_index:
+                break
+            hash_values[index] = parse_hash(phashes[index]) if phashes[index] else compute_dhash(image)
+            if reuse_caption:
+                match = caption_index.lookup(hash_values[index], model_key)
+                if match is not None:
+                    results[index] = (match[0], "index", INDEX_TIER)
+                    self._record_win(INDEX_TIER)
+        
+        pending = [index for index, result in enumerate(results) if result is None]
+        if pending:
+            tier = self._caption_tiers()[0][0]
+            try:
+                captions = self._run_on_device(
+                    model_key, partial(self._caption_batch, model_key),
+                    [images[index] for index in pending], None, [image_hashes[index] for index in pending]
+                )
+            except Exception as e:
+                logger.error(f"Error captioning batch of {len(pending)} images: {e}")
+                captions, tier = [self.ERROR_DESCRIPTION] * len(pending), TEMPLATE_TIER
             
+            for index, caption in zip(pending, captions):
+                results[index] = (caption, "model", tier)
+                self._record_win(tier)
+                if use_index and tier != TEMPLATE_TIER:
+                    caption_index.add(hash_values[index], caption, model_key)
+        return results
+    
+    def _caption_tiers(self) -> List[Tuple[str, Callable]]:
+        """
+        Captioning paths from best to cheapest. The template description is
+        the implicit last tier and always answers in time.
+        """
+        if self.blip_model and self.blip_processor:
+            return [
+                ("blip-beam", partial(self._run_on_device, "blip", partial(self._blip_caption, num_beams=5))),
+                ("blip-greedy", partial(self._run_on_device, "blip", partial(self._blip_caption, num_beams=1)))
+            ]
+        if self.model and self.processor:
+            return [("kosmos-2", partial(self._run_on_device, "kosmos", self._kosmos_caption))]
+        return []
+    
+    def _get_image_description(self, image: "Image.Image", deadline_ms: Optional[float] = None,
+                               image_hash: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Get a description of the image using available models.
+        
+        Returns:
+            Tuple of (description, tier that produced it)
+        """
+        tiers = self._caption_tiers()
+        if not tiers:
+            # Mock description for fallback
+            return self.MOCK_DESCRIPTION, TEMPLATE_TIER
+        
+        if deadline_ms is None:
+            deadline_ms = settings.caption_deadline_ms
+        if deadline_ms:
+            return self._hedged_description(image, tiers, deadline_ms / 1000, image_hash)
+        
+        tier, caption_fn = tiers[0]
+        try:
+            return caption_fn(image, None, image_hash), tier
         except Exception as e:
-            logger.error(f"Error generating story: {e}")
-            # Fallback to mock generation
-            return self._generate_mock_story(story_type, start_time)
+            logger.error(f"Error getting image description: {e}")
+            return self.ERROR_DESCRIPTION, TEMPLATE_TIER
     
-    def _get_image_description(self, image: Image.Image) -> str:
-        """Get a description of the image using available models."""
+    def _hedged_description(self, image: "Image.Image", tiers: List[Tuple[str, Callable]],
+                            budget: float, image_hash: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Caption within a latency budget.
+        
+        The best tier starts immediately. If it hasn't answered after
+        settings.caption_hedge_delay_ms (or fails), the next cheaper tier is
+        started alongside it, and the first answer wins; the losers are
+        stopped at their next decoding step. When the budget runs out the
+        template description is returned.
+        """
+        hedge_delay = settings.caption_hedge_delay_ms / 1000
+        deadline = time.monotonic() + budget
+        hedge_at = time.monotonic() + hedge_delay
+        rank = {name: index for index, (name, _) in enumerate(tiers)}
+        remaining = list(tiers)
+        pending = {}
+        stop = threading.Event()
+        
+        def start_next_tier():
+            name, caption_fn = remaining.pop(0)
+            pending[self._hedge_executor.submit(propagate(caption_fn), image, stop, image_hash)] = name
+        
+        start_next_tier()
         try:
-            if self.blip_model and self.blip_processor:
-                # Use BLIP for better image understanding
-                inputs = self.blip_processor(image, return_tensors="pt").to(self.device)
-                
-                with torch.no_grad():
-                    out = self.blip_model.generate(**inputs, max_length=50, num_beams=5)
+            while pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                wait_until = min(hedge_at, deadline) if remaining else deadline
+                done, _ = wait(pending, timeout=max(0.0, wait_until - now), return_when=FIRST_COMPLETED)
                 
-                description = self.blip_processor.decode(out[0], skip_special_tokens=True)
-                return description
-                
-            elif self.model and self.processor:
-                # Use Kosmos-2 for basic captioning
-                prompt = "<grounding>Describe this image in detail."
-                inputs = self.processor(text=prompt, images=image, return_tensors="pt").to(self.device)
-                
-                with torch.no_grad():
-                    generated_ids = self.model.generate(**inputs, max_new_tokens=100)
+                for future in sorted(done, key=lambda f: rank[pending[f]]):
+                    name = pending.pop(future)
+                    try:
+                        return future.result(), name
+                    except Exception as e:
+                        logger.warning(f"Caption tier {name} failed: {e}")
                 
-                description = self.processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-                description = description.replace(prompt, "").strip()
-                return description
-            else:
-                # Mock description for fallback
-                return "a vibrant scene with people enjoying a moment together in a colorful setting"
-                
-        except Exception as e:
-            logger.error(f"Error getting image description: {e}")
-            return "an interesting scene captured in this photograph"
+                if remaining and (not pending or time.monotonic() >= hedge_at):
+                    with self._metrics_lock:
+                        self._hedges_started += 1
+                    current_span().set_attribute("hedged", True)
+                    start_next_tier()
+                    hedge_at = time.monotonic() + hedge_delay
+        finally:
+            stop.set()
+        
+        if pending:
+            with self._metrics_lock:
+                self._deadline_misses += 1
+            logger.warning(f"Captioning missed its {budget * 1000:.0f}ms deadline; using the template description")
+        return self.ERROR_DESCRIPTION, TEMPLATE_TIER
     
-    def _generate_story_from_description(self, description: str) -> str:
-        """Generate a creative story based on image description."""
-        story_templates = [
-            f"In a world where magic meets reality, {description}. The air was filled with excitement as friends gathered for an adventure that would change their lives forever. Each person brought their own unique energy to the group, creating a bond that transcended ordinary friendship. As they stood together, they knew this moment would be remembered for years to come, a testament to the power of connection and shared joy.",
-            
-            f"The photograph captures {description}, but there's more to this story than meets the eye. Behind the smiles and laughter lies a tale of friendship that began years ago. These companions had traveled far and wide, collecting memories like precious gems. Today marked another chapter in their ongoing adventure, where every moment was a celebration of life itself.",
-            
-            f"Once upon a time, in a place where dreams come alive, {description}. The scene was set for an extraordinary day filled with wonder and discovery. Each person in the group carried stories of their own, and together they created something magical. The bonds they shared were stronger than any challenge they might face, and their joy was infectious to all who witnessed it.",
+    def _record_win(self, tier: str):
+        with self._metrics_lock:
+            self._tier_wins[tier] += 1
+    
+    def get_caption_metrics(self) -> Dict[str, Any]:
+        """Report which captioning tiers answered and how often deadlines forced a fallback."""
+        with self._metrics_lock:
+            return {
+                "deadline_ms": settings.caption_deadline_ms,
+                "hedge_delay_ms": settings.caption_hedge_delay_ms,
+                "tiers": [name for name, _ in self._caption_tiers()] + [TEMPLATE_TIER],
+                "tier_wins": dict(self._tier_wins),
+                "hedges_started": self._hedges_started,
+                "deadline_misses": self._deadline_misses
+            }
+    
+    def _blip_caption(self, model, device: str, image: "Image.Image", stop: Optional[threading.Event] = None,
+                      image_hash: Optional[str] = None, num_beams: int = 5) -> str:
+        """Caption an image with BLIP."""
+        import torch
+        
+        generate, decoder_inputs = self._prepare_decoding("blip", model, device, image, image_hash)
+        stopping_criteria = _cancel_criteria(stop) if stop is not None else None
+        
+        with torch.no_grad():
+            out = generate(**decoder_inputs, max_length=50, num_beams=num_beams, stopping_criteria=stopping_criteria)
+        
+        return self.blip_processor.decode(out[0], skip_special_tokens=True)
+    
+    def _kosmos_caption(self, model, device: str, image: "Image.Image", stop: Optional[threading.Event] = None,
+                        image_hash: Optional[str] = None) -> str:
+        """Caption an image with Kosmos-2."""
+        import torch
+        
+        generate, decoder_inputs = self._prepare_decoding("kosmos", model, device, image, image_hash)
+        stopping_criteria = _cancel_criteria(stop) if stop is not None else None
+        
+        with torch.no_grad():
+            generated_ids = generate(**decoder_inputs, max_new_tokens=100, stopping_criteria=stopping_criteria)
+        
+        description = self.processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
+        return description.replace(self.KOSMOS_PROMPT, "").strip()
+    
+    def _prepare_decoding(self, model_key: str, model, device: str, image: "Image.Image",
+                          image_hash: Optional[str]) -> Tuple[Callable, Dict[str, Any]]:
+        """
+        Encode an image, or fetch its cached vision embeddings, and build the
+        text-decoder call so that only the decoder runs on a cache hit.
+        
+        Returns:
+            Tuple of (generate function, keyword arguments)
+        """
+        if model_key == "blip":
+            image_embeds = self._cached_embeddings(
+                self.BLIP_MODEL_PATH, model, device, image_hash,
+                lambda: self._blip_encode(model, self._blip_inputs(model, device, image)["pixel_values"])
+            )
+            return model.text_decoder.generate, self._blip_decoder_inputs(model, device, image_embeds)
+        
+        inputs = dict(self._kosmos_inputs(model, device, image))
+        pixel_values = inputs.pop("pixel_values")
+        inputs["image_embeds"] = self._cached_embeddings(
+            settings.kosmos_model_path, model, device, image_hash,
+            lambda: self._kosmos_encode(model, pixel_values)
+        )
+        return model.generate, inputs
+    
+    def _blip_decoder_inputs(self, model, device: str, image_embeds: "torch.Tensor") -> Dict[str, Any]:
+        """Same decoder call as BlipForConditionalGeneration.generate for unprompted captions."""
+        import torch
+        
+        text_config = model.config.text_config
+        return {
+            "input_ids": torch.full(
+                (image_embeds.shape[0], 1), text_config.bos_token_id, dtype=torch.long, device=device
+            ),
+            "eos_token_id": text_config.sep_token_id,
+            "pad_token_id": text_config.pad_token_id,
+            "encoder_hidden_states": image_embeds,
+            "encoder_attention_mask": torch.ones(image_embeds.shape[:-1], dtype=torch.long, device=device)
+        }
+    
+    def _caption_batch(self, model_key: str, model, device: str, images: List["Image.Image"],
+                       stop: Optional[threading.Event] = None,
+                       image_hashes: Optional[List[Optional[str]]] = None) -> List[str]:
+        """Caption several images with one encoder and one decoder call (BLIP beam search or Kosmos-2)."""
+        import torch
+        
+        image_hashes = image_hashes or [None] * len(images)
+        stopping_criteria = _cancel_criteria(stop) if stop is not None else None
+        
+        if model_key == "blip":
+            image_embeds = self._batch_embeddings(
+                self.BLIP_MODEL_PATH, model, device, image_hashes,
+                lambda indices: self._blip_encode(
+                    model, self._blip_inputs(model, device, [images[index] for index in indices])["pixel_values"]
+                )
+            )
+            with torch.no_grad():
+                out = model.text_decoder.generate(
+                    **self._blip_decoder_inputs(model, device, image_embeds),
+                    max_length=50, num_beams=5, stopping_criteria=stopping_criteria
+                )
+            return self.blip_processor.batch_decode(out, skip_special_tokens=True)
+        
+        # The prompt is the same for every image, so the text inputs need no padding
+        inputs = dict(self.processor(
+            text=[self.KOSMOS_PROMPT] * len(images), images=images, return_tensors="pt"
+        ).to(device))
+        pixel_values = inputs.pop("pixel_values").to(model.dtype)
+        inputs["image_embeds"] = self._batch_embeddings(
+            settings.kosmos_model_path, model, device, image_hashes,
+            lambda indices: self._kosmos_encode(model, pixel_values[indices])
+        )
+        with torch.no_grad():
+            generated_ids = model.generate(**inputs, max_new_tokens=100, stopping_criteria=stopping_criteria)
+        return [
+            description.replace(self.KOSMOS_PROMPT, "").strip()
+            for description in self.processor.batch_decode(generated_ids, skip_special_tokens=True)
         ]
+    
+    def _batch_embeddings(self, model_name: str, model, device: str, image_hashes: List[Optional[str]],
+                          encode: Callable[[List[int]], "torch.Tensor"]) -> "torch.Tensor":
+        """
+        Vision embeddings for a batch, running the encoder once over only the images not in the cache.
+        
+        Args:
+            encode: Encodes the images at the given batch positions, one row per image
+        
+        Returns:
+            Embeddings stacked in image order, on the model's device and dtype
+        """
+        import torch
         
-        return random.choice(story_templates)
+        rows = [embedding_cache.get(model_name, image_hash) for image_hash in image_hashes]
+        missing = [index for index, row in enumerate(rows) if row is None]
+        if missing:
+            with trace_span("kosmos.encode_image", model=model_name, batch_size=len(missing)):
+                encoded = encode(missing)
+            for position, index in enumerate(missing):
+                # Copy the row so the cache doesn't keep the whole batch's storage alive
+                rows[index] = encoded[position:position + 1].clone()
+                embedding_cache.put(model_name, image_hashes[index], rows[index])
+        return torch.cat([row.to(device, model.dtype) for row in rows])
+    
+    def _cached_embeddings(self, model_name: str, model, device: str, image_hash: Optional[str],
+                           encode: Callable) -> "torch.Tensor":
+        """Get vision embeddings from the cache (or the encoder) on the model's device and dtype."""
+        with trace_span("kosmos.encode_image", model=model_name):
+            image_embeds = embedding_cache.get_or_compute(model_name, image_hash, encode)
+        return image_embeds.to(device, model.dtype)
+    
+    def _blip_encode(self, model, pixel_values: "torch.Tensor") -> "torch.Tensor":
+        """Run BLIP's vision encoder."""
+        import torch
+        
+        with torch.no_grad():
+            return model.vision_model(pixel_values=pixel_values)[0]
+    
+    def _kosmos_encode(self, model, pixel_values: "torch.Tensor") -> "torch.Tensor":
+        """Run Kosmos-2's vision encoder and image-to-text projection."""
+        import torch
+        
+        with torch.no_grad():
+            vision_output = model.vision_model(pixel_values=pixel_values)
+            image_embeds = model.vision_model.model.post_layernorm(vision_output[0])
+            image_embeds = torch.nn.functional.normalize(image_embeds, dim=-1)
+            image_embeds, _ = model.image_to_text_projection(image_embeds)
+        return image_embeds
+    
+    def _blip_inputs(self, model, device: str, image: "Image.Image"):
+        """Preprocess an image for BLIP."""
+        return self.blip_processor(image, return_tensors="pt").to(device, model.dtype)
+    
+    def _kosmos_inputs(self, model, device: str, image: "Image.Image"):
+        """Preprocess an image and the detail prompt for Kosmos-2."""
+        inputs = self.processor(text=self.KOSMOS_PROMPT, images=image, return_tensors="pt").to(device)
+        inputs["pixel_values"] = inputs["pixel_values"].to(model.dtype)
+        return inputs
+    
+    def _generate_story_from_description(self, description: str) -> str:
+        """Generate a creative story based on image description."""
+        return fill_template(random.choice(STORY_TEMPLATES), description)
     
     def _generate_poem_from_description(self, description: str) -> str:
         """Generate a creative poem based on image description."""
-        poem_templates = [
-            f"""In colors bright and spirits high,
-{description} beneath the sky.
-Friends together, hearts so true,
-Creating memories, fresh and new.
-
-Laughter echoes through the air,
-Joy and wonder everywhere.
-In this moment, time stands still,
-Hearts with happiness they fill.""",
-
-            f"""A picture worth a thousand words,
-{description} like singing birds.
-Together standing, side by side,
-With friendship as their faithful guide.
-
-The world around them seems to glow,
-With warmth that only true friends know.
-In this snapshot of pure delight,
-Everything feels just right.""",
-
-            f"""Captured here in vibrant hue,
-{description}, a friendship true.
-Smiles that light the darkest day,
-Hearts that chase all fears away.
-
-In this moment, frozen time,
-Life itself becomes a rhyme.
-Friends united, spirits free,
-Pure joy for all to see."""
-        ]
-        
-        return random.choice(poem_templates)
+        return fill_template(random.choice(POEM_TEMPLATES), description)
     
     def _generate_mock_story(self, story_type: str, start_time: float) -> Dict[str, Any]:
         """Generate a mock story when models fail."""
@@ -227,5 +821,5 @@ Happiness that will never fade."""
         return (self.blip_model is not None) or (self.model is not None) or True  # Always ready with mock
 
 
-# Global instance
-kosmos_service = KosmosService() 
\ No newline at end of file
+# Global instance, constructed (and models loaded) on first use
+kosmos_service = LazyService(KosmosService, "kosmos") 
\ No newline at end of file
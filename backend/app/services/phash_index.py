@@ -0,0 +1,259 @@
+import os
+import json
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple, TYPE_CHECKING
+from app.core.config import settings
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+# The caption log is rewritten once it holds this many times more lines than live entries
+COMPACT_FACTOR = 2
+COMPACT_MIN_LINES = 1000
+
+
+def compute_dhash(image: "Image.Image") -> int:
+    """
+    Compute a 64-bit difference hash of an image.
+
+    The image is reduced to a 9x8 grayscale thumbnail and each bit records
+    whether a pixel is brighter than its right neighbour, which is stable
+    under re-encoding, resizing and small edits.
+    """
+    from PIL import Image
+
+    thumbnail = image.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = list(thumbnail.getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def format_hash(value: int) -> str:
+    return f"{value:016x}"
+
+
+def parse_hash(value: str) -> int:
+    return int(value, 16)
+
+
+class MultiIndexHashTable:
+    """
+    Hamming-distance index over 64-bit hashes using multi-index hashing.
+
+    The hash is split into max_distance + 1 disjoint chunks, each with its own
+    exact-match table. By the pigeonhole principle any hash within
+    max_distance bits of a query matches it exactly on at least one chunk, so
+    a lookup only verifies the few candidates sharing a chunk instead of
+    scanning every entry.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        chunk_count = max_distance + 1
+        base, extra = divmod(HASH_BITS, chunk_count)
+        self._chunks: List[Tuple[int, int]] = []  # (shift, mask)
+        shift = 0
+        for index in range(chunk_count):
+            width = base + (1 if index < extra else 0)
+            self._chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables: List[Dict[int, set]] = [{} for _ in self._chunks]
+        self._values: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def add(self, key: int, value: Any):
+        """Insert or replace the value for a hash."""
+        with self._lock:
+            if key not in self._values:
+                for (shift, mask), table in zip(self._chunks, self._tables):
+                    table.setdefault((key >> shift) & mask, set()).add(key)
+            self._values[key] = value
+
+    def items(self) -> List[Tuple[int, Any]]:
+        """Snapshot of all (hash, value) pairs."""
+        with self._lock:
+            return list(self._values.items())
+
+    def nearest(self, key: int, max_distance: Optional[int] = None) -> Optional[Tuple[int, Any]]:
+        """
+        Find the closest stored hash within max_distance bits.
+
+        Returns:
+            (distance, value) of the nearest entry, or None if nothing is close enough
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+
+        with self._lock:
+            exact = self._values.get(key)
+            if exact is not None:
+                return 0, exact
+
+            best = None
+            seen = set()
+            for (shift, mask), table in zip(self._chunks, self._tables):
+                for candidate in table.get((key >> shift) & mask, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = (candidate ^ key).bit_count()
+                    if distance <= max_distance and (best is None or distance < best[0]):
+                        best = (distance, self._values[candidate])
+            return best
+
+
+class CaptionIndex:
+    """
+    Perceptual-hash index of generated captions, so near-duplicate photos
+    (burst shots, light edits) reuse an existing caption instead of running
+    the captioning model again. Each captioning model has its own table, so
+    one model's captions never shadow or replace another's. Entries are kept
+    in memory and appended to a JSON-lines log so the index survives
+    restarts; the log is compacted when replaced entries make it grow well
+    past the live ones. Several worker processes may share the log, so
+    appends hold a shared file lock and compaction an exclusive one, and
+    compaction rewrites what is on disk rather than this process's view.
+    """
+
+    def __init__(self, path: str, max_distance: int):
+        self.path = path
+        self.max_distance = max_distance
+        self.tables: Dict[str, MultiIndexHashTable] = {}
+        self._tables_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._log_lines = 0
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in list(self.tables.values()))
+
+    def _table(self, model: str) -> MultiIndexHashTable:
+        table = self.tables.get(model)
+        if table is None:
+            with self._tables_lock:
+                table = self.tables.setdefault(model, MultiIndexHashTable(self.max_distance))
+        return table
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._table(entry["model"]).add(parse_hash(entry["phash"]), entry["caption"])
+                        self._log_lines += 1
+            logger.info(f"Loaded {len(self)} captions into the near-duplicate index")
+        except Exception as e:
+            logger.error(f"Failed to load caption index: {e}")
+            return
+        with self._write_lock:
+            self._maybe_compact()
+
+    def lookup(self, phash: int, model: str, max_distance: Optional[int] = None) -> Optional[Tuple[str, int]]:
+        """
+        Find a caption produced by the same model for a perceptually similar image.
+
+        Returns:
+            (caption, distance) or None
+        """
+        table = self.tables.get(model)
+        match = table.nearest(phash, max_distance) if table is not None else None
+        if match is not None:
+            distance, caption = match
+            self.hits += 1
+            return caption, distance
+        self.misses += 1
+        return None
+
+    def add(self, phash: int, caption: str, model: str):
+        """Record a freshly generated caption."""
+        self._table(model).add(phash, caption)
+        try:
+            line = json.dumps({"phash": format_hash(phash), "caption": caption, "model": model})
+            with self._write_lock:
+                with self._log_lock(exclusive=False):
+                    with open(self.path, "a") as f:
+                        f.write(line + "\n")
+                self._log_lines += 1
+                self._maybe_compact()
+        except Exception as e:
+            logger.warning(f"Failed to persist caption index entry: {e}")
+
+    @contextmanager
+    def _log_lock(self, exclusive: bool):
+        """Hold the advisory lock that orders appends against compaction across processes."""
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _maybe_compact(self):
+        """Rewrite the log with one line per live entry once replaced lines dominate it."""
+        if self._log_lines < COMPACT_MIN_LINES or self._log_lines <= len(self) * COMPACT_FACTOR:
+            return
+        with self._log_lock(exclusive=True):
+            # Other workers append to the same log, so the file (not this process's
+            # tables) is the complete record; re-read it while no one can append
+            entries: Dict[Tuple[str, int], str] = {}
+            lines = 0
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        entries[(entry["model"], parse_hash(entry["phash"]))] = entry["caption"]
+                        lines += 1
+            self._log_lines = lines
+            if lines < COMPACT_MIN_LINES or lines <= len(entries) * COMPACT_FACTOR:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                for (model, phash), caption in entries.items():
+                    f.write(json.dumps({"phash": format_hash(phash), "caption": caption, "model": model}) + "\n")
+            os.replace(tmp_path, self.path)
+            self._log_lines = len(entries)
+        for (model, phash), caption in entries.items():
+            self._table(model).add(phash, caption)
+        logger.info(f"Compacted caption index log from {lines} to {len(entries)} lines")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self),
+            "entries_by_model": {model: len(table) for model, table in list(self.tables.items())},
+            "log_lines": self._log_lines,
+            "max_distance": self.max_distance,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# Global instance
+caption_index = CaptionIndex(
+    os.path.join(settings.data_dir, "captions.jsonl"),
+    settings.caption_index_max_distance
+)
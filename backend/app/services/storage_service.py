@@ -0,0 +1,346 @@
+import os
+import io
+import shutil
+import logging
+import mimetypes
+from typing import Optional, List, Dict, Any, Iterator
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class StorageError(Exception):
+    """Raised when a storage backend operation fails."""
+
+
+class StorageBackend:
+    """
+    Interface for object storage used by the file service.
+
+    Objects are addressed by slash-separated keys such as "images/abc.jpg"
+    or "audio/abc.wav", independent of where the bytes actually live.
+    """
+
+    name = "base"
+
+    def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> None:
+        """Store raw bytes under a key."""
+        raise NotImplementedError
+
+    def put_file(self, key: str, local_path: str, content_type: Optional[str] = None) -> None:
+        """Store the contents of a local file under a key."""
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        """Read the full object stored under a key."""
+        raise NotImplementedError
+
+    def stream(self, key: str, start: int = 0, end: Optional[int] = None,
+               chunk_size: int = 65536) -> Iterator[bytes]:
+        """Yield the object in chunks, optionally limited to the inclusive byte range [start, end]."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> bool:
+        """Delete an object. Returns False if it did not exist."""
+        raise NotImplementedError
+
+    def stat(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return size/modified/etag/content_type for an object, or None if missing."""
+        raise NotImplementedError
+
+    def list(self, prefix: str = "") -> List[Dict[str, Any]]:
+        """List objects under a prefix as dicts with key, size and modified."""
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        """Check whether an object exists."""
+        return self.stat(key) is not None
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Return a filesystem path for the object if the backend is local, else None."""
+        return None
+
+    def download_to(self, key: str, local_path: str) -> None:
+        """Copy an object to a local file."""
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        with open(local_path, "wb") as buffer:
+            for chunk in self.stream(key):
+                buffer.write(chunk)
+
+    def presigned_url(self, key: str, expires_in: Optional[int] = None) -> Optional[str]:
+        """Return a time-limited direct download URL, or None if unsupported."""
+        return None
+
+    @staticmethod
+    def guess_content_type(key: str) -> str:
+        """Guess a content type from the key's extension."""
+        return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+
+class LocalStorageBackend(StorageBackend):
+    """Storage backend keeping objects as plain files under a root directory."""
+
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        """Resolve a key to a path, refusing keys that escape the root."""
+        path = os.path.abspath(os.path.join(self.root, key))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            raise StorageError(f"Invalid storage key: {key}")
+        return path
+
+    def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as buffer:
+            buffer.write(data)
+        os.replace(tmp_path, path)
+
+    def put_file(self, key: str, local_path: str, content_type: Optional[str] = None) -> None:
+        path = self._path(key)
+        if os.path.abspath(local_path) == path:
+            # File was written in place, nothing to copy
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        shutil.copyfile(local_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise StorageError(f"Object not found: {key}")
+
+    def stream(self, key: str, start: int = 0, end: Optional[int] = None,
+               chunk_size: int = 65536) -> Iterator[bytes]:
+        try:
+            f = open(self._path(key), "rb")
+        except FileNotFoundError:
+            raise StorageError(f"Object not found: {key}")
+
+        with f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                size = chunk_size if remaining is None else min(chunk_size, remaining)
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, key: str) -> bool:
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+            return True
+        return False
+
+    def stat(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            st = os.stat(self._path(key))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return {
+            "key": key,
+            "size": st.st_size,
+            "modified": st.st_mtime,
+            "etag": f"{st.st_mtime_ns:x}-{st.st_size:x}",
+            "content_type": self.guess_content_type(key)
+        }
+
+    def list(self, prefix: str = "") -> List[Dict[str, Any]]:
+        objects = []
+        base = self._path(prefix) if prefix else self.root
+        search_root = base if os.path.isdir(base) else os.path.dirname(base)
+
+        for root, dirs, files in os.walk(search_root):
+            for file in files:
+                path = os.path.join(root, file)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if not key.startswith(prefix) or key.endswith(".tmp"):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                objects.append({"key": key, "size": st.st_size, "modified": st.st_mtime})
+
+        return objects
+
+    def local_path(self, key: str) -> Optional[str]:
+        return self._path(key)
+
+    def download_to(self, key: str, local_path: str) -> None:
+        if os.path.abspath(local_path) != self._path(key):
+            super().download_to(key, local_path)
+
+
+class S3StorageBackend(StorageBackend):
+    """
+    Storage backend for S3-compatible object stores (AWS S3, MinIO, R2, ...).
+
+    Uses a pooled boto3 client, managed multipart transfers for large files
+    and presigned URLs so that downloads can bypass the API process.
+    """
+
+    name = "s3"
+
+    def __init__(self):
+        try:
+            import boto3
+            from botocore.config import Config
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise StorageError("boto3 is required for the S3 storage backend")
+
+        if not settings.s3_bucket:
+            raise StorageError("S3_BUCKET must be set for the S3 storage backend")
+
+        self.bucket = settings.s3_bucket
+        self.prefix = settings.s3_prefix.strip("/")
+        self.presign_expiry = settings.s3_presign_expiry
+
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=settings.s3_endpoint_url,
+            region_name=settings.s3_region,
+            aws_access_key_id=settings.s3_access_key_id,
+            aws_secret_access_key=settings.s3_secret_access_key,
+            config=Config(
+                max_pool_connections=settings.s3_max_pool_connections,
+                retries={"max_attempts": 3, "mode": "standard"}
+            )
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.s3_multipart_threshold,
+            multipart_chunksize=settings.s3_multipart_chunksize,
+            max_concurrency=max(1, settings.s3_max_pool_connections // 4)
+        )
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _is_missing(self, error: Exception) -> bool:
+        code = getattr(error, "response", {}).get("Error", {}).get("Code", "")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> None:
+        # upload_fileobj switches to multipart above the configured threshold
+        self.client.upload_fileobj(
+            io.BytesIO(data),
+            self.bucket,
+            self._object_key(key),
+            ExtraArgs={"ContentType": content_type or self.guess_content_type(key)},
+            Config=self.transfer_config
+        )
+
+    def put_file(self, key: str, local_path: str, content_type: Optional[str] = None) -> None:
+        self.client.upload_file(
+            local_path,
+            self.bucket,
+            self._object_key(key),
+            ExtraArgs={"ContentType": content_type or self.guess_content_type(key)},
+            Config=self.transfer_config
+        )
+
+    def get(self, key: str) -> bytes:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except Exception as e:
+            if self._is_missing(e):
+                raise StorageError(f"Object not found: {key}")
+            raise
+        return response["Body"].read()
+
+    def stream(self, key: str, start: int = 0, end: Optional[int] = None,
+               chunk_size: int = 65536) -> Iterator[bytes]:
+        params = {"Bucket": self.bucket, "Key": self._object_key(key)}
+        if start or end is not None:
+            params["Range"] = f"bytes={start}-{'' if end is None else end}"
+        try:
+            response = self.client.get_object(**params)
+        except Exception as e:
+            if self._is_missing(e):
+                raise StorageError(f"Object not found: {key}")
+            raise
+
+        body = response["Body"]
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    def delete(self, key: str) -> bool:
+        if not self.exists(key):
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        return True
+
+    def stat(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except Exception as e:
+            if self._is_missing(e):
+                return None
+            raise
+        return {
+            "key": key,
+            "size": response["ContentLength"],
+            "modified": response["LastModified"].timestamp(),
+            "etag": response.get("ETag", "").strip('"'),
+            "content_type": response.get("ContentType") or self.guess_content_type(key)
+        }
+
+    def list(self, prefix: str = "") -> List[Dict[str, Any]]:
+        objects = []
+        strip = len(self.prefix) + 1 if self.prefix else 0
+        paginator = self.client.get_paginator("list_objects_v2")
+
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._object_key(prefix)):
+            for obj in page.get("Contents", []):
+                objects.append({
+                    "key": obj["Key"][strip:],
+                    "size": obj["Size"],
+                    "modified": obj["LastModified"].timestamp()
+                })
+
+        return objects
+
+    def download_to(self, key: str, local_path: str) -> None:
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        tmp_path = f"{local_path}.tmp"
+        self.client.download_file(
+            self.bucket, self._object_key(key), tmp_path, Config=self.transfer_config
+        )
+        os.replace(tmp_path, local_path)
+
+    def presigned_url(self, key: str, expires_in: Optional[int] = None) -> Optional[str]:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._object_key(key)},
+            ExpiresIn=expires_in or self.presign_expiry
+        )
+
+
+def create_storage_backend() -> StorageBackend:
+    """Create the storage backend selected by settings.storage_backend."""
+    backend = settings.storage_backend.lower()
+    if backend == "local":
+        return LocalStorageBackend(settings.upload_dir)
+    if backend == "s3":
+        return S3StorageBackend()
+    raise StorageError(f"Unknown storage backend: {settings.storage_backend}")
+
+
+# Global instance
+storage_backend = create_storage_backend()
@@ -0,0 +1,194 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+import logging
+from typing import Optional, Dict, Any, List, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Words as the unicode61 tokenizer splits them (it separates on underscores too)
+_QUERY_TERM = re.compile(r"[^\W_]+\*?")
+
+# Function words found in nearly every caption. Ranking reads a term's whole
+# posting list, so these would make a query slow without changing what it finds.
+STOPWORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "by", "for", "from", "in", "into", "is", "it", "its",
+    "of", "on", "or", "the", "their", "there", "to", "with"
+])
+
+
+def build_match_query(text: str) -> Optional[str]:
+    """
+    Turn free text into an FTS5 query matching stories that contain every word.
+
+    Words are quoted so FTS5 operators and punctuation in user input are never
+    interpreted; a trailing ``*`` on a word is kept as a prefix search.
+    Stopwords are dropped unless the text has nothing else.
+
+    Returns:
+        The MATCH expression, or None if the text has no searchable words
+    """
+    words = _QUERY_TERM.findall(text.lower())
+    words = [word for word in words if word not in STOPWORDS] or words
+    return " ".join(f'"{word[:-1]}"*' if word.endswith("*") else f'"{word}"' for word in words) or None
+
+
+class StoryStore:
+    """
+    Generated stories with a full-text index over their captions and titles.
+
+    There is at most one story per upload: adding a story for an upload that
+    already has one replaces it, so a retried batch does not index it twice.
+
+    Rows live in a plain table; an FTS5 table over the same rowids holds the
+    inverted index and is updated in the same transaction as each insert, so
+    a story is searchable as soon as it is returned. Story bodies are not
+    indexed: apart from the caption they are template text shared by every
+    story, which would only add huge posting lists and noise to the ranking.
+    """
+
+    # bm25 weights for the columns (caption, title, story_type)
+    RANK_WEIGHTS = (4.0, 1.0, 0.0)
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS stories (
+                id INTEGER PRIMARY KEY,
+                upload_id TEXT,
+                image_filename TEXT,
+                title TEXT NOT NULL,
+                content TEXT NOT NULL,
+                caption TEXT,
+                story_type TEXT NOT NULL,
+                model_used TEXT,
+                caption_source TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS stories_upload ON stories(upload_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS stories_fts USING fts5(
+                caption, title, story_type UNINDEXED,
+                content='stories', content_rowid='id',
+                tokenize='porter unicode61 remove_diacritics 2',
+                prefix='2 3'
+            );
+            INSERT INTO stories_fts (stories_fts, rank)
+                VALUES ('rank', 'bm25({", ".join(str(w) for w in self.RANK_WEIGHTS)})');
+            """
+        )
+
+    def add(self, story: Dict[str, Any], upload_id: Optional[str] = None,
+            image_filename: Optional[str] = None) -> int:
+        """
+        Persist a generated story and index it, replacing the upload's previous story.
+
+        Args:
+            story: Story data as returned by KosmosService
+            upload_id: Upload the story was generated for
+            image_filename: Stored image the story describes
+
+        Returns:
+            The story's id (unchanged when an existing story was replaced)
+        """
+        values = (image_filename, story["title"], story["content"], story.get("caption"), story["story_type"],
+                  story.get("model_used"), story.get("caption_source"), time.time())
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                existing = None
+                if upload_id is not None:
+                    existing = self._conn.execute(
+                        "SELECT id, caption, title, story_type FROM stories WHERE upload_id = ?", (upload_id,)
+                    ).fetchone()
+                if existing is None:
+                    story_id = self._conn.execute(
+                        "INSERT INTO stories (image_filename, title, content, caption, story_type, model_used, "
+                        "caption_source, created_at, upload_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        values + (upload_id,)
+                    ).lastrowid
+                else:
+                    story_id = existing["id"]
+                    # External content tables need the old values to remove a row's terms
+                    self._conn.execute(
+                        "INSERT INTO stories_fts (stories_fts, rowid, caption, title, story_type) "
+                        "VALUES ('delete', ?, ?, ?, ?)",
+                        (story_id, existing["caption"], existing["title"], existing["story_type"])
+                    )
+                    self._conn.execute(
+                        "UPDATE stories SET image_filename = ?, title = ?, content = ?, caption = ?, story_type = ?, "
+                        "model_used = ?, caption_source = ?, created_at = ? WHERE id = ?",
+                        values + (story_id,)
+                    )
+                self._conn.execute(
+                    "INSERT INTO stories_fts (rowid, caption, title, story_type) VALUES (?, ?, ?, ?)",
+                    (story_id, story.get("caption"), story["title"], story["story_type"])
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return story_id
+
+    def _matches(self, query: str, story_type: Optional[str], columns: str = "rowid") -> Tuple[str, List[Any]]:
+        """SQL selecting matching rows and its parameters."""
+        sql = f"SELECT {columns} FROM stories_fts WHERE stories_fts MATCH ?"
+        params: List[Any] = [query]
+        if story_type is not None:
+            # Checked per matching row rather than matched as a term: bm25 scans the whole
+            # posting list of every term in the query, and a story type is in half of them
+            sql += " AND story_type = ?"
+            params.append(story_type)
+        return sql, params
+
+    def search(self, query: str, limit: int = 10, offset: int = 0,
+               story_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Find stories matching a MATCH expression (see build_match_query), best first.
+
+        Every match is ranked, so an old story that matches well is not pushed out
+        by newer, weaker ones; ties go to the newest story.
+
+        Args:
+            query: FTS5 MATCH expression
+            limit: Page size
+            offset: Number of results to skip
+            story_type: Only return stories of this type
+
+        Returns:
+            Story rows with a relevance score (higher is better)
+        """
+        matches, params = self._matches(query, story_type, columns="rowid, rank")
+        # Only the requested page of rowids is joined back to the stories table
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s.*, -page.rank AS score FROM ("
+                f"  {matches} ORDER BY rank, rowid DESC LIMIT ? OFFSET ?"
+                ") page JOIN stories s ON s.id = page.rowid ORDER BY page.rank, page.rowid DESC",
+                params + [limit, offset]
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self, query: str, story_type: Optional[str] = None) -> int:
+        """Number of stories matching a MATCH expression."""
+        matches, params = self._matches(query, story_type)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM ({matches})", params).fetchone()[0]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) AS stories, MAX(id) AS last_id FROM stories").fetchone()
+        return dict(row)
+
+
+# Global instance
+story_store = StoryStore(os.path.join(settings.data_dir, "stories.db"))
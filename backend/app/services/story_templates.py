@@ -0,0 +1,127 @@
+import re
+from typing import List, NamedTuple, Optional, Tuple
+
+# The placeholder replaced by the image description
+DESCRIPTION = "{description}"
+
+STORY_TEMPLATES = [
+    "In a world where magic meets reality, {description}. The air was filled with excitement as friends gathered for an adventure that would change their lives forever. Each person brought their own unique energy to the group, creating a bond that transcended ordinary friendship. As they stood together, they knew this moment would be remembered for years to come, a testament to the power of connection and shared joy.",
+
+    "The photograph captures {description}, but there's more to this story than meets the eye. Behind the smiles and laughter lies a tale of friendship that began years ago. These companions had traveled far and wide, collecting memories like precious gems. Today marked another chapter in their ongoing adventure, where every moment was a celebration of life itself.",
+
+    "Once upon a time, in a place where dreams come alive, {description}. The scene was set for an extraordinary day filled with wonder and discovery. Each person in the group carried stories of their own, and together they created something magical. The bonds they shared were stronger than any challenge they might face, and their joy was infectious to all who witnessed it.",
+]
+
+POEM_TEMPLATES = [
+    """In colors bright and spirits high,
+{description} beneath the sky.
+Friends together, hearts so true,
+Creating memories, fresh and new.
+
+Laughter echoes through the air,
+Joy and wonder everywhere.
+In this moment, time stands still,
+Hearts with happiness they fill.""",
+
+    """A picture worth a thousand words,
+{description} like singing birds.
+Together standing, side by side,
+With friendship as their faithful guide.
+
+The world around them seems to glow,
+With warmth that only true friends know.
+In this snapshot of pure delight,
+Everything feels just right.""",
+
+    """Captured here in vibrant hue,
+{description}, a friendship true.
+Smiles that light the darkest day,
+Hearts that chase all fears away.
+
+In this moment, frozen time,
+Life itself becomes a rhyme.
+Friends united, spirits free,
+Pure joy for all to see."""
+]
+
+# Same boundaries as tts_service.split_sentences, so per-sentence narration also matches
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def fill_template(template: str, description: str) -> str:
+    """Insert a description into a template (descriptions may contain braces, so no str.format)."""
+    return template.replace(DESCRIPTION, description)
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+class TemplatePiece(NamedTuple):
+    """A span of narration text; fixed spans are the same for every story using the template."""
+    text: str
+    fixed: bool
+
+
+def _build_patterns() -> List[Tuple[str, Optional[str]]]:
+    """
+    (prefix, suffix) patterns for every template and every template sentence.
+
+    Sentences without the placeholder are exact patterns with suffix None.
+    Longer patterns come first so a whole story matches before its first sentence.
+    """
+    patterns = set()
+    for template in STORY_TEMPLATES + POEM_TEMPLATES:
+        units = [template] + [part for part in _SENTENCE_BOUNDARY.split(template) if part.strip()]
+        for unit in units:
+            unit = _normalize(unit)
+            if DESCRIPTION in unit:
+                prefix, suffix = unit.split(DESCRIPTION, 1)
+                patterns.add((prefix, suffix))
+            else:
+                patterns.add((unit, None))
+    return sorted(patterns, key=lambda p: len(p[0]) + len(p[1] or ""), reverse=True)
+
+
+_PATTERNS = _build_patterns()
+
+
+def match_template(text: str) -> Optional[List[TemplatePiece]]:
+    """
+    Split narration text into fixed template spans and the variable description.
+
+    Matches whole stories and poems as well as single sentences or lines of
+    them, as sent by per-sentence narration.
+
+    Returns:
+        Pieces in reading order, or None if the text doesn't come from a known template
+    """
+    normalized = _normalize(text)
+    for prefix, suffix in _PATTERNS:
+        if suffix is None:
+            if normalized == prefix:
+                return [TemplatePiece(prefix, True)]
+            continue
+        if len(normalized) <= len(prefix) + len(suffix):
+            continue
+        if normalized.startswith(prefix) and normalized.endswith(suffix):
+            description = normalized[len(prefix):len(normalized) - len(suffix)]
+            if not description.strip():
+                continue
+            pieces = [
+                TemplatePiece(prefix, True),
+                TemplatePiece(description, False),
+                TemplatePiece(suffix, True)
+            ]
+            return [piece for piece in pieces if piece.text.strip()]
+    return None
+
+
+def fixed_spans() -> List[str]:
+    """All fixed template text that match_template can return, for pre-synthesis."""
+    spans = set()
+    for prefix, suffix in _PATTERNS:
+        spans.add(prefix)
+        if suffix is not None:
+            spans.add(suffix)
+    return sorted(span for span in spans if span.strip())
@@ -0,0 +1,207 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Pause inserted between spliced pieces, by the punctuation at the boundary
+BOUNDARY_PAUSES = {".": 0.35, "!": 0.35, "?": 0.35, ",": 0.15, ";": 0.2, ":": 0.2}
+DEFAULT_PAUSE = 0.06
+FADE_SECONDS = 0.012
+SILENCE_THRESHOLD = 0.01  # fraction of the peak amplitude treated as silence when trimming
+EDGE_PADDING_SECONDS = 0.02
+MAX_GAIN = 2.0
+
+
+def boundary_pause(left_text: str, right_text: str) -> float:
+    """Pause length implied by the punctuation where two pieces of text meet."""
+    left = left_text.rstrip()[-1:]
+    right = right_text.lstrip()[:1]
+    return max(BOUNDARY_PAUSES.get(left, 0.0), BOUNDARY_PAUSES.get(right, 0.0)) or DEFAULT_PAUSE
+
+
+def _trim_silence(wav: Any, sample_rate: int) -> Any:
+    """Cut leading and trailing silence, keeping a little padding."""
+    import numpy as np
+
+    if wav.size == 0:
+        return wav
+    peak = float(np.max(np.abs(wav)))
+    if peak == 0:
+        return wav[:0]
+    voiced = np.flatnonzero(np.abs(wav) > peak * SILENCE_THRESHOLD)
+    padding = int(EDGE_PADDING_SECONDS * sample_rate)
+    return wav[max(0, voiced[0] - padding):voiced[-1] + 1 + padding]
+
+
+def _fade_edges(wav: Any, sample_rate: int) -> Any:
+    """Raised-cosine fade in and out so pieces don't click where they are joined."""
+    import numpy as np
+
+    wav = wav.copy()
+    length = min(int(FADE_SECONDS * sample_rate), wav.size // 2)
+    if length > 0:
+        ramp = 0.5 - 0.5 * np.cos(np.linspace(0, np.pi, length, dtype=np.float32))
+        wav[:length] *= ramp
+        wav[-length:] *= ramp[::-1]
+    return wav
+
+
+def _rms(wav: Any) -> float:
+    import numpy as np
+
+    return float(np.sqrt(np.mean(np.square(wav)))) if wav.size else 0.0
+
+
+def splice(segments: List[Tuple[str, Any, bool]], sample_rate: int) -> Any:
+    """
+    Join separately synthesized pieces into one narration.
+
+    Each piece is trimmed of silence and faded at its edges, pieces are
+    separated by a pause matching the punctuation between them, and variable
+    pieces are gain-matched to the loudness of the fixed ones around them.
+
+    Args:
+        segments: (text, samples, fixed) for each piece in reading order;
+            pieces with no samples only contribute their punctuation
+        sample_rate: Sample rate of all pieces
+
+    Returns:
+        Mono float32 samples
+    """
+    import numpy as np
+
+    fixed_levels = [_rms(wav) for _, wav, fixed in segments if fixed and wav is not None and wav.size]
+    target_level = float(np.mean(fixed_levels)) if fixed_levels else 0.0
+
+    parts = []
+    previous_text = ""  # text since the start of the last voiced piece
+    for text, wav, fixed in segments:
+        if wav is None:
+            previous_text += text
+            continue
+        if parts:
+            pause = boundary_pause(previous_text, text)
+            parts.append(np.zeros(int(pause * sample_rate), dtype=np.float32))
+        previous_text = text
+
+        wav = _trim_silence(np.asarray(wav, dtype=np.float32), sample_rate)
+        if not fixed and target_level:
+            level = _rms(wav)
+            if level:
+                wav = wav * min(MAX_GAIN, max(1 / MAX_GAIN, target_level / level))
+        parts.append(_fade_edges(wav, sample_rate))
+
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+
+
+class FragmentCache:
+    """
+    Synthesized audio for fixed narration text, e.g. the template spans of stories.
+
+    Fragments are kept in memory (LRU bounded by bytes) and as float32 .npy
+    PCM files under data_dir, so each span is synthesized once per voice.
+    """
+
+    def __init__(self, root: str, memory_bytes: int):
+        self.root = root
+        self.memory_bytes = memory_bytes
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._memory_used = 0
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:32]
+
+    def get_or_synthesize(self, key: str, synthesize: Callable[[], Any]) -> Any:
+        """Get a fragment's samples, synthesizing them once on a miss."""
+        with self._lock:
+            wav = self._memory.get(key)
+            if wav is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return wav
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        # Concurrent misses for the same fragment synthesize it only once
+        with key_lock:
+            with self._lock:
+                wav = self._memory.get(key)
+            if wav is not None:
+                with self._lock:
+                    self.hits += 1
+                return wav
+
+            try:
+                wav, hit = self._load_or_synthesize(key, synthesize)
+            finally:
+                with self._lock:
+                    self._locks.pop(key, None)
+
+            with self._lock:
+                if hit:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                self._remember(key, wav)
+            return wav
+
+    def _load_or_synthesize(self, key: str, synthesize: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Read a fragment from disk, or synthesize and persist it. Returns (samples, was on disk)."""
+        import numpy as np
+
+        path = os.path.join(self.root, f"{key}.npy")
+        try:
+            return np.load(path), True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Discarding unreadable narration fragment {path}: {e}")
+
+        wav = np.asarray(synthesize(), dtype=np.float32)
+        try:
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, wav)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Failed to persist narration fragment: {e}")
+        return wav, False
+
+    def _remember(self, key: str, wav: Any):
+        """Add to the memory tier; caller holds the lock."""
+        if wav.nbytes > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= previous.nbytes
+        self._memory[key] = wav
+        self._memory_used += wav.nbytes
+        while self._memory_used > self.memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_used -= old.nbytes
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_mb": round(self._memory_used / (1024 * 1024), 1),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+# Global instance
+fragment_cache = FragmentCache(
+    os.path.join(settings.data_dir, "tts_fragments"),
+    settings.tts_fragment_cache_mb * 1024 * 1024
+)
@@ -1,109 +1,372 @@
+import io
 import os
+import re
 import time
+import threading
 import logging
-from typing import Optional, Dict, Any, List
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple
 from app.core.config import settings
+from app.core.lazy import LazyService
+from app.services.voice_service import voice_service
+from app.services.device_service import device_manager
+from app.core.cpu_topology import cpu_topology
+from app.core.tracing import trace_span, current_span
+from app.services.story_templates import TemplatePiece, match_template, fixed_spans
+from app.services.tts_fragments import fragment_cache, splice
 
 logger = logging.getLogger(__name__)
 
+# soundfile (libsndfile) container and codec for each output format
+AUDIO_ENCODINGS = {
+    "wav": ("WAV", "PCM_16"),
+    "flac": ("FLAC", "PCM_16"),
+    "ogg": ("OGG", "VORBIS"),
+    "opus": ("OGG", "OPUS"),
+    "mp3": ("MP3", "MPEG_LAYER_III")
+}
+
+# Opus only supports these sample rates
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+
+
+class AudioEncodingError(Exception):
+    """Raised when synthesized audio cannot be encoded in the requested format."""
+
+
+@lru_cache(maxsize=None)
+def encodable_formats() -> Tuple[str, ...]:
+    """Output formats whose container and codec the installed libsndfile can write."""
+    try:
+        import soundfile as sf
+    except ImportError:
+        return ()
+
+    containers = sf.available_formats()
+    return tuple(
+        fmt for fmt, (container, subtype) in AUDIO_ENCODINGS.items()
+        if container in containers and subtype in sf.available_subtypes(container)
+    )
+
+
+# Sentence boundaries used to synthesize long texts incrementally
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split story or poem text into sentences (or lines) for incremental synthesis."""
+    return [part.strip() for part in SENTENCE_BOUNDARY.split(text) if part and part.strip()]
+
+
+def mock_synthesize(text: str) -> Tuple[Any, int]:
+    """Produce silence of roughly the spoken length when no TTS model is available."""
+    import numpy as np
+
+    duration = len(text) * 0.1  # Rough estimate, matches mock generation
+    return np.zeros(int(duration * settings.audio_sample_rate), dtype=np.float32), settings.audio_sample_rate
+
 
 class TTSService:
+    FALLBACK_MODEL_PATH = "tts_models/en/ljspeech/tacotron2-DDC"
+    
     def __init__(self):
         self.tts = None
-        self.device = self._get_device()
+        self.model_path = None
+        self.device = "cpu"
+        self._cpu_replica = None
+        self._replica_lock = threading.Lock()
         self._load_model()
     
-    def _get_device(self) -> str:
-        """Determine the best device to use for TTS."""
-        if settings.device == "auto":
-            try:
-                import torch
-                return "cuda" if torch.cuda.is_available() else "cpu"
-            except ImportError:
-                return "cpu"
-        return "cpu" if settings.device == "cpu" else "cuda"
-    
     def _load_model(self):
         """Load the XTTS-v2 model."""
+        cpu_topology.configure_torch()
+        
         try:
             from TTS.api import TTS
-            import soundfile as sf
-            import numpy as np
             
+            self.device = device_manager.place_model("xtts")
             logger.info(f"Loading XTTS-v2 model on {self.device}...")
-            self.tts = TTS(
-                model_name=settings.xtts_model_path,
-                gpu=self.device == "cuda"
-            )
+            self.tts = TTS(model_name=settings.xtts_model_path).to(self.device)
+            self.model_path = settings.xtts_model_path
             logger.info("XTTS-v2 model loaded successfully!")
         except Exception as e:
             logger.error(f"Failed to load XTTS-v2 model: {e}")
+            device_manager.release_model("xtts")
+            self.device = "cpu"
             # Fallback to a simpler TTS model if XTTS fails
             try:
                 from TTS.api import TTS
                 logger.info("Falling back to simpler TTS model...")
-                self.tts = TTS(model_name="tts_models/en/ljspeech/tacotron2-DDC")
+                self.tts = TTS(model_name=self.FALLBACK_MODEL_PATH)
+                self.model_path = self.FALLBACK_MODEL_PATH
                 logger.info("Fallback TTS model loaded successfully!")
             except Exception as fallback_error:
                 logger.error(f"Failed to load fallback TTS model: {fallback_error}")
                 logger.warning("TTS will not be available - using mock service")
                 self.tts = None
     
-    def generate_audio(self, text: str, output_path: str, voice: str = "default") -> Dict[str, Any]:
+    def generate_audio(self, text: str, output_path: str, voice: str = "default",
+                       audio_format: Optional[str] = None) -> Dict[str, Any]:
         """
         Generate audio narration from text.
         
         Args:
             text: Text to convert to speech
             output_path: Path where to save the audio file
-            voice: Voice to use (for future enhancement)
+            voice: Built-in or registered voice name
+            audio_format: Output format (wav, flac, ogg, opus, mp3); defaults to settings.audio_format
             
         Returns:
             Dictionary containing audio generation metadata
         """
+        audio_format = self.resolve_format(audio_format)
+        with trace_span("tts.generate_audio", voice=voice, format=audio_format, chars=len(text)):
+            return self._generate_audio(text, output_path, voice, audio_format)
+    
+    def _generate_audio(self, text: str, output_path: str, voice: str, audio_format: str) -> Dict[str, Any]:
         start_time = time.time()
         
+        if self.tts is None:
+            # Fallback to mock generation
+            return self._mock_generate_audio(text, output_path, voice, start_time, audio_format)
+        
         try:
-            if self.tts is None:
-                # Fallback to mock generation
-                return self._mock_generate_audio(text, output_path, voice, start_time)
-            
-            # Clean the text for better TTS
-            cleaned_text = self._clean_text_for_tts(text)
-            
-            # Generate audio
-            if hasattr(self.tts, 'tts_to_file'):
-                # For newer TTS versions
-                self.tts.tts_to_file(
-                    text=cleaned_text,
-                    file_path=output_path
-                )
-            else:
-                # For older TTS versions
-                import soundfile as sf
-                wav = self.tts.tts(text=cleaned_text)
-                sf.write(output_path, wav, settings.audio_sample_rate)
+            wav, sample_rate = self.synthesize(text, voice)
+        except Exception as e:
+            logger.error(f"Error generating audio: {e}")
+            # Fallback to mock generation
+            return self._mock_generate_audio(text, output_path, voice, start_time, audio_format)
+        
+        # Encoding errors are raised: a placeholder file would be served as audio that cannot be played
+        audio_bytes, sample_rate = self.encode_audio(wav, sample_rate, audio_format)
+        
+        with trace_span("tts.write", bytes=len(audio_bytes)):
+            with open(output_path, "wb") as f:
+                f.write(audio_bytes)
+        
+        generation_time = time.time() - start_time
+        
+        return {
+            "audio_path": output_path,
+            "generation_time": generation_time,
+            "model_used": "xtts-v2",
+            "duration": len(wav) / sample_rate if sample_rate else 0,
+            "file_size": len(audio_bytes),
+            "sample_rate": sample_rate,
+            "format": audio_format
+        }
+    
+    def synthesize(self, text: str, voice: str = "default") -> Tuple[Any, int]:
+        """
+        Synthesize speech to a float PCM array.
+        
+        Args:
+            text: Text to convert to speech
+            voice: Voice to use
             
-            generation_time = time.time() - start_time
+        Returns:
+            Tuple of (mono float32 samples, sample rate)
+        """
+        with trace_span("tts.synthesize", voice=voice, chars=len(text)):
+            if self.tts is None:
+                return mock_synthesize(text)
+            return self._synthesize(text, voice)
+    
+    def _synthesize(self, text: str, voice: str) -> Tuple[Any, int]:
+        if settings.tts_fragment_cache_enabled:
+            pieces = match_template(text)
+            if pieces is not None:
+                try:
+                    return self._synthesize_spliced(pieces, voice)
+                except Exception as e:
+                    logger.warning(f"Spliced synthesis failed, synthesizing the full text: {e}")
+        
+        return self._synthesize_text(self._clean_text_for_tts(text), voice)
+    
+    def _synthesize_spliced(self, pieces: List[TemplatePiece], voice: str) -> Tuple[Any, int]:
+        """
+        Synthesize templated text by splicing cached audio of the fixed
+        template spans around freshly synthesized audio of the description.
+        """
+        sample_rate = self._output_sample_rate()
+        segments = []
+        
+        with trace_span("tts.splice", pieces=len(pieces)) as span:
+            for piece in pieces:
+                # Leading punctuation only sets the pause before the piece
+                speech = self._clean_text_for_tts(piece.text.lstrip(" .,;:!?"), complete_sentence=False)
+                if not re.search(r"\w", speech):
+                    segments.append((piece.text, None, piece.fixed))
+                    continue
+                if piece.fixed:
+                    wav = fragment_cache.get_or_synthesize(
+                        self._fragment_key(speech, voice),
+                        lambda speech=speech: self._synthesize_text(speech, voice)[0]
+                    )
+                else:
+                    wav, _ = self._synthesize_text(speech, voice)
+                    span.set_attribute("synthesized_chars", len(speech))
+                segments.append((piece.text, wav, piece.fixed))
             
-            # Get audio file info
-            audio_info = self._get_audio_info(output_path)
+            return splice(segments, sample_rate), sample_rate
+    
+    def _fragment_key(self, text: str, voice: str) -> str:
+        """Cache key for fixed text in a voice; changes when the model or the voice's references change."""
+        voice_version = voice_service.get_reference_hash(voice) or settings.tts_builtin_voices.get(voice, "")
+        return fragment_cache.make_key(self.model_path or "", voice, voice_version, settings.tts_language, text)
+    
+    def prewarm_fragments(self, voice: str = "default"):
+        """Synthesize the fixed spans of every story and poem template ahead of the first request."""
+        if self.tts is None:
+            return
+        with trace_span("tts.prewarm_fragments", voice=voice):
+            for text in fixed_spans():
+                speech = self._clean_text_for_tts(text.lstrip(" .,;:!?"), complete_sentence=False)
+                if re.search(r"\w", speech):
+                    fragment_cache.get_or_synthesize(
+                        self._fragment_key(speech, voice),
+                        lambda speech=speech: self._synthesize_text(speech, voice)[0]
+                    )
+        logger.info(f"Pre-synthesized template narration for voice '{voice}'")
+    
+    def _synthesize_text(self, cleaned_text: str, voice: str) -> Tuple[Any, int]:
+        """Synthesize cleaned text, retrying on CPU if the accelerator runs out of memory."""
+        with device_manager.acquire("xtts") as device:
+            current_span().set_attribute("device", device)
+            try:
+                return self._synthesize_with(self._get_tts_for_device(device), cleaned_text, voice)
+            except Exception as e:
+                if device == "cpu" or not device_manager.is_out_of_memory(e):
+                    raise
+                device_manager.release_cached_memory(device)
+                device_manager.record_fallback("xtts", "out of memory")
+        
+        current_span().set_attribute("device", "cpu")
+        return self._synthesize_with(self._get_tts_for_device("cpu"), cleaned_text, voice)
+    
+    def _get_tts_for_device(self, device: str) -> Any:
+        """Get the TTS instance living on a device, loading a CPU replica on first fallback."""
+        if device == self.device:
+            return self.tts
+        if self._cpu_replica is None:
+            # Concurrent fallbacks wait for one load instead of each loading a copy
+            with self._replica_lock:
+                if self._cpu_replica is None:
+                    from TTS.api import TTS
+                    logger.info("Loading CPU replica of TTS model for fallback requests...")
+                    self._cpu_replica = TTS(model_name=self.model_path).to("cpu")
+        return self._cpu_replica
+    
+    def _synthesize_with(self, tts: Any, cleaned_text: str, voice: str) -> Tuple[Any, int]:
+        """Run synthesis on a specific TTS instance."""
+        import numpy as np
+        
+        xtts_model = self._get_xtts_model(tts)
+        
+        if xtts_model is not None and voice_service.has_voice(voice):
+            # Cloned voice: reuse cached conditioning instead of re-encoding the reference clips
+            gpt_cond_latent, speaker_embedding = voice_service.get_conditioning(voice, xtts_model)
+            output = xtts_model.inference(
+                cleaned_text,
+                settings.tts_language,
+                gpt_cond_latent,
+                speaker_embedding
+            )
+            wav = output["wav"]
+            if hasattr(wav, "cpu"):
+                wav = wav.cpu().numpy()
+        elif xtts_model is not None:
+            # Built-in speakers ship with precomputed conditioning
+            speaker = settings.tts_builtin_voices.get(voice, settings.tts_builtin_voices.get("default"))
+            wav = tts.tts(text=cleaned_text, speaker=speaker, language=settings.tts_language)
+        else:
+            wav = tts.tts(text=cleaned_text)
+        
+        return np.asarray(wav, dtype=np.float32), self._output_sample_rate()
+    
+    def _get_xtts_model(self, tts: Optional[Any] = None) -> Optional[Any]:
+        """Get the underlying XTTS model if the loaded model supports voice conditioning."""
+        synthesizer = getattr(tts or self.tts, "synthesizer", None)
+        model = getattr(synthesizer, "tts_model", None)
+        if model is not None and hasattr(model, "get_conditioning_latents"):
+            return model
+        return None
+    
+    def register_voice(self, name: str, clips: List[Tuple[str, bytes]]) -> Dict[str, Any]:
+        """
+        Register a custom voice and precompute its conditioning if the model is loaded.
+        
+        Args:
+            name: Voice name used in generation requests
+            clips: List of (original filename, audio bytes) reference clips
             
-            return {
-                "audio_path": output_path,
-                "generation_time": generation_time,
-                "model_used": "xtts-v2",
-                "duration": audio_info.get("duration", 0),
-                "sample_rate": settings.audio_sample_rate,
-                "format": settings.audio_format
-            }
+        Returns:
+            Voice registration details
+        """
+        voice_service.register_voice(name, clips)
+        
+        xtts_model = self._get_xtts_model()
+        if xtts_model is not None:
+            voice_service.get_conditioning(name, xtts_model)
+        
+        return {
+            "voice": name,
+            "reference_clips": len(clips),
+            "conditioning_cached": xtts_model is not None
+        }
+    
+    @staticmethod
+    def encode_audio(wav: Any, sample_rate: int, audio_format: str) -> Tuple[bytes, int]:
+        """
+        Encode PCM samples into the requested container/codec.
+        
+        Args:
+            wav: Mono float32 samples
+            sample_rate: Sample rate of the samples
+            audio_format: Output format key from AUDIO_ENCODINGS
             
-        except Exception as e:
-            logger.error(f"Error generating audio: {e}")
-            # Fallback to mock generation
-            return self._mock_generate_audio(text, output_path, voice, start_time)
+        Returns:
+            Tuple of (encoded bytes, sample rate of the encoded audio)
+        
+        Raises:
+            AudioEncodingError: If the samples cannot be encoded in that format
+        """
+        container, subtype = AUDIO_ENCODINGS[audio_format]
+        
+        with trace_span("tts.encode", format=audio_format) as span:
+            try:
+                import soundfile as sf
+                
+                if audio_format == "opus" and sample_rate not in OPUS_SAMPLE_RATES:
+                    import librosa
+                    wav = librosa.resample(wav, orig_sr=sample_rate, target_sr=24000)
+                    sample_rate = 24000
+                
+                buffer = io.BytesIO()
+                sf.write(buffer, wav, sample_rate, format=container, subtype=subtype)
+            except Exception as e:
+                raise AudioEncodingError(f"Failed to encode audio as {audio_format}: {e}") from e
+            span.set_attribute("bytes", buffer.tell())
+            return buffer.getvalue(), sample_rate
+    
+    def resolve_format(self, audio_format: Optional[str]) -> str:
+        """Validate a requested output format, falling back to the configured default."""
+        audio_format = (audio_format or settings.audio_format).lower()
+        if audio_format not in self.get_supported_formats():
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+        return audio_format
+    
+    def get_supported_formats(self) -> List[str]:
+        """Get the enabled output formats the installed libsndfile can encode."""
+        return [fmt for fmt in settings.audio_formats if fmt in encodable_formats()]
     
-    def _mock_generate_audio(self, text: str, output_path: str, voice: str, start_time: float) -> Dict[str, Any]:
+    def _output_sample_rate(self) -> int:
+        """Get the native sample rate of the loaded TTS model."""
+        synthesizer = getattr(self.tts, "synthesizer", None)
+        return getattr(synthesizer, "output_sample_rate", None) or settings.audio_sample_rate
+    
+    def _mock_generate_audio(self, text: str, output_path: str, voice: str, start_time: float,
+                             audio_format: str) -> Dict[str, Any]:
         """Generate mock audio file when TTS is not available."""
         try:
             # Create a placeholder audio file
@@ -120,14 +383,19 @@ class TTSService:
                 "model_used": "mock-tts-v1",
                 "duration": len(text) * 0.1,  # Rough estimate
                 "sample_rate": settings.audio_sample_rate,
-                "format": settings.audio_format
+                "format": audio_format
             }
         except Exception as e:
             logger.error(f"Error in mock audio generation: {e}")
             raise
     
-    def _clean_text_for_tts(self, text: str) -> str:
-        """Clean text to improve TTS quality."""
+    def _clean_text_for_tts(self, text: str, complete_sentence: bool = True) -> str:
+        """
+        Clean text to improve TTS quality.
+        
+        With complete_sentence off (for spans spliced into a longer narration)
+        no placeholder text or final period is added.
+        """
         # Remove or replace problematic characters
         text = text.replace('"', '')
         text = text.replace('"', '')
@@ -157,6 +425,9 @@ class TTSService:
         text = re.sub(r'\s+', ' ', text)
         text = text.strip()
         
+        if not complete_sentence:
+            return text
+        
         # Ensure proper sentence structure
         if not text:
             text = "This is a beautiful image that captures a wonderful moment."
@@ -182,13 +453,17 @@ class TTSService:
                 # Get file size
                 file_size = os.path.getsize(audio_path)
                 
-                # Try to get duration using soundfile
+                # Try to get duration using soundfile (wav, flac, ogg/opus and mp3 on libsndfile >= 1.1)
                 try:
                     import soundfile as sf
-                    with sf.SoundFile(audio_path) as f:
-                        duration = len(f) / f.samplerate
-                except:
-                    duration = 0
+                    duration = sf.info(audio_path).duration
+                except Exception:
+                    # Older libsndfile builds cannot read mp3, let librosa decode it
+                    try:
+                        import librosa
+                        duration = librosa.get_duration(path=audio_path)
+                    except Exception:
+                        duration = 0
                 
                 return {
                     "file_size": file_size,
@@ -204,9 +479,8 @@ class TTSService:
         return self.tts is not None
     
     def get_available_voices(self) -> List[str]:
-        """Get list of available voices (for future enhancement)."""
-        # This is a placeholder for future voice selection feature
-        return ["default", "female", "male"]
+        """Get list of available voices: built-in speakers plus registered clones."""
+        return list(settings.tts_builtin_voices) + voice_service.list_voices()
 
 
 class MockTTSService:
@@ -222,9 +496,40 @@ class MockTTSService:
     
     def get_available_voices(self) -> List[str]:
         """Get list of available voices."""
-        return ["default", "female", "male"]
+        return ["default", "female", "male"] + voice_service.list_voices()
+    
+    def prewarm_fragments(self, voice: str = "default"):
+        """Nothing to pre-synthesize without a model."""
+        pass
+    
+    def register_voice(self, name: str, clips: List[Tuple[str, bytes]]) -> Dict[str, Any]:
+        """Register a custom voice; conditioning is computed once a real model is available."""
+        voice_service.register_voice(name, clips)
+        return {
+            "voice": name,
+            "reference_clips": len(clips),
+            "conditioning_cached": False
+        }
     
-    def generate_audio(self, text: str, output_path: str, voice: str = "default") -> Dict:
+    def get_supported_formats(self) -> List[str]:
+        """Get the enabled output formats the installed libsndfile can encode."""
+        return [fmt for fmt in settings.audio_formats if fmt in encodable_formats()]
+    
+    def synthesize(self, text: str, voice: str = "default") -> Tuple[Any, int]:
+        """Mock synthesis - returns silence."""
+        return mock_synthesize(text)
+    
+    encode_audio = staticmethod(TTSService.encode_audio)
+    
+    def resolve_format(self, audio_format: Optional[str]) -> str:
+        """Validate a requested output format, falling back to the configured default."""
+        audio_format = (audio_format or settings.audio_format).lower()
+        if audio_format not in self.get_supported_formats():
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+        return audio_format
+    
+    def generate_audio(self, text: str, output_path: str, voice: str = "default",
+                       audio_format: Optional[str] = None) -> Dict:
         """
         Mock audio generation - creates a placeholder file.
         
@@ -232,6 +537,7 @@ class MockTTSService:
             text: Text to convert to speech
             output_path: Path where audio file should be saved
             voice: Voice to use for generation
+            audio_format: Requested output format
         
         Returns:
             Generation result with metadata
@@ -254,7 +560,8 @@ class MockTTSService:
                 "model_used": "mock-tts-v1",
                 "duration": len(text) * 0.1,  # Rough estimate: 0.1s per character
                 "voice_used": voice,
-                "output_path": output_path
+                "output_path": output_path,
+                "format": audio_format or settings.audio_format
             }
             
         except Exception as e:
@@ -262,9 +569,14 @@ class MockTTSService:
             raise Exception(f"Mock TTS generation failed: {e}")
 
 
-# Try to use real TTS service, fallback to mock if not available
-try:
-    tts_service = TTSService()
-except Exception as e:
-    logger.warning(f"Failed to initialize TTS service, using mock: {e}")
-    tts_service = MockTTSService() 
\ No newline at end of file
+def _create_tts_service():
+    """Try to use real TTS service, fallback to mock if not available."""
+    try:
+        return TTSService()
+    except Exception as e:
+        logger.warning(f"Failed to initialize TTS service, using mock: {e}")
+        return MockTTSService()
+
+
+# Global instance, constructed (and model loaded) on first use
+tts_service = LazyService(_create_tts_service, "tts") 
\ No newline at end of file
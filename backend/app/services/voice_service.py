@@ -0,0 +1,205 @@
+import os
+import re
+import json
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+import logging
+from typing import Optional, Dict, Any, List, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+VOICE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+REFERENCE_EXTENSIONS = ["wav", "flac", "ogg", "mp3"]
+
+
+class VoiceService:
+    """
+    Registry of custom narration voices for XTTS-v2 voice cloning.
+
+    Reference clips are registered once. Their conditioning latents and speaker
+    embedding are computed on first use and cached in memory and on disk, so
+    later syntheses with the same voice skip the speaker encoder entirely.
+    """
+
+    def __init__(self):
+        self.voices_dir = os.path.join(settings.data_dir, "voices")
+        self.registry_path = os.path.join(self.voices_dir, "voices.json")
+        self._latents: Dict[str, Tuple[Any, Any]] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.voices_dir, exist_ok=True)
+        self._registry = self._load_registry()
+
+    def _load_registry(self) -> Dict[str, Dict[str, Any]]:
+        """Load registered voices from disk."""
+        try:
+            if os.path.exists(self.registry_path):
+                with open(self.registry_path, "r") as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load voice registry: {e}")
+        return {}
+
+    def _save_registry(self):
+        """Persist registered voices atomically."""
+        tmp_path = f"{self.registry_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._registry, f, indent=2)
+        os.replace(tmp_path, self.registry_path)
+
+    def has_voice(self, name: str) -> bool:
+        """Check whether a custom voice is registered."""
+        return name in self._registry
+
+    def get_reference_hash(self, name: str) -> Optional[str]:
+        """Hash of a registered voice's reference clips, or None for unknown voices."""
+        entry = self._registry.get(name)
+        return entry["reference_hash"] if entry else None
+
+    def list_voices(self) -> List[str]:
+        """Get names of registered custom voices."""
+        return sorted(self._registry)
+
+    def register_voice(self, name: str, clips: List[Tuple[str, bytes]]) -> Dict[str, Any]:
+        """
+        Register a voice from one or more reference clips.
+
+        Args:
+            name: Voice name used in generation requests
+            clips: List of (original filename, audio bytes) reference clips
+
+        Returns:
+            Registry entry for the voice
+        """
+        if not VOICE_NAME_PATTERN.match(name):
+            raise ValueError("Voice name may only contain letters, digits, '-' and '_'")
+        if not clips:
+            raise ValueError("At least one reference clip is required")
+
+        extensions = []
+        for filename, _ in clips:
+            extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else "wav"
+            if extension not in REFERENCE_EXTENSIONS:
+                raise ValueError(f"Reference clip type not allowed. Allowed types: {', '.join(REFERENCE_EXTENSIONS)}")
+            extensions.append(extension)
+
+        # Clips are written to a fresh directory that replaces the voice's old one in
+        # a single rename, so clips and latents of a previous registration never mix in
+        voice_dir = os.path.join(self.voices_dir, name)
+        staging_dir = tempfile.mkdtemp(prefix=f".{name}.", dir=self.voices_dir)
+        try:
+            digest = hashlib.sha256()
+            references = []
+            for index, ((_, data), extension) in enumerate(zip(clips, extensions)):
+                reference_name = f"reference_{index}.{extension}"
+                with open(os.path.join(staging_dir, reference_name), "wb") as f:
+                    f.write(data)
+                digest.update(data)
+                references.append(os.path.join(voice_dir, reference_name))
+
+            with self._lock:
+                retired_dir = self._retire_dir(name)
+                os.replace(staging_dir, voice_dir)
+                self._drop_cached(name)
+                self._registry[name] = {
+                    "references": references,
+                    "reference_hash": digest.hexdigest()[:16]
+                }
+                self._save_registry()
+                entry = self._registry[name]
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        if retired_dir:
+            shutil.rmtree(retired_dir, ignore_errors=True)
+        logger.info(f"Registered voice '{name}' with {len(references)} reference clip(s)")
+        return entry
+
+    def delete_voice(self, name: str) -> bool:
+        """Remove a registered voice, its reference clips and its cached conditioning."""
+        with self._lock:
+            entry = self._registry.pop(name, None)
+            if entry is None:
+                return False
+            self._drop_cached(name)
+            self._save_registry()
+            retired_dir = self._retire_dir(name)
+
+        if retired_dir:
+            shutil.rmtree(retired_dir, ignore_errors=True)
+        return True
+
+    def _retire_dir(self, name: str) -> Optional[str]:
+        """Move a voice's directory out of the way so it can be removed outside the lock."""
+        voice_dir = os.path.join(self.voices_dir, name)
+        if not os.path.isdir(voice_dir):
+            return None
+        retired_dir = os.path.join(self.voices_dir, f".{name}.{uuid.uuid4().hex}.old")
+        os.replace(voice_dir, retired_dir)
+        return retired_dir
+
+    def _drop_cached(self, name: str):
+        """Forget in-memory conditioning for a voice (on-disk latents live in its directory)."""
+        for key in [k for k in self._latents if k.startswith(f"{name}:")]:
+            del self._latents[key]
+
+    def get_conditioning(self, name: str, model: Any) -> Tuple[Any, Any]:
+        """
+        Get (gpt_cond_latent, speaker_embedding) for a voice, computing them at most once.
+
+        Args:
+            name: Registered voice name
+            model: Loaded XTTS model exposing get_conditioning_latents
+
+        Returns:
+            Conditioning tensors on the model's device
+        """
+        import torch
+
+        entry = self._registry.get(name)
+        if entry is None:
+            raise KeyError(f"Unknown voice: {name}")
+
+        device = next(model.parameters()).device
+        cache_key = f"{name}:{entry['reference_hash']}:{device}"
+
+        cached = self._latents.get(cache_key)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            cached = self._latents.get(cache_key)
+            if cached is not None:
+                return cached
+
+            cache_path = os.path.join(self.voices_dir, name, f"latents_{entry['reference_hash']}.pt")
+            if os.path.exists(cache_path):
+                data = torch.load(cache_path, map_location="cpu")
+                gpt_cond_latent = data["gpt_cond_latent"]
+                speaker_embedding = data["speaker_embedding"]
+                logger.info(f"Loaded cached conditioning for voice '{name}'")
+            else:
+                logger.info(f"Computing conditioning latents for voice '{name}'...")
+                gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(
+                    audio_path=entry["references"]
+                )
+                torch.save(
+                    {
+                        "gpt_cond_latent": gpt_cond_latent.cpu(),
+                        "speaker_embedding": speaker_embedding.cpu()
+                    },
+                    cache_path
+                )
+
+            conditioning = (gpt_cond_latent.to(device), speaker_embedding.to(device))
+            self._latents[cache_key] = conditioning
+            return conditioning
+
+
+# Global instance
+voice_service = VoiceService()
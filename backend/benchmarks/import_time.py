@@ -0,0 +1,85 @@
+"""
+Import-time benchmark for the API process.
+
+Imports ``app.main`` in fresh interpreters and reports wall time, peak RSS and
+whether any heavy ML library was pulled in. Exits non-zero when a threshold is
+exceeded, so it can run in CI to catch import-time regressions.
+
+Usage (from the backend directory):
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --edge --runs 10 --max-seconds 1.5 --max-rss-mb 150
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["torch", "transformers", "TTS", "PIL", "librosa", "soundfile"]
+
+PROBE = f"""
+import json, resource, sys, time
+start = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - start
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == "darwin":
+    rss_kb //= 1024
+print(json.dumps({{
+    "seconds": elapsed,
+    "rss_mb": rss_kb / 1024,
+    "heavy_modules": [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+}}))
+"""
+
+
+def run_once(edge: bool) -> dict:
+    env = dict(os.environ, EDGE_MODE="true" if edge else "false", PRELOAD_MODELS="false")
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure the import cost of app.main")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to measure")
+    parser.add_argument("--edge", action="store_true", help="Measure with EDGE_MODE enabled")
+    parser.add_argument("--max-seconds", type=float, help="Fail if the median import time exceeds this")
+    parser.add_argument("--max-rss-mb", type=float, help="Fail if the peak RSS exceeds this")
+    parser.add_argument("--allow-heavy", action="store_true", help="Don't fail when ML libraries are imported")
+    args = parser.parse_args()
+
+    samples = [run_once(args.edge) for _ in range(args.runs)]
+    seconds = statistics.median(s["seconds"] for s in samples)
+    rss_mb = max(s["rss_mb"] for s in samples)
+    heavy = sorted({m for s in samples for m in s["heavy_modules"]})
+
+    print(f"mode:          {'edge' if args.edge else 'full'}")
+    print(f"runs:          {args.runs}")
+    print(f"median import: {seconds:.3f}s (min {min(s['seconds'] for s in samples):.3f}s)")
+    print(f"peak RSS:      {rss_mb:.1f}MB")
+    print(f"heavy modules: {', '.join(heavy) or 'none'}")
+
+    failures = []
+    if args.max_seconds is not None and seconds > args.max_seconds:
+        failures.append(f"median import time {seconds:.3f}s > {args.max_seconds}s")
+    if args.max_rss_mb is not None and rss_mb > args.max_rss_mb:
+        failures.append(f"peak RSS {rss_mb:.1f}MB > {args.max_rss_mb}MB")
+    if heavy and not args.allow_heavy:
+        failures.append(f"heavy modules imported at startup: {', '.join(heavy)}")
+
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+Throughput versus CPU thread configuration.
+
+For each configuration ``WORKERSxTHREADS`` this starts WORKERS processes at
+once, each applying the app's CPU topology (its share of the cores,
+TORCH_INTRA_OP_THREADS=THREADS, optional pinning), and counts how many
+inferences they complete in a fixed window. Comparing e.g. ``4x0`` (threads
+sized to each share) with ``4x8`` shows the cost of oversubscription.
+
+Usage (from the backend directory):
+    python benchmarks/thread_scaling.py
+    python benchmarks/thread_scaling.py --configs 1x0,2x0,4x0,4x8 --seconds 20 --affinity
+    python benchmarks/thread_scaling.py --workload blip --configs 1x0,2x0
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = """
+import json, os, sys, time
+from app.core.cpu_topology import cpu_topology
+
+cpu_topology.apply()
+cpu_topology.configure_torch()
+
+import torch
+
+workload, seconds, start_at = sys.argv[1], float(sys.argv[2]), float(sys.argv[3])
+
+if workload == "blip":
+    from PIL import Image
+    from app.services.kosmos_service import KosmosService
+
+    service = KosmosService()
+    image = Image.new("RGB", (384, 384), (120, 160, 200))
+    step = lambda: service._get_image_description(image)
+else:
+    # A stack of transformer layers, about the size of a captioning decoder step
+    layer = torch.nn.TransformerEncoderLayer(d_model=512, nhead=8, batch_first=True)
+    model = torch.nn.TransformerEncoder(layer, num_layers=4).eval()
+    batch = torch.randn(4, 64, 512)
+
+    def step():
+        with torch.no_grad():
+            model(batch)
+
+step()  # warm up outside the timed window
+time.sleep(max(0.0, start_at - time.time()))
+
+count = 0
+deadline = time.perf_counter() + seconds
+while time.perf_counter() < deadline:
+    step()
+    count += 1
+
+print(json.dumps({"count": count, "topology": cpu_topology.verify()}))
+"""
+
+
+def parse_config(spec: str):
+    workers, threads = spec.lower().split("x")
+    return int(workers), int(threads)
+
+
+def run_config(workers: int, threads: int, args) -> dict:
+    """Run one configuration; threads=0 sizes each worker's pool to its share of cores."""
+    start_at = time.time() + args.startup_seconds
+    processes = []
+    for index in range(workers):
+        env = dict(
+            os.environ,
+            CPU_TOPOLOGY_ENABLED="true",
+            CPU_WORKERS=str(workers),
+            CPU_WORKER_INDEX=str(index),
+            CPU_AFFINITY="true" if args.affinity else "false",
+            TRACING_ENABLED="false"
+        )
+        env.pop("TORCH_INTRA_OP_THREADS", None)
+        if threads:
+            env["TORCH_INTRA_OP_THREADS"] = str(threads)
+        processes.append(subprocess.Popen(
+            [sys.executable, "-c", WORKER, args.workload, str(args.seconds), str(start_at)],
+            cwd=BACKEND_DIR,
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True
+        ))
+
+    results = []
+    for process in processes:
+        stdout, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"Worker exited with status {process.returncode}")
+        results.append(json.loads(stdout.strip().splitlines()[-1]))
+
+    total = sum(r["count"] for r in results)
+    return {
+        "config": f"{workers}x{threads or 'auto'}",
+        "workers": workers,
+        "intra_op_threads": [r["topology"]["intra_op_threads"] for r in results],
+        "throughput": total / args.seconds,
+        "per_worker": [r["count"] / args.seconds for r in results],
+        "issues": [issue for r in results for issue in r["topology"]["issues"]]
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure throughput across CPU thread configurations")
+    parser.add_argument("--configs", default="1x0,2x0,4x0,4x8",
+                        help="Comma-separated WORKERSxTHREADS; 0 threads sizes the pool to each worker's cores")
+    parser.add_argument("--workload", choices=["synthetic", "blip"], default="synthetic")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Length of the timed window")
+    parser.add_argument("--startup-seconds", type=float, default=10.0,
+                        help="Time allowed for workers to load before the window starts (raise for --workload blip)")
+    parser.add_argument("--affinity", action="store_true", help="Pin each worker to its share of cores")
+    args = parser.parse_args()
+
+    rows = [run_config(*parse_config(spec), args) for spec in args.configs.split(",")]
+
+    print(f"{'config':>10} {'threads':>10} {'items/s':>10}  per worker")
+    for row in rows:
+        threads = ",".join(str(t) for t in sorted(set(row["intra_op_threads"])))
+        per_worker = " ".join(f"{rate:.1f}" for rate in row["per_worker"])
+        print(f"{row['config']:>10} {threads:>10} {row['throughput']:>10.2f}  {per_worker}")
+        for issue in row["issues"]:
+            print(f"{'':>10} ! {issue}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Settings and the global services are created at import time, so point them
+# at a scratch directory before any app module is imported
+_scratch = tempfile.mkdtemp(prefix="storylens-tests-")
+os.environ.setdefault("UPLOAD_DIR", os.path.join(_scratch, "uploads"))
+os.environ.setdefault("DATA_DIR", os.path.join(_scratch, "data"))
+os.environ.setdefault("STORAGE_BACKEND", "local")
+os.environ.setdefault("PRELOAD_MODELS", "false")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
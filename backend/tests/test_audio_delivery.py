@@ -0,0 +1,107 @@
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from app.api.endpoints import audio
+from app.api.endpoints.audio import _parse_range
+from app.services.file_service import file_service
+from app.services.storage_service import LocalStorageBackend
+
+CONTENT_HASH = "0123456789abcdef0123456789abcdef"
+FILENAME = f"audio_{CONTENT_HASH}.wav"
+DATA = bytes(range(100))
+
+
+def test_parse_range_explicit():
+    assert _parse_range("bytes=0-9", 100) == (0, 9)
+    assert _parse_range("bytes=90-200", 100) == (90, 99)
+
+
+def test_parse_range_open_ended():
+    assert _parse_range("bytes=40-", 100) == (40, 99)
+
+
+def test_parse_range_suffix():
+    assert _parse_range("bytes=-10", 100) == (90, 99)
+    assert _parse_range("bytes=-500", 100) == (0, 99)
+
+
+def test_parse_range_ignores_unsupported_headers():
+    assert _parse_range("items=0-9", 100) is None
+    assert _parse_range("bytes=0-9,20-29", 100) is None
+    assert _parse_range("bytes=abc-", 100) is None
+    assert _parse_range("bytes=-0", 100) is None
+
+
+def test_parse_range_out_of_range():
+    with pytest.raises(HTTPException) as error:
+        _parse_range("bytes=100-", 100)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == "bytes */100"
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    backend = LocalStorageBackend(str(tmp_path / "storage"))
+    backend.put(f"audio/{FILENAME}", DATA)
+    backend.put("audio/narration.wav", DATA)
+    monkeypatch.setattr(file_service, "storage", backend)
+    app = FastAPI()
+    app.include_router(audio.router, prefix="/api")
+    return TestClient(app)
+
+
+def test_full_response_has_validators(client):
+    response = client.get(f"/api/audio/{FILENAME}")
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert response.headers["etag"] == f'"{CONTENT_HASH}"'
+    assert response.headers["cache-control"] == audio.IMMUTABLE_CACHE_CONTROL
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_range_response(client):
+    response = client.get(f"/api/audio/{FILENAME}", headers={"Range": "bytes=-10"})
+    assert response.status_code == 206
+    assert response.content == DATA[90:]
+    assert response.headers["content-range"] == "bytes 90-99/100"
+
+
+def test_unsatisfiable_range(client):
+    response = client.get(f"/api/audio/{FILENAME}", headers={"Range": "bytes=500-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */100"
+
+
+def test_if_none_match_returns_304(client):
+    etag = f'"{CONTENT_HASH}"'
+    assert client.get(f"/api/audio/{FILENAME}", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(f"/api/audio/{FILENAME}", headers={"If-None-Match": f"W/{etag}"}).status_code == 304
+    assert client.get(f"/api/audio/{FILENAME}", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_if_modified_since_returns_304(client):
+    last_modified = client.get("/api/audio/narration.wav").headers["last-modified"]
+    response = client.get("/api/audio/narration.wav", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    assert response.headers["cache-control"] == audio.REVALIDATE_CACHE_CONTROL
+
+
+def test_if_range_uses_strong_comparison(client):
+    etag = f'"{CONTENT_HASH}"'
+    headers = {"Range": "bytes=0-9"}
+    assert client.get(f"/api/audio/{FILENAME}", headers={**headers, "If-Range": etag}).status_code == 206
+    weak = client.get(f"/api/audio/{FILENAME}", headers={**headers, "If-Range": f"W/{etag}"})
+    assert weak.status_code == 200
+    assert weak.content == DATA
+    assert client.get(f"/api/audio/{FILENAME}", headers={**headers, "If-Range": '"stale"'}).status_code == 200
+
+
+def test_content_addressed_etag_is_independent_of_mtime(client, tmp_path):
+    before = client.get(f"/api/audio/{FILENAME}").headers["etag"]
+    file_service.storage.put(f"audio/{FILENAME}", DATA)  # e.g. restored from a backup
+    assert client.get(f"/api/audio/{FILENAME}").headers["etag"] == before
+
+
+def test_missing_file(client):
+    assert client.get("/api/audio/missing.wav").status_code == 404
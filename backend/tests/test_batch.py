@@ -0,0 +1,176 @@
+import io
+import json
+import argparse
+
+import pytest
+from PIL import Image
+
+from app import batch
+from app.batch import Checkpoint
+from app.services.image_store import image_ref_store
+from app.services.story_store import story_store
+
+
+def image_bytes(color) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class StubKosmos:
+    """Stands in for KosmosService: captions every image as its hash."""
+
+    def __init__(self):
+        self.captioned = []
+
+    def initialize(self):
+        pass
+
+    def load_image(self, path):
+        return path, path.rsplit("/", 1)[-1].split(".")[0]
+
+    def generate_stories(self, images, image_hashes, story_type, phashes, reuse_caption):
+        self.captioned.extend(images)
+        return [
+            {"title": "A Story", "content": f"About {image_hash}.", "story_type": story_type,
+             "generation_time": 0.0, "model_used": "stub", "caption": f"image {image_hash}"}
+            for image_hash in image_hashes
+        ]
+
+
+class StubTopology:
+    def apply(self):
+        pass
+
+
+@pytest.fixture
+def kosmos(monkeypatch):
+    stub = StubKosmos()
+    monkeypatch.setattr(batch, "kosmos_service", stub)
+    monkeypatch.setattr(batch, "cpu_topology", StubTopology())
+    return stub
+
+
+@pytest.fixture
+def photos(tmp_path):
+    directory = tmp_path / "photos"
+    directory.mkdir()
+    for index, color in enumerate(["red", "green", "blue", "white", "black"]):
+        (directory / f"{index}.png").write_bytes(image_bytes(color))
+    return directory
+
+
+def make_args(source, output, **overrides):
+    args = dict(
+        source=str(source), output=str(output), checkpoint=None, restart=False, retry_failed=False,
+        story_type="story", batch_size=2, prefetch_workers=2, no_reuse_caption=False, narrate=False,
+        voice="default", audio_format=None, limit=None, progress_interval=3600.0
+    )
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def read_results(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_checkpoint_truncates_torn_record(tmp_path):
+    path = tmp_path / "out.jsonl.checkpoint"
+    path.write_bytes(
+        b'{"ids": ["a"], "failed": [], "output_offset": 10}\n'
+        b'{"ids": ["b"], "failed": ["c"], "output_offset": 30}\n'
+        b'{"ids": ["d"], "outp'
+    )
+    checkpoint = Checkpoint(str(path), str(tmp_path / "out.jsonl"))
+    assert checkpoint.load()
+    assert checkpoint.completed == {"a", "b"}
+    assert checkpoint.failed == {"c"}
+    assert checkpoint.output_offset == 30
+
+    checkpoint.record(["d"], [], 40)
+    reloaded = Checkpoint(str(path), str(tmp_path / "out.jsonl"))
+    reloaded.load()
+    assert reloaded.completed == {"a", "b", "d"}
+    assert reloaded.output_offset == 40
+
+
+def test_checkpoint_truncate_output_drops_unrecorded_results(tmp_path):
+    output = tmp_path / "out.jsonl"
+    output.write_bytes(b"0123456789partial")
+    checkpoint = Checkpoint(str(tmp_path / "cp"), str(output))
+    checkpoint.output_offset = 10
+    checkpoint.truncate_output()
+    assert output.read_bytes() == b"0123456789"
+
+
+def test_missing_checkpoint(tmp_path):
+    assert not Checkpoint(str(tmp_path / "missing"), str(tmp_path / "out.jsonl")).load()
+
+
+def test_run_resumes_after_limit(kosmos, photos, tmp_path):
+    output = tmp_path / "out.jsonl"
+    assert batch.run(make_args(photos, output, limit=3)) == 0
+    assert [result["id"] for result in read_results(output)] == ["0.png", "1.png", "2.png"]
+
+    assert batch.run(make_args(photos, output)) == 0
+    results = read_results(output)
+    assert [result["id"] for result in results] == ["0.png", "1.png", "2.png", "3.png", "4.png"]
+    assert len(kosmos.captioned) == 5
+    assert all(result["story_id"] for result in results)
+
+    # Nothing left to do
+    assert batch.run(make_args(photos, output)) == 0
+    assert len(read_results(output)) == 5
+
+
+def test_rerun_after_lost_checkpoint_reuses_uploads_and_stories(kosmos, photos, tmp_path):
+    output = tmp_path / "out.jsonl"
+    batch.run(make_args(photos, output))
+    before = read_results(output)
+    uploads, stories = image_ref_store.get_stats()["uploads"], story_store.get_stats()["stories"]
+
+    assert batch.run(make_args(photos, output, restart=True)) == 0
+    after = read_results(output)
+    assert [r["story_id"] for r in after] == [r["story_id"] for r in before]
+    assert [r["upload_id"] for r in after] == [r["upload_id"] for r in before]
+    assert image_ref_store.get_stats()["uploads"] == uploads
+    assert story_store.get_stats()["stories"] == stories
+
+
+def test_failed_images_are_retried_only_when_asked(kosmos, photos, tmp_path):
+    output = tmp_path / "out.jsonl"
+    broken = photos / "2.png"
+    broken.write_bytes(b"not an image")
+
+    batch.run(make_args(photos, output))
+    results = read_results(output)
+    assert "error" in results[2]
+    assert sum("error" in result for result in results) == 1
+
+    broken.write_bytes(image_bytes("purple"))
+    batch.run(make_args(photos, output))
+    assert len(read_results(output)) == 5
+
+    batch.run(make_args(photos, output, retry_failed=True))
+    results = read_results(output)
+    assert len(results) == 6
+    assert results[-1]["id"] == "2.png" and "error" not in results[-1]
+
+    checkpoint = Checkpoint(f"{output}.checkpoint", str(output))
+    checkpoint.load()
+    assert checkpoint.failed == set()
+    assert len(checkpoint.completed) == 5
+
+
+def test_existing_output_without_checkpoint_is_refused(kosmos, photos, tmp_path):
+    output = tmp_path / "out.jsonl"
+    output.write_text("{}\n")
+    assert batch.run(make_args(photos, output)) == 2
+
+
+def test_read_manifest(tmp_path):
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text('# comment\nphotos/a.png\n{"path": "/abs/b.png", "id": "b"}\n\n')
+    items = batch.read_manifest(str(manifest))
+    assert items[0].path == str(tmp_path / "photos" / "a.png")
+    assert items[1] == batch.BatchItem("b", "/abs/b.png")
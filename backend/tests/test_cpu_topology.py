@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from app.core import cpu_topology as topology_module
+from app.core.config import settings
+from app.core.cpu_topology import CpuTopology, THREAD_ENV_VARS, plan_worker_cores
+
+
+def test_cores_are_split_into_contiguous_near_equal_shares():
+    cores = list(range(10))
+    shares = [plan_worker_cores(cores, 3, index) for index in range(3)]
+    assert shares == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    assert plan_worker_cores(cores, 1, 0) == cores
+
+
+def test_more_workers_than_cores_share_round_robin():
+    assert [plan_worker_cores([4, 5], 5, index) for index in range(5)] == [[4], [5], [4], [5], [4]]
+
+
+def test_worker_index_wraps_around():
+    assert plan_worker_cores(list(range(4)), 2, 3) == [2, 3]
+
+
+@pytest.fixture
+def machine(tmp_path, monkeypatch):
+    """Eight cores shared by two workers; thread environment variables restored afterwards."""
+    monkeypatch.setattr(topology_module, "available_cores", lambda: list(range(8)))
+    monkeypatch.setattr(settings, "data_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "cpu_topology_enabled", True)
+    monkeypatch.setattr(settings, "cpu_workers", 2)
+    monkeypatch.setattr(settings, "cpu_worker_index", None)
+    monkeypatch.setattr(settings, "torch_intra_op_threads", None)
+    monkeypatch.setattr(settings, "torch_inter_op_threads", None)
+    monkeypatch.setattr(settings, "cpu_affinity", False)
+    for name in THREAD_ENV_VARS:
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_workers_claim_separate_slots(machine):
+    first, second, third = CpuTopology(), CpuTopology(), CpuTopology()
+    for topology in (first, second, third):
+        topology.apply()
+    assert (first.worker_index, first.cores) == (0, [0, 1, 2, 3])
+    assert (second.worker_index, second.cores) == (1, [4, 5, 6, 7])
+    # No slot left: falls back to sharing the first
+    assert third.worker_index == 0
+    assert first.intra_op_threads == 4 and first.inter_op_threads == 1
+    assert all(os.environ[name] == "4" for name in THREAD_ENV_VARS)
+
+
+def test_released_slot_can_be_claimed_again(machine):
+    first = CpuTopology()
+    first.apply()
+    first._slot_lock.close()
+    second = CpuTopology()
+    second.apply()
+    assert second.worker_index == 0
+
+
+def test_explicit_worker_index_and_thread_counts(machine, monkeypatch):
+    monkeypatch.setattr(settings, "cpu_worker_index", 1)
+    monkeypatch.setattr(settings, "torch_intra_op_threads", 2)
+    monkeypatch.setattr(settings, "torch_inter_op_threads", 2)
+    topology = CpuTopology()
+    topology.apply()
+    assert topology.worker_index == 1 and topology.cores == [4, 5, 6, 7]
+    assert (topology.intra_op_threads, topology.inter_op_threads) == (2, 2)
+    assert topology.verify()["issues"] == []
+
+
+def test_verify_reports_oversubscription(machine, monkeypatch):
+    monkeypatch.setattr(settings, "torch_intra_op_threads", 16)
+    topology = CpuTopology()
+    topology.apply()
+    assert topology.verify()["issues"] == ["16 intra-op threads for a share of 4 cores"]
+
+
+def test_disabled_topology_changes_nothing(machine, monkeypatch):
+    monkeypatch.setattr(settings, "cpu_topology_enabled", False)
+    topology = CpuTopology()
+    topology.apply()
+    assert topology.worker_index is None
+    assert not any(name in os.environ for name in THREAD_ENV_VARS)
+    assert topology.verify()["enabled"] is False
@@ -0,0 +1,206 @@
+import sys
+import time
+import types
+import threading
+
+import pytest
+
+from app.core.config import settings
+from app.services import kosmos_service as kosmos_module
+from app.services.device_service import DeviceManager
+from app.services.kosmos_service import KosmosService
+
+
+@pytest.fixture(autouse=True)
+def memory_settings(monkeypatch):
+    monkeypatch.setattr(settings, "device", "auto")
+    monkeypatch.setattr(settings, "device_policies", {})
+    monkeypatch.setattr(settings, "model_memory_mb", {"blip": 1000, "kosmos": 3500, "xtts": 2500})
+    monkeypatch.setattr(settings, "request_memory_mb", {"blip": 300, "kosmos": 800, "xtts": 600})
+    monkeypatch.setattr(settings, "device_headroom_mb", 500)
+
+
+def test_places_model_on_accelerator_with_room():
+    manager = DeviceManager(accelerators={"cuda:0": 4000})
+    assert manager.place_model("blip") == "cuda:0"
+    assert manager.get_status()["devices"]["cuda:0"]["free_mb"] == 3000
+
+
+def test_places_model_on_next_accelerator_when_first_is_full():
+    manager = DeviceManager(accelerators={"cuda:0": 3000, "cuda:1": 8000})
+    assert manager.place_model("kosmos") == "cuda:1"
+    assert manager.place_model("blip") == "cuda:0"
+    assert manager.place_model("xtts") == "cuda:1"
+    assert manager.place_model("kosmos") == "cuda:1"  # re-placing replaces its old reservation
+
+
+def test_places_model_on_cpu_without_room_or_by_policy(monkeypatch):
+    manager = DeviceManager(accelerators={"cuda:0": 2000})
+    assert manager.place_model("kosmos") == "cpu"
+    assert "insufficient memory" in manager.get_status()["placements"]["kosmos"]["reason"]
+
+    monkeypatch.setattr(settings, "device_policies", {"blip": "cpu"})
+    assert manager.place_model("blip") == "cpu"
+    assert manager.get_status()["placements"]["blip"]["reason"] == "policy"
+
+
+def test_explicit_policy_for_missing_device_falls_back_to_cpu(monkeypatch):
+    monkeypatch.setattr(settings, "device_policies", {"blip": "cuda:1"})
+    manager = DeviceManager(accelerators={"cuda:0": 8000})
+    assert manager.place_model("blip") == "cpu"
+    assert manager.get_status()["placements"]["blip"]["reason"] == "cuda:1 unavailable"
+
+
+def test_no_accelerators_places_on_cpu():
+    assert DeviceManager(accelerators={}).place_model("blip") == "cpu"
+
+
+def test_release_model_frees_its_memory():
+    manager = DeviceManager(accelerators={"cuda:0": 4000})
+    manager.place_model("blip")
+    assert manager.place_model("kosmos") == "cpu"
+    manager.release_model("blip")
+    assert manager.get_device("blip") == "cpu"
+    assert manager.place_model("kosmos") == "cuda:0"
+    assert manager.get_status()["devices"]["cuda:0"]["free_mb"] == 500
+
+
+def test_acquire_reserves_request_memory():
+    manager = DeviceManager(accelerators={"cuda:0": 2000})
+    manager.place_model("blip")
+    with manager.acquire("blip") as device:
+        assert device == "cuda:0"
+        status = manager.get_status()["devices"]["cuda:0"]
+        assert status["reserved_mb"] == 300
+        assert status["active_requests"] == 1
+    status = manager.get_status()["devices"]["cuda:0"]
+    assert status["reserved_mb"] == 0
+    assert status["active_requests"] == 0
+
+
+def test_saturated_accelerator_sends_requests_to_cpu():
+    # 2000 - 1000 placed leaves room for one 300MB request above the 500MB headroom
+    manager = DeviceManager(accelerators={"cuda:0": 2000})
+    manager.place_model("blip")
+    with manager.acquire("blip") as first, manager.acquire("blip") as second:
+        assert (first, second) == ("cuda:0", "cpu")
+        assert manager.get_status()["cpu_active_requests"] == 1
+    assert manager.get_status()["cpu_fallbacks"] == {"blip": 1}
+    with manager.acquire("blip") as device:
+        assert device == "cuda:0"
+
+
+def test_model_on_cpu_never_reserves_accelerator_memory():
+    manager = DeviceManager(accelerators={"cuda:0": 2000})
+    manager.place_model("kosmos")
+    with manager.acquire("kosmos") as device:
+        assert device == "cpu"
+        assert manager.get_status()["devices"]["cuda:0"]["reserved_mb"] == 0
+    assert manager.get_status()["cpu_fallbacks"] == {}
+
+
+def test_is_out_of_memory():
+    assert DeviceManager.is_out_of_memory(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"))
+    assert not DeviceManager.is_out_of_memory(ValueError("bad input"))
+
+
+@pytest.fixture
+def simulated_manager(monkeypatch):
+    manager = DeviceManager(accelerators={"cuda:0": 4000})
+    manager.place_model("blip")
+    monkeypatch.setattr(kosmos_module, "device_manager", manager)
+    return manager
+
+
+@pytest.fixture
+def service():
+    """A KosmosService on a simulated GPU, without loading any model."""
+    service = KosmosService.__new__(KosmosService)
+    service.device = "cuda:0"
+    service.blip_model = "gpu-model"
+    service.model = None
+    service._cpu_replicas = {"blip": "cpu-model"}
+    service._replica_lock = threading.Lock()
+    return service
+
+
+def test_out_of_memory_is_retried_on_cpu(simulated_manager, service):
+    calls = []
+
+    def caption(model, device, image, stop, image_hash):
+        calls.append((model, device))
+        if device != "cpu":
+            raise RuntimeError("CUDA out of memory")
+        return "a caption"
+
+    assert service._run_on_device("blip", caption, image=None) == "a caption"
+    assert calls == [("gpu-model", "cuda:0"), ("cpu-model", "cpu")]
+    assert simulated_manager.get_status()["cpu_fallbacks"] == {"blip": 1}
+    assert simulated_manager.get_status()["devices"]["cuda:0"]["reserved_mb"] == 0
+
+
+def test_other_errors_are_not_retried(simulated_manager, service):
+    def caption(model, device, image, stop, image_hash):
+        raise ValueError("bad image")
+
+    with pytest.raises(ValueError):
+        service._run_on_device("blip", caption, image=None)
+    assert simulated_manager.get_status()["cpu_fallbacks"] == {}
+
+
+def test_streamed_caption_out_of_memory_is_retried_on_cpu(simulated_manager, service, monkeypatch):
+    def stream(model_key, device, image, image_hash, stop=None):
+        if device != "cpu":
+            raise RuntimeError("CUDA out of memory")
+        yield from ["a ", "caption"]
+
+    monkeypatch.setattr(service, "_stream_on_device", stream)
+    assert list(service._stream_caption("blip", image=None)) == ["a ", "caption"]
+    assert simulated_manager.get_status()["cpu_fallbacks"] == {"blip": 1}
+
+
+def test_streamed_caption_out_of_memory_after_first_piece_is_raised(simulated_manager, service, monkeypatch):
+    def stream(model_key, device, image, image_hash, stop=None):
+        yield "a "
+        raise RuntimeError("CUDA out of memory")
+
+    monkeypatch.setattr(service, "_stream_on_device", stream)
+    pieces = []
+    with pytest.raises(RuntimeError):
+        for piece in service._stream_caption("blip", image=None):
+            pieces.append(piece)
+    assert pieces == ["a "]
+
+
+def test_concurrent_fallbacks_load_one_cpu_replica(service, monkeypatch):
+    loads = []
+
+    class FakeModel:
+        @classmethod
+        def from_pretrained(cls, path):
+            loads.append(path)
+            time.sleep(0.05)
+            return cls()
+
+        def to(self, device):
+            return self
+
+        def eval(self):
+            return self
+
+    monkeypatch.setitem(sys.modules, "transformers", types.SimpleNamespace(
+        BlipForConditionalGeneration=FakeModel, AutoModelForVision2Seq=FakeModel
+    ))
+    service._cpu_replicas = {}
+    replicas = []
+    threads = [
+        threading.Thread(target=lambda: replicas.append(service._get_model_for_device("blip", "cpu")))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert len({id(replica) for replica in replicas}) == 1
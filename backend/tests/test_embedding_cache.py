@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from app.services.embedding_cache import EmbeddingCache
+
+MODEL = "Salesforce/blip-image-captioning-base"
+ROW_BYTES = 4 * 16
+
+
+def embedding(value, dtype=torch.float32):
+    return torch.full((1, 4, 4), value, dtype=dtype)
+
+
+def test_memory_hit_returns_the_stored_tensor(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), memory_bytes=1024, disk_bytes=0)
+    cache.put(MODEL, "abc", embedding(1.0))
+    assert torch.equal(cache.get(MODEL, "abc"), embedding(1.0))
+    assert cache.get("other-model", "abc") is None
+    assert cache.get_stats()["hits"] == {"memory": 1, "disk": 0}
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_disk_round_trip_across_instances(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), memory_bytes=1024, disk_bytes=1024 * 1024)
+    cache.put(MODEL, "abc", embedding(2.0, torch.float16))
+    assert os.path.exists(os.path.join(tmp_path, "Salesforce_blip-image-captioning-base", "abc.npy"))
+
+    reloaded = EmbeddingCache(str(tmp_path), memory_bytes=1024, disk_bytes=1024 * 1024)
+    assert reloaded.get_stats()["disk_entries"] == 1
+    tensor = reloaded.get(MODEL, "abc")
+    assert tensor.dtype == torch.float16
+    assert torch.equal(tensor, embedding(2.0, torch.float16))
+    assert reloaded.get_stats()["hits"] == {"memory": 0, "disk": 1}
+
+    # Served from memory from now on, and writes to the mapped tensor never reach the file
+    tensor.add_(1)
+    assert reloaded.get(MODEL, "abc") is tensor
+    assert torch.equal(EmbeddingCache(str(tmp_path), 0, 1024 * 1024).get(MODEL, "abc"), embedding(2.0, torch.float16))
+
+
+def test_memory_tier_evicts_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), memory_bytes=2 * ROW_BYTES, disk_bytes=0)
+    cache.put(MODEL, "a", embedding(1.0))
+    cache.put(MODEL, "b", embedding(2.0))
+    cache.get(MODEL, "a")
+    cache.put(MODEL, "c", embedding(3.0))
+    assert cache.get(MODEL, "b") is None
+    assert cache.get(MODEL, "a") is not None and cache.get(MODEL, "c") is not None
+
+
+def test_disk_tier_evicts_oldest_files(tmp_path):
+    probe = EmbeddingCache(str(tmp_path / "probe"), memory_bytes=0, disk_bytes=1024 * 1024)
+    probe.put(MODEL, "x", embedding(0.0))
+    file_size = os.path.getsize(probe._disk_path(MODEL, "x"))
+
+    cache = EmbeddingCache(str(tmp_path / "cache"), memory_bytes=0, disk_bytes=int(2.5 * file_size))
+    for name in ("a", "b", "c"):
+        cache.put(MODEL, name, embedding(1.0))
+    assert not os.path.exists(cache._disk_path(MODEL, "a"))
+    assert cache.get(MODEL, "a") is None
+    assert cache.get(MODEL, "c") is not None
+
+
+def test_get_or_compute_only_encodes_on_a_miss(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), memory_bytes=1024, disk_bytes=0)
+    calls = []
+
+    def encode():
+        calls.append(1)
+        return embedding(1.0, torch.float64)
+
+    first = cache.get_or_compute(MODEL, "abc", encode)
+    second = cache.get_or_compute(MODEL, "abc", encode)
+    assert len(calls) == 1
+    assert second.dtype == torch.float32 and torch.equal(second, first.float())
+    cache.get_or_compute(MODEL, None, encode)
+    assert len(calls) == 2
+
+
+def test_unreadable_files_are_discarded(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), memory_bytes=0, disk_bytes=1024 * 1024)
+    path = cache._disk_path(MODEL, "abc")
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(b"not numpy")
+    assert cache.get(MODEL, "abc") is None
+    assert not os.path.exists(path)
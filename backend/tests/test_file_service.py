@@ -0,0 +1,81 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from app.core.config import settings
+from app.services import file_service as file_service_module
+from app.services.file_service import FileService
+from app.services.image_store import ImageRefStore
+from app.services.storage_service import LocalStorageBackend
+
+
+def image_bytes(color="red", mode="RGB") -> bytes:
+    buffer = io.BytesIO()
+    Image.new(mode, (16, 16), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def refs(tmp_path, monkeypatch):
+    store = ImageRefStore(str(tmp_path / "images.db"))
+    monkeypatch.setattr(file_service_module, "image_ref_store", store)
+    return store
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch, refs):
+    monkeypatch.setattr(settings, "upload_dir", str(tmp_path / "uploads"))
+    service = FileService()
+    # As create_storage_backend sets it up: local objects live in the working directory
+    service.storage = LocalStorageBackend(settings.upload_dir)
+    return service
+
+
+def test_identical_uploads_share_one_blob(files, refs):
+    first = files.save_image_bytes(image_bytes(), "a.png")
+    second = files.save_image_bytes(image_bytes(), "b.png")
+    assert not first["deduplicated"] and second["deduplicated"]
+    assert first["upload_id"] != second["upload_id"]
+    assert first["filename"] == second["filename"] == f"{first['content_hash']}.png"
+    assert refs.get_blob(first["content_hash"])["refcount"] == 2
+    assert refs.get_stats()["blobs"] == 1
+    assert os.listdir(files.images_dir) == [first["filename"]]
+
+
+def test_blob_is_deleted_with_its_last_reference(files, refs):
+    first = files.save_image_bytes(image_bytes(), "a.png")
+    second = files.save_image_bytes(image_bytes(), "b.png")
+    key = first["key"]
+
+    assert files.delete_file(first["path"], upload_id=first["upload_id"])
+    assert files.storage.exists(key) and os.path.exists(second["path"])
+    assert refs.get_blob(first["content_hash"])["refcount"] == 1
+
+    assert files.delete_file(second["path"], upload_id=second["upload_id"])
+    assert not files.storage.exists(key) and not os.path.exists(second["path"])
+    assert refs.get_blob(first["content_hash"]) is None
+
+
+def test_unknown_upload_id_does_not_delete_a_referenced_blob(files, refs):
+    info = files.save_image_bytes(image_bytes(), "a.png")
+    assert not files.delete_file(info["path"], upload_id="someone-else")
+    assert files.storage.exists(info["key"])
+
+
+def test_saving_under_an_existing_upload_id(files, refs):
+    first = files.save_image_bytes(image_bytes("red"), "a.png", upload_id="batch-1")
+    again = files.save_image_bytes(image_bytes("red"), "a.png", upload_id="batch-1")
+    assert again["deduplicated"] and refs.get_blob(first["content_hash"])["refcount"] == 1
+
+    replaced = files.save_image_bytes(image_bytes("blue"), "a.png", upload_id="batch-1")
+    assert replaced["content_hash"] != first["content_hash"]
+    assert refs.get_blob(first["content_hash"]) is None
+    assert not files.storage.exists(first["key"])
+
+
+def test_non_rgb_images_are_stored_as_jpeg(files):
+    info = files.save_image_bytes(image_bytes("red", mode="RGBA"), "a.png")
+    assert info["filename"].endswith(".jpg")
+    assert info["phash"] is not None
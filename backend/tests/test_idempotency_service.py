@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from app.services.idempotency_service import IdempotencyCache, IdempotencyConflict
+
+
+def counting(result="story"):
+    """A compute factory that records how often it ran."""
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return f"{result} {len(calls)}"
+
+    return compute, calls
+
+
+def test_retry_replays_the_stored_result():
+    cache = IdempotencyCache(ttl_seconds=60, max_entries=10)
+    compute, calls = counting()
+
+    async def scenario():
+        return [await cache.run("upload:k", "fp", compute) for _ in range(2)]
+
+    assert asyncio.run(scenario()) == [("story 1", False), ("story 1", True)]
+    assert len(calls) == 1
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_reusing_a_key_for_another_request_conflicts():
+    cache = IdempotencyCache(ttl_seconds=60, max_entries=10)
+    compute, _ = counting()
+
+    async def scenario():
+        await cache.run("upload:k", "fp", compute)
+        await cache.run("upload:k", "other", compute)
+
+    with pytest.raises(IdempotencyConflict):
+        asyncio.run(scenario())
+
+
+def test_concurrent_duplicates_join_the_in_flight_request():
+    cache = IdempotencyCache(ttl_seconds=60, max_entries=10)
+    compute, calls = counting()
+
+    async def scenario():
+        return await asyncio.gather(*(cache.run("upload:k", "fp", compute) for _ in range(3)))
+
+    assert asyncio.run(scenario()) == [("story 1", False), ("story 1", True), ("story 1", True)]
+    assert len(calls) == 1
+    assert cache.get_stats()["joins"] == 2
+
+
+def test_failures_are_not_stored():
+    cache = IdempotencyCache(ttl_seconds=60, max_entries=10)
+    attempts = []
+
+    async def compute():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("model crashed")
+        return "story"
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await cache.run("upload:k", "fp", compute)
+        return await cache.run("upload:k", "fp", compute)
+
+    assert asyncio.run(scenario()) == ("story", False)
+    assert cache.get_stats()["in_flight"] == 0
+
+
+def test_expired_and_evicted_entries_run_again():
+    cache = IdempotencyCache(ttl_seconds=-1, max_entries=10)
+    compute, calls = counting()
+
+    async def scenario():
+        await cache.run("upload:k", "fp", compute)
+        return await cache.run("upload:k", "fp", compute)
+
+    assert asyncio.run(scenario()) == ("story 2", False)
+
+    cache = IdempotencyCache(ttl_seconds=60, max_entries=1)
+    compute, calls = counting()
+
+    async def evict():
+        await cache.run("upload:a", "fp", compute)
+        await cache.run("upload:b", "fp", compute)
+        return await cache.run("upload:a", "fp", compute)
+
+    assert asyncio.run(evict()) == ("story 3", False)
+
+
+def test_fingerprint_covers_every_part():
+    assert IdempotencyCache.fingerprint("hash", "a.jpg", "story") == IdempotencyCache.fingerprint("hash", "a.jpg", "story")
+    assert IdempotencyCache.fingerprint("hash", "a.jpg", "story") != IdempotencyCache.fingerprint("hash", "a.jpg", "poem")
+    assert IdempotencyCache.fingerprint("ab", "c") != IdempotencyCache.fingerprint("a", "bc")
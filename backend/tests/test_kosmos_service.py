@@ -0,0 +1,172 @@
+import io
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+from app.core.config import settings
+from app.services import kosmos_service as kosmos_module
+from app.services.kosmos_service import KosmosService, TEMPLATE_TIER
+
+
+class RecordingIndex:
+    """Stands in for the caption index and records what is added to it."""
+
+    def __init__(self):
+        self.added = []
+
+    def lookup(self, phash, model):
+        return None
+
+    def add(self, phash, caption, model):
+        self.added.append(caption)
+
+
+@pytest.fixture
+def service():
+    """A KosmosService with no models loaded."""
+    service = KosmosService.__new__(KosmosService)
+    service.model = service.processor = service.blip_model = service.blip_processor = None
+    service._tier_wins = Counter()
+    service._hedges_started = 0
+    service._deadline_misses = 0
+    service._metrics_lock = threading.Lock()
+    service._hedge_executor = ThreadPoolExecutor(max_workers=4)
+    yield service
+    service._hedge_executor.shutdown(wait=True)
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = RecordingIndex()
+    monkeypatch.setattr(kosmos_module, "caption_index", index)
+    return index
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "photo.png"
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16), "red").save(buffer, "PNG")
+    path.write_bytes(buffer.getvalue())
+    return str(path)
+
+
+def stub_streaming(service, monkeypatch, pieces, after_first=None):
+    """Stream the given caption pieces as if decoded by BLIP, calling after_first once one is out."""
+    def stream_caption(model_key, image, image_hash=None, stop=None):
+        for number, piece in enumerate(pieces):
+            if stop is not None and stop.is_set():
+                return
+            yield piece
+            if number == 0 and after_first is not None:
+                after_first()
+
+    monkeypatch.setattr(service, "_caption_model_key", lambda: "blip")
+    monkeypatch.setattr(service, "_stream_caption", stream_caption)
+
+
+def test_stream_story_yields_tokens_then_story(service, index, image_path, monkeypatch):
+    stub_streaming(service, monkeypatch, ["a dog", " on a beach"])
+    events = list(service.stream_story(image_path, reuse_caption=False))
+    assert [event for event, _ in events] == ["token", "token", "caption", "story"]
+    assert events[2][1] == {"text": "a dog on a beach", "source": "model"}
+    assert index.added == ["a dog on a beach"]
+
+
+def test_stopped_stream_does_not_index_or_compose(service, index, image_path, monkeypatch):
+    stop = threading.Event()
+    stub_streaming(service, monkeypatch, ["a dog", " on a beach"], after_first=stop.set)
+    events = list(service.stream_story(image_path, reuse_caption=False, stop=stop))
+    assert events == [("token", {"text": "a dog"})]
+    assert index.added == []
+
+
+class StubTier:
+    """A caption tier answering after a delay, or failing; records whether it was told to stop."""
+
+    def __init__(self, caption, seconds=0.0, error=None):
+        self.caption = caption
+        self.seconds = seconds
+        self.error = error
+        self.calls = 0
+        self.stopped = False
+
+    def __call__(self, image, stop, image_hash):
+        self.calls += 1
+        # Sleep in small steps, like decoding, so a stop request ends the call early
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            if stop is not None and stop.is_set():
+                self.stopped = True
+                raise RuntimeError("stopped")
+            time.sleep(0.005)
+        if self.error:
+            raise self.error
+        return self.caption
+
+
+@pytest.fixture
+def tiers(service, monkeypatch):
+    """Install stub tiers (best first) on the service."""
+    def install(**stubs):
+        monkeypatch.setattr(service, "_caption_tiers", lambda: list(stubs.items()))
+        return stubs
+    monkeypatch.setattr(settings, "caption_hedge_delay_ms", 50)
+    return install
+
+
+def test_best_tier_answering_in_time_is_not_hedged(service, tiers):
+    stubs = tiers(beam=StubTier("beam caption"), greedy=StubTier("greedy caption"))
+    assert service._get_image_description(None, deadline_ms=2000) == ("beam caption", "beam")
+    assert stubs["greedy"].calls == 0
+    assert service.get_caption_metrics()["hedges_started"] == 0
+
+
+def test_slow_best_tier_is_hedged_by_the_next_one(service, tiers):
+    stubs = tiers(beam=StubTier("beam caption", seconds=1.0), greedy=StubTier("greedy caption"))
+    assert service._get_image_description(None, deadline_ms=2000) == ("greedy caption", "greedy")
+    service._hedge_executor.shutdown(wait=True)
+    assert stubs["beam"].stopped
+    assert service.get_caption_metrics()["hedges_started"] == 1
+
+
+def test_failed_tier_falls_through_without_waiting_for_the_hedge_delay(service, tiers, monkeypatch):
+    monkeypatch.setattr(settings, "caption_hedge_delay_ms", 10000)
+    tiers(beam=StubTier("beam caption", error=RuntimeError("out of memory")), greedy=StubTier("greedy caption"))
+    started = time.monotonic()
+    assert service._get_image_description(None, deadline_ms=5000) == ("greedy caption", "greedy")
+    assert time.monotonic() - started < 1.0
+
+
+def test_missed_deadline_returns_the_template_description(service, tiers):
+    stubs = tiers(beam=StubTier("beam caption", seconds=2.0), greedy=StubTier("greedy caption", seconds=2.0))
+    started = time.monotonic()
+    assert service._get_image_description(None, deadline_ms=200) == (service.ERROR_DESCRIPTION, TEMPLATE_TIER)
+    assert time.monotonic() - started < 1.0
+    service._hedge_executor.shutdown(wait=True)
+    assert stubs["beam"].stopped and stubs["greedy"].stopped
+    assert service.get_caption_metrics()["deadline_misses"] == 1
+
+
+def test_without_a_deadline_the_best_tier_is_awaited(service, tiers, monkeypatch):
+    monkeypatch.setattr(settings, "caption_deadline_ms", None)
+    stubs = tiers(beam=StubTier("beam caption", seconds=0.2), greedy=StubTier("greedy caption"))
+    assert service._get_image_description(None) == ("beam caption", "beam")
+    assert stubs["greedy"].calls == 0
+
+
+def test_template_captions_are_not_indexed(service, tiers, index, monkeypatch):
+    monkeypatch.setattr(settings, "caption_index_enabled", True)
+    monkeypatch.setattr(service, "_caption_model_key", lambda: "blip")
+    image = Image.new("RGB", (16, 16), "red")
+    tiers(beam=StubTier("beam caption", seconds=2.0))
+    assert service._describe(image, None, True, deadline_ms=100) == (service.ERROR_DESCRIPTION, "model", TEMPLATE_TIER)
+    assert index.added == []
+
+    tiers(beam=StubTier("beam caption"))
+    assert service._describe(image, None, True, deadline_ms=100) == ("beam caption", "model", "beam")
+    assert index.added == ["beam caption"]
@@ -0,0 +1,65 @@
+from app.services import phash_index
+from app.services.phash_index import CaptionIndex, MultiIndexHashTable
+
+
+def test_nearest_finds_hashes_within_max_distance():
+    table = MultiIndexHashTable(max_distance=4)
+    table.add(0b1011, "a")
+    table.add(0xFFFF_0000_FFFF_0000, "b")
+    assert table.nearest(0b1011) == (0, "a")
+    assert table.nearest(0b1011 ^ 0b0101_0000_0000) == (2, "a")
+    assert table.nearest(0xFFFF_0000_FFFF_0000 ^ 0b11111) is None
+    assert table.nearest(0b1010, max_distance=0) is None
+
+
+def test_lookup_only_returns_captions_of_the_same_model(tmp_path):
+    index = CaptionIndex(str(tmp_path / "captions.jsonl"), max_distance=4)
+    index.add(0xAB00, "a dog by kosmos", "kosmos")
+    index.add(0xAB01, "a dog by blip", "blip")
+
+    # The kosmos entry is nearer, but a blip lookup must still find the blip caption
+    assert index.lookup(0xAB00, "blip") == ("a dog by blip", 1)
+    assert index.lookup(0xAB00, "kosmos") == ("a dog by kosmos", 0)
+
+
+def test_add_does_not_replace_other_models_entry(tmp_path):
+    path = str(tmp_path / "captions.jsonl")
+    index = CaptionIndex(path, max_distance=4)
+    index.add(0xAB00, "kosmos caption", "kosmos")
+    index.add(0xAB00, "blip caption", "blip")
+    assert index.lookup(0xAB00, "kosmos") == ("kosmos caption", 0)
+
+    reloaded = CaptionIndex(path, max_distance=4)
+    assert len(reloaded) == 2
+    assert reloaded.lookup(0xAB00, "kosmos") == ("kosmos caption", 0)
+    assert reloaded.lookup(0xAB00, "blip") == ("blip caption", 0)
+
+
+def test_log_is_compacted_when_replaced_entries_dominate(tmp_path, monkeypatch):
+    monkeypatch.setattr(phash_index, "COMPACT_MIN_LINES", 10)
+    path = tmp_path / "captions.jsonl"
+    index = CaptionIndex(str(path), max_distance=4)
+    for round_number in range(10):
+        for phash in (1, 2, 3):
+            index.add(phash, f"caption {round_number}", "blip")
+
+    assert len(path.read_text().splitlines()) < 10
+    reloaded = CaptionIndex(str(path), max_distance=4)
+    assert len(reloaded) == 3
+    assert reloaded.lookup(2, "blip") == ("caption 9", 0)
+
+
+def test_compaction_keeps_entries_appended_by_other_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(phash_index, "COMPACT_MIN_LINES", 10)
+    path = tmp_path / "captions.jsonl"
+    index = CaptionIndex(str(path), max_distance=4)
+    other_worker = CaptionIndex(str(path), max_distance=4)
+    other_worker.add(0xFF00, "seen by another worker", "blip")
+    for round_number in range(10):
+        index.add(1, f"caption {round_number}", "blip")
+
+    assert len(path.read_text().splitlines()) == 2
+    assert index.lookup(0xFF00, "blip") == ("seen by another worker", 0)
+    reloaded = CaptionIndex(str(path), max_distance=4)
+    assert reloaded.lookup(0xFF00, "blip") == ("seen by another worker", 0)
+    assert reloaded.lookup(1, "blip") == ("caption 9", 0)
@@ -0,0 +1,67 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from app.core.lazy import LazyService
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["torch", "transformers", "TTS", "PIL", "librosa", "soundfile"]
+
+
+def test_lazy_service_is_built_once_on_first_use():
+    built = []
+
+    class Service:
+        def __init__(self):
+            built.append(self)
+            self.ready = True
+
+    service = LazyService(Service, "test")
+    assert not service.is_initialized()
+    assert built == []
+
+    threads = [threading.Thread(target=lambda: service.ready) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(built) == 1
+    assert service.is_initialized()
+    assert service.initialize() is built[0]
+
+
+def run_app(tmp_path, edge: bool, script: str) -> dict:
+    """Import the app in a fresh interpreter, run a probe against it and return its JSON output."""
+    env = dict(
+        os.environ, EDGE_MODE="true" if edge else "false", PRELOAD_MODELS="false", STORAGE_BACKEND="local",
+        UPLOAD_DIR=str(tmp_path / "uploads"), DATA_DIR=str(tmp_path / "data")
+    )
+    probe = "import json, sys\nimport app.main\n" + script
+    result = subprocess.run([sys.executable, "-c", probe], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("edge", [False, True])
+def test_importing_the_app_loads_no_ml_libraries(tmp_path, edge):
+    leaked = run_app(tmp_path, edge, f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+    assert leaked == []
+
+
+def test_edge_mode_serves_delivery_routes_only(tmp_path):
+    routes = run_app(tmp_path, True, (
+        "from fastapi.testclient import TestClient\n"
+        "client = TestClient(app.main.app)\n"
+        "print(json.dumps({\n"
+        "    'health': client.get('/health').json()['mode'],\n"
+        "    'upload': client.post('/api/upload').status_code,\n"
+        "    'audio': client.get('/api/audio/missing.wav').status_code,\n"
+        "    'stats': client.get('/api/stories/stats/summary').status_code,\n"
+        "    'heavy': [m for m in %r if m in sys.modules]\n"
+        "}))" % HEAVY_MODULES
+    ))
+    assert routes == {"health": "edge", "upload": 404, "audio": 404, "stats": 200, "heavy": []}
@@ -0,0 +1,147 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.api.endpoints import audio
+from app.services.file_service import file_service
+from app.services.storage_service import LocalStorageBackend, S3StorageBackend, StorageError
+
+BUCKET = "storylens-test"
+
+
+@pytest.fixture
+def local_backend(tmp_path):
+    return LocalStorageBackend(str(tmp_path / "storage"))
+
+
+@pytest.fixture
+def s3_backend(monkeypatch):
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        monkeypatch.setattr(settings, "s3_bucket", BUCKET)
+        monkeypatch.setattr(settings, "s3_prefix", "media")
+        monkeypatch.setattr(settings, "s3_region", "us-east-1")
+        monkeypatch.setattr(settings, "s3_endpoint_url", None)
+        monkeypatch.setattr(settings, "s3_access_key_id", "testing")
+        monkeypatch.setattr(settings, "s3_secret_access_key", "testing")
+        backend = S3StorageBackend()
+        backend.client.create_bucket(Bucket=BUCKET)
+        yield backend
+
+
+@pytest.fixture(params=["local", "s3"])
+def backend(request):
+    return request.getfixturevalue(f"{request.param}_backend")
+
+
+def test_put_and_get(backend):
+    backend.put("images/a.jpg", b"image bytes")
+    assert backend.get("images/a.jpg") == b"image bytes"
+
+
+def test_put_file(backend, tmp_path):
+    source = tmp_path / "source.wav"
+    source.write_bytes(b"RIFF audio")
+    backend.put_file("audio/a.wav", str(source))
+    assert backend.get("audio/a.wav") == b"RIFF audio"
+
+
+def test_get_missing(backend):
+    with pytest.raises(StorageError):
+        backend.get("images/missing.jpg")
+
+
+def test_stream_whole_object(backend):
+    data = bytes(range(256)) * 10
+    backend.put("audio/a.wav", data)
+    assert b"".join(backend.stream("audio/a.wav", chunk_size=100)) == data
+
+
+def test_stream_range(backend):
+    data = bytes(range(256)) * 10
+    backend.put("audio/a.wav", data)
+    assert b"".join(backend.stream("audio/a.wav", start=10, end=19, chunk_size=4)) == data[10:20]
+    assert b"".join(backend.stream("audio/a.wav", start=2500)) == data[2500:]
+
+
+def test_stream_missing(backend):
+    with pytest.raises(StorageError):
+        next(backend.stream("audio/missing.wav"))
+
+
+def test_stat(backend):
+    backend.put("audio/a.wav", b"12345")
+    stat = backend.stat("audio/a.wav")
+    assert stat["key"] == "audio/a.wav"
+    assert stat["size"] == 5
+    assert stat["etag"]
+    assert stat["content_type"] in ("audio/wav", "audio/x-wav")
+    assert backend.exists("audio/a.wav")
+    assert backend.stat("audio/missing.wav") is None
+    assert not backend.exists("audio/missing.wav")
+
+
+def test_delete(backend):
+    backend.put("images/a.jpg", b"x")
+    assert backend.delete("images/a.jpg")
+    assert not backend.exists("images/a.jpg")
+    assert not backend.delete("images/a.jpg")
+
+
+def test_list(backend):
+    backend.put("images/a.jpg", b"a")
+    backend.put("images/b.png", b"bb")
+    backend.put("audio/c.wav", b"ccc")
+    images = sorted(backend.list("images/"), key=lambda obj: obj["key"])
+    assert [(obj["key"], obj["size"]) for obj in images] == [("images/a.jpg", 1), ("images/b.png", 2)]
+    assert {obj["key"] for obj in backend.list()} == {"images/a.jpg", "images/b.png", "audio/c.wav"}
+
+
+def test_download_to(backend, tmp_path):
+    backend.put("images/a.jpg", b"image bytes")
+    target = tmp_path / "copy" / "a.jpg"
+    backend.download_to("images/a.jpg", str(target))
+    assert target.read_bytes() == b"image bytes"
+
+
+def test_local_rejects_escaping_keys(local_backend):
+    with pytest.raises(StorageError):
+        local_backend.put("../outside.txt", b"x")
+
+
+def test_s3_keys_use_prefix(s3_backend):
+    s3_backend.put("images/a.jpg", b"x")
+    keys = [obj["Key"] for obj in s3_backend.client.list_objects_v2(Bucket=BUCKET)["Contents"]]
+    assert keys == ["media/images/a.jpg"]
+
+
+def test_presigned_url(local_backend, s3_backend):
+    assert local_backend.presigned_url("audio/a.wav") is None
+    url = s3_backend.presigned_url("audio/a.wav", expires_in=60)
+    assert f"{BUCKET}" in url and "media/audio/a.wav" in url and "Expires=" in url
+
+
+@pytest.fixture
+def audio_client(monkeypatch, backend):
+    monkeypatch.setattr(file_service, "storage", backend)
+    app = FastAPI()
+    app.include_router(audio.router, prefix="/api")
+    return TestClient(app)
+
+
+def test_audio_endpoint_serves_or_redirects(audio_client, backend):
+    data = b"RIFF" + bytes(1000)
+    backend.put("audio/a.wav", data)
+    response = audio_client.get("/api/audio/a.wav", headers={"Range": "bytes=4-13"}, follow_redirects=False)
+    if backend.name == "s3":
+        assert response.status_code == 307
+        assert "media/audio/a.wav" in response.headers["location"]
+    else:
+        assert response.status_code == 206
+        assert response.content == data[4:14]
+        assert response.headers["content-range"] == "bytes 4-13/1004"
+
+
+def test_audio_endpoint_missing(audio_client):
+    assert audio_client.get("/api/audio/missing.wav", follow_redirects=False).status_code == 404
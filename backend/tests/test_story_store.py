@@ -0,0 +1,79 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.endpoints import stories
+from app.services.story_store import StoryStore, build_match_query
+
+
+def make_story(title, caption, story_type="story"):
+    return {"title": title, "content": "Once upon a time.", "caption": caption, "story_type": story_type,
+            "model_used": "stub"}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StoryStore(str(tmp_path / "stories.db"))
+
+
+def test_build_match_query():
+    assert build_match_query("The dog at the beach") == '"dog" "beach"'
+    assert build_match_query("sunset*") == '"sunset"*'
+    assert build_match_query('"NEAR (dog) -cat') == '"near" "dog" "cat"'
+    assert build_match_query("the") == '"the"'
+    assert build_match_query("?!") is None
+
+
+def test_caption_matches_outrank_newer_title_matches(store):
+    best = store.add(make_story("A Day Out", "a dog running on the beach"), upload_id="old")
+    for index in range(20):
+        store.add(make_story(f"Beach {index}", "a quiet street"), upload_id=f"new-{index}")
+
+    results = store.search(build_match_query("beach"), limit=5)
+    assert results[0]["id"] == best
+    assert results[0]["score"] > results[1]["score"]
+    assert [row["title"] for row in results[1:]] == ["Beach 19", "Beach 18", "Beach 17", "Beach 16"]
+    assert store.count(build_match_query("beach")) == 21
+
+
+def test_search_pages_and_filters(store):
+    for index in range(7):
+        store.add(make_story(f"Story {index}", "a cat on a sofa", "poem" if index % 2 else "story"))
+    match = build_match_query("cats")  # stemmed
+    pages = [store.search(match, limit=3, offset=offset) for offset in (0, 3, 6)]
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert len({row["id"] for page in pages for row in page}) == 7
+    assert {row["story_type"] for row in store.search(match, limit=10, story_type="poem")} == {"poem"}
+    assert store.count(match, story_type="poem") == 3
+
+
+def test_readding_an_upload_replaces_its_story(store):
+    first = store.add(make_story("Beach Day", "a dog on the beach"), upload_id="upload-1")
+    second = store.add(make_story("Mountain Day", "a dog on a mountain"), upload_id="upload-1")
+    assert second == first
+    assert store.get_stats()["stories"] == 1
+    assert store.search(build_match_query("beach")) == []
+    assert [row["title"] for row in store.search(build_match_query("mountain"))] == ["Mountain Day"]
+
+
+@pytest.fixture
+def client(store, monkeypatch):
+    monkeypatch.setattr(stories, "story_store", store)
+    app = FastAPI()
+    app.include_router(stories.router, prefix="/api")
+    return TestClient(app)
+
+
+def test_search_endpoint(client, store):
+    for index in range(3):
+        store.add(make_story(f"Beach {index}", "waves on the sand"))
+    response = client.get("/api/stories/search", params={"q": "beach", "page": 2, "page_size": 2})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 3
+    assert [result["title"] for result in body["results"]] == ["Beach 0"]
+
+
+def test_search_endpoint_rejects_queries_without_words(client):
+    assert client.get("/api/stories/search", params={"q": "*&!"}).status_code == 400
+    assert client.get("/api/stories/search", params={"q": "beach", "story_type": "novel"}).status_code == 400
@@ -0,0 +1,53 @@
+from app.services.story_templates import (
+    STORY_TEMPLATES, POEM_TEMPLATES, TemplatePiece, fill_template, fixed_spans, match_template
+)
+
+DESCRIPTION = "a dog chasing {a ball} on the beach"
+
+
+def test_whole_story_splits_around_the_description():
+    story = fill_template(STORY_TEMPLATES[0], DESCRIPTION)
+    pieces = match_template(story)
+    assert pieces == [
+        TemplatePiece("In a world where magic meets reality, ", True),
+        TemplatePiece(DESCRIPTION, False),
+        TemplatePiece(STORY_TEMPLATES[0].split("{description}")[1], True)
+    ]
+
+
+def test_description_at_the_start_of_a_line():
+    poem = fill_template(POEM_TEMPLATES[0], DESCRIPTION)
+    pieces = match_template(poem)
+    assert pieces[0] == TemplatePiece("In colors bright and spirits high, ", True)
+    assert pieces[1] == TemplatePiece(DESCRIPTION, False)
+    assert pieces[2].text.startswith(" beneath the sky.")
+
+
+def test_single_sentences_match():
+    sentence = f"The photograph captures {DESCRIPTION}, but there's more to this story than meets the eye."
+    assert match_template(sentence) == [
+        TemplatePiece("The photograph captures ", True),
+        TemplatePiece(DESCRIPTION, False),
+        TemplatePiece(", but there's more to this story than meets the eye.", True)
+    ]
+    fixed = "Today marked another chapter in their ongoing adventure, where every moment was a celebration of life itself."
+    assert match_template(fixed) == [TemplatePiece(fixed, True)]
+
+
+def test_whitespace_is_normalized():
+    story = fill_template(STORY_TEMPLATES[2], DESCRIPTION).replace(". ", ".\n  ")
+    assert [piece.fixed for piece in match_template(story)] == [True, False, True]
+
+
+def test_other_text_does_not_match():
+    assert match_template("A dog chased a ball on the beach.") is None
+    # A template frame with nothing in place of the description
+    assert match_template("The photograph captures , but there's more to this story than meets the eye.") is None
+
+
+def test_fixed_spans_cover_every_match():
+    spans = set(fixed_spans())
+    for template in STORY_TEMPLATES + POEM_TEMPLATES:
+        for piece in match_template(fill_template(template, DESCRIPTION)):
+            assert not piece.fixed or piece.text in spans
+    assert all(span.strip() and "{description}" not in span for span in spans)
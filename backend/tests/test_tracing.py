@@ -0,0 +1,129 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.core import tracing
+from app.core.config import settings
+from app.core.tracing import Tracer, JsonFileExporter, TracingMiddleware, STATUS_ERROR, propagate
+
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "tracer", Tracer(JsonFileExporter(str(path))))
+    monkeypatch.setattr(settings, "tracing_enabled", True)
+    monkeypatch.setattr(settings, "trace_sample_rate", 1.0)
+    monkeypatch.setattr(settings, "trace_slow_threshold_ms", 60000)
+    return path
+
+
+def exported_traces(path):
+    """Spans of each exported trace, keyed by span name."""
+    if not path.exists():
+        return []
+    traces = []
+    for line in path.read_text().splitlines():
+        spans = json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        traces.append({span["name"]: span for span in spans})
+    return traces
+
+
+def test_nested_spans_are_exported_together(trace_file):
+    with tracing.trace_span("root", story_type="poem"):
+        with tracing.trace_span("child"):
+            tracing.current_span().set_attribute("device", "cpu")
+
+    [trace] = exported_traces(trace_file)
+    root, child = trace["root"], trace["child"]
+    assert child["traceId"] == root["traceId"]
+    assert child["parentSpanId"] == root["spanId"]
+    assert "parentSpanId" not in root
+    assert {"key": "device", "value": {"stringValue": "cpu"}} in child["attributes"]
+
+
+def test_errors_are_recorded_on_the_span(trace_file):
+    with pytest.raises(ValueError):
+        with tracing.trace_span("root"):
+            raise ValueError("bad image")
+    [trace] = exported_traces(trace_file)
+    assert trace["root"]["status"] == {"code": STATUS_ERROR, "message": "ValueError: bad image"}
+
+
+def test_unsampled_fast_traces_are_dropped_but_slow_ones_kept(trace_file, monkeypatch):
+    monkeypatch.setattr(settings, "trace_sample_rate", 0.0)
+    with tracing.trace_span("fast"):
+        pass
+    assert exported_traces(trace_file) == []
+
+    monkeypatch.setattr(settings, "trace_slow_threshold_ms", 0)
+    with tracing.trace_span("slow"):
+        pass
+    assert [list(trace) for trace in exported_traces(trace_file)] == [["slow"]]
+
+
+def test_propagate_parents_spans_opened_in_executor_threads(trace_file):
+    def work():
+        with tracing.trace_span("worker"):
+            pass
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with tracing.trace_span("root"):
+            executor.submit(propagate(work)).result()
+
+    [trace] = exported_traces(trace_file)
+    assert trace["worker"]["parentSpanId"] == trace["root"]["spanId"]
+
+
+def test_span_finishing_after_its_root_follows_the_root_decision(trace_file):
+    started, release = threading.Event(), threading.Event()
+
+    def background():
+        with tracing.trace_span("background"):
+            started.set()
+            release.wait()
+
+    with tracing.trace_span("root"):
+        thread = threading.Thread(target=propagate(background))
+        thread.start()
+        started.wait()
+    release.set()
+    thread.join()
+
+    traces = exported_traces(trace_file)
+    assert [list(trace) for trace in traces] == [["root"], ["background"]]
+    assert traces[1]["background"]["parentSpanId"] == traces[0]["root"]["spanId"]
+
+
+def test_disabled_tracing_uses_noop_spans(trace_file, monkeypatch):
+    monkeypatch.setattr(settings, "tracing_enabled", False)
+    with tracing.trace_span("root") as span:
+        span.set_attribute("ignored", True)
+        assert tracing.current_span() is tracing.NOOP_SPAN
+    assert exported_traces(trace_file) == []
+
+
+def test_middleware_assigns_request_ids(trace_file):
+    app = FastAPI()
+
+    @app.get("/ping")
+    def ping():
+        return {"request_id": tracing.get_request_id()}
+
+    app.add_middleware(TracingMiddleware)
+    client = TestClient(app)
+
+    response = client.get("/ping", headers={"X-Request-ID": "abc123"})
+    assert response.headers["x-request-id"] == "abc123"
+    assert response.json() == {"request_id": "abc123"}
+
+    generated = client.get("/ping")
+    assert generated.headers["x-request-id"] == generated.json()["request_id"]
+    assert len(generated.headers["x-request-id"]) == 32
+
+    request_span = exported_traces(trace_file)[0]["http.request"]
+    assert {"key": "request_id", "value": {"stringValue": "abc123"}} in request_span["attributes"]
+    assert {"key": "status_code", "value": {"intValue": "200"}} in request_span["attributes"]
@@ -0,0 +1,87 @@
+import threading
+
+import numpy as np
+import pytest
+
+from app.services import tts_fragments
+from app.services.tts_fragments import FragmentCache, boundary_pause, splice
+
+RATE = 1000
+
+
+def tone(seconds, amplitude):
+    """A voiced piece padded with silence on both sides."""
+    silence = np.zeros(int(0.1 * RATE), dtype=np.float32)
+    voiced = np.full(int(seconds * RATE), amplitude, dtype=np.float32)
+    return np.concatenate([silence, voiced, silence])
+
+
+def test_boundary_pause_follows_punctuation():
+    assert boundary_pause("In a world.", "The air") == tts_fragments.BOUNDARY_PAUSES["."]
+    assert boundary_pause("The photograph captures ", ", but") == tts_fragments.BOUNDARY_PAUSES[","]
+    assert boundary_pause("The photograph captures ", "a dog") == tts_fragments.DEFAULT_PAUSE
+
+
+def test_splice_trims_silence_and_inserts_pauses():
+    segments = [("Once upon a time.", tone(0.5, 0.5), True), ("A dog", tone(0.3, 0.5), False)]
+    wav = splice(segments, RATE)
+    padding = int(tts_fragments.EDGE_PADDING_SECONDS * RATE)
+    pause = int(tts_fragments.BOUNDARY_PAUSES["."] * RATE)
+    assert wav.dtype == np.float32
+    assert len(wav) == (500 + 2 * padding) + pause + (300 + 2 * padding)
+
+
+def test_pieces_are_faded_in_and_out():
+    wav = splice([("Hello.", np.full(RATE, 0.5, dtype=np.float32), True)], RATE)
+    fade = int(tts_fragments.FADE_SECONDS * RATE)
+    assert wav[0] == 0 and wav[-1] == 0
+    assert 0 < wav[fade // 2] < 0.5
+    assert wav[fade] == pytest.approx(0.5)
+
+
+def test_splice_matches_the_loudness_of_variable_pieces():
+    segments = [("The photograph captures ", tone(0.5, 0.4), True), ("a dog", tone(0.5, 0.1), False)]
+    wav = splice(segments, RATE)
+    fixed, variable = wav[:len(wav) // 2], wav[len(wav) // 2:]
+    assert np.max(fixed) == pytest.approx(0.4)
+    # Raised towards the fixed pieces' level, but by at most MAX_GAIN
+    assert np.max(variable) == pytest.approx(0.1 * tts_fragments.MAX_GAIN)
+
+
+def test_pieces_without_audio_only_contribute_punctuation():
+    segments = [("a dog", tone(0.2, 0.5), False), (",", None, True), ("a friendship true.", tone(0.2, 0.5), True)]
+    wav = splice(segments, RATE)
+    padding = int(tts_fragments.EDGE_PADDING_SECONDS * RATE)
+    pause = int(tts_fragments.BOUNDARY_PAUSES[","] * RATE)
+    assert len(wav) == 2 * (200 + 2 * padding) + pause
+
+
+def test_splice_of_nothing_is_empty():
+    assert splice([], RATE).size == 0
+
+
+def test_fragments_are_synthesized_once_and_persisted(tmp_path):
+    calls = []
+
+    def synthesize():
+        calls.append(1)
+        return tone(0.1, 0.5)
+
+    cache = FragmentCache(str(tmp_path), memory_bytes=1024 * 1024)
+    key = FragmentCache.make_key("xtts", "default", "Once upon a time.")
+    threads = [threading.Thread(target=cache.get_or_synthesize, args=(key, synthesize)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert cache.get_stats()["misses"] == 1 and cache.get_stats()["hits"] == 3
+
+    reloaded = FragmentCache(str(tmp_path), memory_bytes=1024 * 1024)
+    assert np.array_equal(reloaded.get_or_synthesize(key, synthesize), tone(0.1, 0.5))
+    assert len(calls) == 1
+
+
+def test_keys_depend_on_every_part():
+    assert FragmentCache.make_key("xtts", "default", "text") != FragmentCache.make_key("xtts", "narrator", "text")
+    assert FragmentCache.make_key("ab", "c") != FragmentCache.make_key("a", "bc")
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import soundfile as sf
+
+from app.core.config import settings
+from app.services import tts_service as tts_module
+from app.services.tts_service import TTSService, AudioEncodingError, encodable_formats
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """A TTSService with a stand-in model that returns a short tone."""
+    service = TTSService.__new__(TTSService)
+    service.tts = object()
+    monkeypatch.setattr(service, "synthesize", lambda text, voice: (np.zeros(2205, dtype=np.float32), 22050))
+    return service
+
+
+@pytest.fixture
+def without_mp3(monkeypatch):
+    available_subtypes = sf.available_subtypes
+
+    def subtypes(format=None):
+        result = dict(available_subtypes(format))
+        if format == "MP3":
+            result.pop("MPEG_LAYER_III", None)
+        return result
+
+    monkeypatch.setattr(sf, "available_subtypes", subtypes)
+    encodable_formats.cache_clear()
+    yield
+    encodable_formats.cache_clear()
+
+
+def test_supported_formats_follow_libsndfile(service, without_mp3, monkeypatch):
+    monkeypatch.setattr(settings, "audio_formats", ["wav", "flac", "mp3"])
+    assert service.get_supported_formats() == ["wav", "flac"]
+    assert service.resolve_format("flac") == "flac"
+    with pytest.raises(ValueError):
+        service.resolve_format("mp3")
+
+
+def test_generates_encoded_audio(service, tmp_path):
+    output_path = tmp_path / "a.wav"
+    result = service.generate_audio("Hello there.", str(output_path), audio_format="wav")
+    assert result["model_used"] == "xtts-v2"
+    assert sf.info(str(output_path)).samplerate == 22050
+
+
+def test_encode_errors_are_raised_instead_of_mocked(service, tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("Error : MPEG_LAYER_III not supported")
+
+    monkeypatch.setattr(sf, "write", fail)
+    output_path = tmp_path / "a.wav"
+    with pytest.raises(AudioEncodingError):
+        service.generate_audio("Hello there.", str(output_path), audio_format="wav")
+    assert not output_path.exists()
+
+
+def test_synthesis_errors_fall_back_to_mock(service, tmp_path, monkeypatch):
+    def fail(text, voice):
+        raise RuntimeError("model crashed")
+
+    monkeypatch.setattr(service, "synthesize", fail)
+    result = service.generate_audio("Hello there.", str(tmp_path / "a.wav"), audio_format="wav")
+    assert result["model_used"] == "mock-tts-v1"
+
+
+def test_mock_service_lists_only_encodable_formats(without_mp3, monkeypatch):
+    monkeypatch.setattr(settings, "audio_formats", ["wav", "mp3"])
+    assert tts_module.MockTTSService().get_supported_formats() == ["wav"]
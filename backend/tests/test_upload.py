@@ -0,0 +1,188 @@
+import io
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+from app.api import idempotency
+from app.api.endpoints import upload
+from app.services.idempotency_service import IdempotencyCache
+from app.services.story_store import StoryStore
+
+
+def upload_file(data=b"png"):
+    return {"file": ("photo.png", io.BytesIO(data), "image/png")}
+
+
+def parse_events(text):
+    """Split a Server-Sent Events body into (event, data) pairs."""
+    events = []
+    for message in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in message.splitlines())
+        events.append((lines.get("event"), json.loads(lines["data"])))
+    return events
+
+
+class StubFileService:
+    max_file_size = 1024
+
+    def __init__(self):
+        self.deleted = []
+        self.saved_audio = []
+
+    async def save_uploaded_image(self, file):
+        return {"path": "/tmp/photo.png", "upload_id": "upload-1", "filename": "photo.png", "phash": None}
+
+    def delete_file(self, path, upload_id=None):
+        self.deleted.append(upload_id)
+
+    def save_audio(self, audio_bytes, audio_format):
+        self.saved_audio.append(audio_bytes)
+        return f"audio_full.{audio_format}"
+
+    def get_audio_media_type(self, filename):
+        return "audio/wav"
+
+
+class StubTTS:
+    """Synthesizes every sentence as 100 samples and encodes them as their float32 bytes."""
+
+    def resolve_format(self, audio_format):
+        return audio_format or "wav"
+
+    def synthesize(self, text, voice):
+        return np.full(100, len(text), dtype=np.float32), 1000
+
+    def encode_audio(self, wav, sample_rate, audio_format):
+        return wav.tobytes(), sample_rate
+
+
+def generate_story(image_path, story_type, phash, reuse_caption, deadline_ms):
+    return {"title": "Beach Day", "content": "A dog ran. It found a ball. The end.", "story_type": story_type,
+            "caption": "a dog", "generation_time": 0.1, "model_used": "stub", "caption_source": "model"}
+
+
+@pytest.fixture
+def files(monkeypatch):
+    stub = StubFileService()
+    monkeypatch.setattr(upload, "file_service", stub)
+    return stub
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = StoryStore(str(tmp_path / "stories.db"))
+    monkeypatch.setattr(upload, "story_store", store)
+    return store
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(upload.router, prefix="/api")
+    return TestClient(app)
+
+
+def test_stream_stops_generation_when_client_disconnects(client, files, monkeypatch):
+    stream = {}
+
+    def stream_story(image_path, story_type, phash, reuse_caption, stop):
+        stream["stop"] = stop
+        try:
+            for piece in ["a", " dog", " on", " a", " beach"]:
+                yield "token", {"text": piece}
+        finally:
+            stream["closed"] = True
+
+    polls = iter([False, True])
+
+    async def is_disconnected(self):
+        return next(polls, True)
+
+    monkeypatch.setattr(upload, "kosmos_service", SimpleNamespace(stream_story=stream_story))
+    monkeypatch.setattr(Request, "is_disconnected", is_disconnected)
+
+    response = client.post("/api/upload/stream", files=upload_file())
+    assert response.text == upload.format_sse({"text": "a"}, event="token")
+    assert stream["stop"].is_set()
+    assert stream["closed"]
+    assert files.deleted == ["upload-1"]
+
+
+def test_narrate_streams_story_then_audio_per_sentence(client, files, store, monkeypatch):
+    monkeypatch.setattr(upload, "kosmos_service", SimpleNamespace(generate_story=generate_story))
+    monkeypatch.setattr(upload, "tts_service", StubTTS())
+
+    response = client.post("/api/upload/narrate", files=upload_file())
+    assert response.status_code == 200
+    events = parse_events(response.text)
+    assert [event for event, _ in events] == ["story", "audio", "audio", "audio", "done"]
+
+    story = events[0][1]
+    assert story["title"] == "Beach Day"
+    assert store.get_stats()["stories"] == 1
+
+    chunks = [payload for event, payload in events if event == "audio"]
+    assert [chunk["text"] for chunk in chunks] == ["A dog ran.", "It found a ball.", "The end."]
+    assert [chunk["index"] for chunk in chunks] == [0, 1, 2]
+    assert all(chunk["total"] == 3 and chunk["duration"] == 0.1 for chunk in chunks)
+
+    done = events[-1][1]
+    assert done["audio_filename"] == "audio_full.wav"
+    assert done["duration"] == pytest.approx(0.3)
+    assert len(files.saved_audio[0]) == 3 * 100 * 4
+
+
+def test_narrate_rejects_unknown_story_type(client, files):
+    assert client.post("/api/upload/narrate", params={"story_type": "novel"}, files=upload_file()).status_code == 400
+
+
+@pytest.fixture
+def generating(files, store, monkeypatch):
+    """Stub story generation, counting how often it runs."""
+    calls = []
+
+    def generate(**kwargs):
+        calls.append(kwargs)
+        return generate_story(**kwargs)
+
+    monkeypatch.setattr(upload, "kosmos_service", SimpleNamespace(generate_story=generate))
+    monkeypatch.setattr(idempotency, "idempotency_cache", IdempotencyCache(ttl_seconds=60, max_entries=10))
+    return calls
+
+
+def test_upload_retry_with_idempotency_key_is_replayed(client, generating, store):
+    headers = {"Idempotency-Key": "retry-1"}
+    first = client.post("/api/upload", headers=headers, files=upload_file())
+    retry = client.post("/api/upload", headers=headers, files=upload_file())
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers[idempotency.REPLAYED_HEADER] == "true"
+    assert idempotency.REPLAYED_HEADER not in first.headers
+    assert len(generating) == 1
+    assert store.get_stats()["stories"] == 1
+
+
+def test_idempotency_key_reused_for_another_photo_is_rejected(client, generating):
+    headers = {"Idempotency-Key": "retry-1"}
+    client.post("/api/upload", headers=headers, files=upload_file(b"first photo"))
+    response = client.post("/api/upload", headers=headers, files=upload_file(b"second photo"))
+    assert response.status_code == 422
+    assert client.post("/api/upload", params={"story_type": "poem"}, headers=headers,
+                       files=upload_file(b"first photo")).status_code == 422
+    assert len(generating) == 1
+
+
+def test_uploads_without_a_key_always_run(client, generating):
+    client.post("/api/upload", files=upload_file())
+    client.post("/api/upload", files=upload_file())
+    assert len(generating) == 2
+
+
+def test_overlong_idempotency_key_is_rejected(client, generating):
+    response = client.post("/api/upload", headers={"Idempotency-Key": "k" * 256}, files=upload_file())
+    assert response.status_code == 400
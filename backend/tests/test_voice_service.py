@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from app.core.config import settings
+from app.services.voice_service import VoiceService
+
+
+@pytest.fixture
+def voices(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "data_dir", str(tmp_path))
+    return VoiceService()
+
+
+def test_register_voice_stores_clips(voices):
+    entry = voices.register_voice("narrator", [("a.wav", b"first"), ("b.flac", b"second")])
+    assert [os.path.basename(path) for path in entry["references"]] == ["reference_0.wav", "reference_1.flac"]
+    assert [open(path, "rb").read() for path in entry["references"]] == [b"first", b"second"]
+    assert voices.has_voice("narrator")
+    assert VoiceService().get_reference_hash("narrator") == entry["reference_hash"]
+
+
+def test_reregistering_drops_stale_clips_and_latents(voices):
+    first = voices.register_voice("narrator", [("a.wav", b"1"), ("b.wav", b"2"), ("c.wav", b"3")])
+    voice_dir = os.path.dirname(first["references"][0])
+    open(os.path.join(voice_dir, f"latents_{first['reference_hash']}.pt"), "wb").close()
+    voices._latents["narrator:old:cpu"] = ("latent", "embedding")
+
+    second = voices.register_voice("narrator", [("new.wav", b"new")])
+    assert sorted(os.listdir(voice_dir)) == ["reference_0.wav"]
+    assert second["references"] == [os.path.join(voice_dir, "reference_0.wav")]
+    assert second["reference_hash"] != first["reference_hash"]
+    assert voices._latents == {}
+    assert [name for name in os.listdir(voices.voices_dir) if name.startswith(".")] == []
+
+
+def test_rejected_clip_leaves_existing_voice_untouched(voices):
+    entry = voices.register_voice("narrator", [("a.wav", b"1")])
+    with pytest.raises(ValueError):
+        voices.register_voice("narrator", [("a.wav", b"2"), ("b.txt", b"x")])
+    assert voices.get_reference_hash("narrator") == entry["reference_hash"]
+    assert open(entry["references"][0], "rb").read() == b"1"
+
+
+def test_delete_voice_removes_its_directory(voices):
+    entry = voices.register_voice("narrator", [("a.wav", b"1")])
+    assert voices.delete_voice("narrator")
+    assert not os.path.exists(os.path.dirname(entry["references"][0]))
+    assert not voices.has_voice("narrator")
+    assert not voices.delete_voice("narrator")
+
+
+def test_invalid_voice_name(voices):
+    with pytest.raises(ValueError):
+        voices.register_voice("../escape", [("a.wav", b"1")])